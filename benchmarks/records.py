@@ -0,0 +1,89 @@
+# Copyright (c) Matt Haggard.
+# See LICENSE for details.
+"""
+Microbenchmark of the memory used by, and the time taken to build, fetched
+rows as dictionaries and as L{crudset.crud.Record}s.
+
+    python benchmarks/records.py [rows]
+
+Rows come from a Readset like the one in C{rowdecode.py}: a wide table with
+several single references.  As with C{timeit}, the garbage collector is off
+while timing, since every decoded row is kept.
+"""
+
+import gc
+import sys
+import time
+
+from crudset.crud import Crud, Readset, Ref
+
+from rowdecode import things, others, makeRows
+
+
+def makeCrud(records):
+    references = {}
+    for i, other in enumerate(others):
+        references['ref%d' % (i,)] = Ref(Readset(other),
+            getattr(things.c, 'ref%d_id' % (i,)) == other.c.id)
+    return Crud(Readset(things, references=references), table_attr='_type',
+                records=records)
+
+
+def sizeOf(obj, seen=None):
+    """
+    Get the size in bytes of C{obj} and everything it holds, not counting
+    shared objects (such as interned keys) twice.
+    """
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for k, v in obj.iteritems():
+            size += sizeOf(k, seen) + sizeOf(v, seen)
+    elif isinstance(obj, (list, tuple)):
+        for x in obj:
+            size += sizeOf(x, seen)
+    elif hasattr(obj, '_values'):
+        size += sizeOf(obj._values, seen)
+    return size
+
+
+def timeit(decode, rows):
+    gc.collect()
+    gc.disable()
+    try:
+        start = time.time()
+        ret = [decode(row) for row in rows]
+        return time.time() - start, ret
+    finally:
+        gc.enable()
+
+
+def main(count=100000):
+    dict_crud = makeCrud(False)
+    record_crud = makeCrud(True)
+    rows = makeRows(dict_crud, count)
+
+    dict_time, dicts = timeit(dict_crud.row_decoder.decode, rows)
+    record_time, records = timeit(record_crud.row_decoder.decode, rows)
+    assert records[:2] == dicts[:2]
+
+    dict_size = sizeOf(dicts)
+    record_size = sizeOf(records)
+    del dicts, records
+
+    print '%d rows, %d columns, %d single references' % (
+        count, len(dict_crud.select_columns), len(others))
+    print 'dicts:   %10.0f rows/sec %10.0f bytes/row' % (
+        count / dict_time, dict_size / float(count))
+    print 'records: %10.0f rows/sec %10.0f bytes/row' % (
+        count / record_time, record_size / float(count))
+    print 'memory:  %10.1fx smaller' % (dict_size / float(record_size),)
+    print 'speedup: %10.1fx' % (dict_time / record_time,)
+
+
+if __name__ == '__main__':
+    main(*[int(x) for x in sys.argv[1:]])
@@ -0,0 +1,117 @@
+# Copyright (c) Matt Haggard.
+# See LICENSE for details.
+"""
+Microbenchmark of turning result rows into dictionaries on a wide Readset
+with several single references.
+
+    python benchmarks/rowdecode.py [rows]
+
+Compares the precomputed L{crudset.crud._RowDecoder} plan against the
+original cell-by-cell decoding loop.
+"""
+
+import sys
+import time
+
+from sqlalchemy import MetaData, Table, Column, Integer, String
+
+from crudset.crud import Crud, Readset, Ref
+
+
+WIDTH = 30
+REFS = 4
+
+metadata = MetaData()
+things = Table('thing', metadata,
+    Column('id', Integer, primary_key=True),
+    *([Column('ref%d_id' % (i,), Integer) for i in xrange(REFS)]
+      + [Column('col%d' % (i,), String) for i in xrange(WIDTH)])
+)
+others = []
+for i in xrange(REFS):
+    others.append(Table('other%d' % (i,), metadata,
+        Column('id', Integer, primary_key=True),
+        Column('name', String),
+        Column('value', Integer),
+    ))
+
+
+def makeCrud():
+    references = {}
+    for i, other in enumerate(others):
+        references['ref%d' % (i,)] = Ref(Readset(other),
+            getattr(things.c, 'ref%d_id' % (i,)) == other.c.id)
+    return Crud(Readset(things, references=references), table_attr='_type')
+
+
+def makeRows(crud, count):
+    rows = []
+    for i in xrange(count):
+        row = []
+        for (ref_name, col) in crud.select_columns:
+            if ref_name == 'ref0' and i % 2:
+                # half of the rows have a null reference
+                row.append(None)
+            else:
+                row.append(i)
+        rows.append(tuple(row))
+    return rows
+
+
+def legacyRowToDict(crud, row):
+    """
+    The decoding loop crudset used before decoding plans.
+    """
+    ret = {}
+    pk_column = crud.readset.table.primary_key
+    row = row[len(pk_column):]
+    columns = crud.select_columns[len(pk_column):]
+
+    if crud.table_attr:
+        ret[crud.table_attr] = crud._tableName(crud.readset.table)
+    has_value = {}
+    for ((ref_name,col), v) in zip(columns, row):
+        if ref_name is None:
+            ret[col.name] = v
+        else:
+            if ref_name not in has_value:
+                has_value[ref_name] = False
+            if ref_name not in ret:
+                ret[ref_name] = {}
+                if crud.table_attr:
+                    ret[ref_name][crud.table_attr] = crud._tableName(col.table)
+            ret[ref_name][col.name] = v
+            if v is not None:
+                has_value[ref_name] = True
+    for ref_name, ref_has_value in has_value.items():
+        if not ref_has_value:
+            ret[ref_name] = None
+    return ret
+
+
+def timeit(func, rows):
+    start = time.time()
+    for row in rows:
+        func(row)
+    return time.time() - start
+
+
+def main(count=100000):
+    crud = makeCrud()
+    rows = makeRows(crud, count)
+
+    decode = crud.row_decoder.decode
+    assert [decode(x) for x in rows[:2]] == \
+        [legacyRowToDict(crud, x) for x in rows[:2]]
+
+    legacy = timeit(lambda row: legacyRowToDict(crud, row), rows)
+    planned = timeit(decode, rows)
+    print '%d rows, %d columns, %d single references' % (
+        count, len(crud.select_columns), REFS)
+    print 'legacy:  %10.0f rows/sec' % (count / legacy,)
+    print 'planned: %10.0f rows/sec' % (count / planned,)
+    print 'speedup: %10.1fx' % (legacy / planned,)
+
+
+if __name__ == '__main__':
+    main(*[int(x) for x in sys.argv[1:]])
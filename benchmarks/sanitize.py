@@ -0,0 +1,112 @@
+# Copyright (c) Matt Haggard.
+# See LICENSE for details.
+"""
+Microbenchmark of sanitizing a record with 10 field sanitizers.
+
+    python benchmarks/sanitize.py [records]
+
+Compares the plain-call path taken when every sanitizer is synchronous,
+the same chain with one Deferred-returning sanitizer, and the original
+all-inlineCallbacks implementation.
+"""
+
+import sys
+import time
+
+from twisted.internet import defer
+
+from sqlalchemy import MetaData, Table, Column, Integer, String
+
+from crudset.crud import Sanitizer, SanitizationContext, Writeset, SaniChain
+
+
+FIELDS = 10
+
+metadata = MetaData()
+things = Table('thing', metadata,
+    Column('id', Integer, primary_key=True),
+    *[Column('col%d' % (i,), String) for i in xrange(FIELDS)]
+)
+
+
+class LegacySanitizer(Sanitizer):
+    """
+    The sanitizer crudset used before the synchronous fast path.
+    """
+
+    @defer.inlineCallbacks
+    def sanitize(self, context, data, instance=None):
+        result = data
+        for func in self.sanitizeMethods():
+            result = yield func(instance, context, result)
+        stripped = yield self._writeset.sanitize(context, result)
+        defer.returnValue(stripped)
+
+
+    def _fieldSanitizer(self, func, field):
+        @defer.inlineCallbacks
+        def _sanitizer(instance, context, data):
+            if field not in data:
+                defer.returnValue(data)
+            else:
+                output = yield func(instance, context, data, field)
+                data[field] = output
+                defer.returnValue(data)
+        return _sanitizer
+
+
+class LegacySaniChain(SaniChain):
+
+    @defer.inlineCallbacks
+    def sanitize(self, context, data):
+        output = data
+        for sanitizer in self.sanitizers:
+            output = yield sanitizer.sanitize(context, output)
+        defer.returnValue(output)
+
+
+def strip(instance, context, data, field):
+    return data[field].strip()
+
+
+def deferredStrip(instance, context, data, field):
+    return defer.succeed(data[field].strip())
+
+
+def makeChain(sanitizer_class, chain_class, one_deferred=False):
+    sanitizer = sanitizer_class(things)
+    for i in xrange(FIELDS):
+        func = strip
+        if one_deferred and i == 0:
+            func = deferredStrip
+        sanitizer.sanitizeField('col%d' % (i,))(func)
+    return chain_class([sanitizer, Writeset(things, things.columns)])
+
+
+def timeit(chain, count):
+    context = SanitizationContext(None, 'create', None)
+    results = []
+    start = time.time()
+    for i in xrange(count):
+        data = dict([('col%d' % (j,), ' value ') for j in xrange(FIELDS)])
+        chain.sanitize(context, data).addCallback(results.append)
+    elapsed = time.time() - start
+    assert len(results) == count
+    assert results[0]['col0'] == 'value'
+    return elapsed
+
+
+def main(count=20000):
+    print '%d records, %d field sanitizers' % (count, FIELDS)
+    for name, chain in [
+            ('legacy', makeChain(LegacySanitizer, LegacySaniChain)),
+            ('one deferred', makeChain(Sanitizer, SaniChain, True)),
+            ('synchronous', makeChain(Sanitizer, SaniChain)),
+            ]:
+        elapsed = timeit(chain, count)
+        print '%-13s %8.2f usec/record' % (name + ':',
+                                           elapsed / count * 1e6)
+
+
+if __name__ == '__main__':
+    main(*[int(x) for x in sys.argv[1:]])
@@ -0,0 +1,433 @@
+# Copyright (c) Matt Haggard.
+# See LICENSE for details.
+"""
+Benchmark suite for the core CRUD paths.
+
+    python benchmarks/suite.py [options]
+
+Each benchmark is run against in-memory and file-backed SQLite databases
+holding 10k, 100k and 1M people (see C{--sizes} and C{--backends}).  The
+timings are written as JSON (see C{--output}) so that runs can be compared:
+
+    python benchmarks/suite.py --output before.json
+    ... change things ...
+    python benchmarks/suite.py --output after.json
+    python benchmarks/suite.py --compare before.json after.json
+
+Benchmarks:
+
+  - C{create}, C{createMany}: inserting people through a sanitizer chain.
+  - C{fetch/<s>single-<m>multi}: fetching 1000 people with C{s} single and
+    C{m} multiple references.
+  - C{decode/<s>single}: turning 1000 already fetched rows into records.
+  - C{sanitize/chain}: sanitizing 1000 records with a L{SaniChain}.
+  - C{count/*}: counting people, with and without references and filters.
+  - C{page/*}: the last page of people by C{OFFSET}, keyset and with a
+    count.
+"""
+
+import json
+import os
+import platform
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+from fnmatch import fnmatch
+
+from twisted.internet import defer, task
+
+import sqlalchemy
+from sqlalchemy import MetaData, Table, Column, Integer, String, ForeignKey
+from sqlalchemy import Index, create_engine
+from sqlalchemy.schema import CreateTable, CreateIndex
+from sqlalchemy.pool import StaticPool
+from alchimia import TWISTED_STRATEGY
+
+from crudset.crud import Crud, Readset, Ref, Sanitizer, Writeset, SaniChain
+from crudset.crud import Paginator, SanitizationContext
+from crudset.version import version
+
+
+SIZES = (10000, 100000, 1000000)
+BACKENDS = ('memory', 'file')
+INSERT_CHUNK = 10000
+FETCH_ROWS = 1000
+PAGE_SIZE = 20
+
+metadata = MetaData()
+cities = Table('city', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('name', String),
+)
+companies = Table('company', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('name', String),
+    Column('city_id', Integer, ForeignKey('city.id')),
+)
+families = Table('family', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('surname', String),
+    Column('location', String),
+)
+people = Table('people', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('family_id', Integer, ForeignKey('family.id')),
+    Column('company_id', Integer, ForeignKey('company.id')),
+    Column('city_id', Integer, ForeignKey('city.id')),
+    Column('name', String),
+    Column('email', String),
+    Column('age', Integer),
+)
+pets = Table('pets', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('owner_id', Integer, ForeignKey('people.id')),
+    Column('name', String),
+)
+nicknames = Table('nickname', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('person_id', Integer, ForeignKey('people.id')),
+    Column('nickname', String),
+)
+Index('pets_owner', pets.c.owner_id)
+Index('nickname_person', nicknames.c.person_id)
+Index('people_age', people.c.age)
+
+
+SINGLE_REFS = [
+    ('family', lambda: Ref(Readset(families),
+                           people.c.family_id == families.c.id)),
+    ('company', lambda: Ref(Readset(companies),
+                            people.c.company_id == companies.c.id)),
+    ('city', lambda: Ref(Readset(cities), people.c.city_id == cities.c.id)),
+]
+MULTI_REFS = [
+    ('pets', lambda: Ref(Readset(pets), pets.c.owner_id == people.c.id,
+                         multiple=True)),
+    ('nicknames', lambda: Ref(Readset(nicknames),
+                              nicknames.c.person_id == people.c.id,
+                              multiple=True)),
+]
+
+
+
+class PeopleSanitizer(object):
+    """
+    A sanitizer with a few field sanitizers, like an application's.
+    """
+
+    sanitizer = Sanitizer(people)
+
+    @sanitizer.sanitizeField('name')
+    def name(self, context, data, field):
+        return data[field].strip()
+
+
+    @sanitizer.sanitizeField('email')
+    def email(self, context, data, field):
+        return data[field].lower()
+
+
+    @sanitizer.sanitizeField('age')
+    def age(self, context, data, field):
+        return int(data[field])
+
+
+    @sanitizer.sanitizeData
+    def defaults(self, context, data):
+        data.setdefault('city_id', 1)
+        return data
+
+
+
+def makeSanitizer():
+    writeset = Writeset(people, writeable=[x.name for x in people.columns
+                                           if x.name != 'id'])
+    return SaniChain([PeopleSanitizer().sanitizer, writeset])
+
+
+def makeCrud(single=0, multiple=0):
+    references = {}
+    for name, ref in SINGLE_REFS[:single] + MULTI_REFS[:multiple]:
+        references[name] = ref()
+    return Crud(Readset(people, references=references), makeSanitizer())
+
+
+def makePerson(i):
+    return {
+        'name': '  person %d ' % (i,),
+        'email': 'Person%d@Example.com' % (i,),
+        'age': str(i % 90),
+        'family_id': '1',
+    }
+
+
+
+def makeEngine(reactor, backend, directory):
+    if backend == 'memory':
+        return create_engine('sqlite://',
+                             connect_args={'check_same_thread': False},
+                             reactor=reactor,
+                             strategy=TWISTED_STRATEGY,
+                             poolclass=StaticPool)
+    path = os.path.join(directory, 'bench.sqlite')
+    if os.path.exists(path):
+        os.remove(path)
+    return create_engine('sqlite:///' + path,
+                         connect_args={'check_same_thread': False},
+                         reactor=reactor,
+                         strategy=TWISTED_STRATEGY)
+
+
+
+@defer.inlineCallbacks
+def populate(engine, size):
+    """
+    Create the tables and fill them with C{size} people (and their
+    families, companies, cities, pets and nicknames).
+    """
+    for table in metadata.sorted_tables:
+        yield engine.execute(CreateTable(table))
+    for index in [x for t in metadata.sorted_tables for x in t.indexes]:
+        yield engine.execute(CreateIndex(index))
+
+    yield insertRows(engine, cities, 100, lambda i: {
+        'id': i, 'name': 'city %d' % (i,)})
+    yield insertRows(engine, companies, 1000, lambda i: {
+        'id': i, 'name': 'company %d' % (i,), 'city_id': i % 100 + 1})
+    yield insertRows(engine, families, max(size / 4, 1), lambda i: {
+        'id': i, 'surname': 'family %d' % (i,), 'location': 'here'})
+    yield insertRows(engine, people, size, lambda i: {
+        'id': i,
+        'family_id': i / 4 + 1,
+        'company_id': i % 1000 + 1,
+        'city_id': i % 100 + 1,
+        'name': 'person %d' % (i,),
+        'email': 'person%d@example.com' % (i,),
+        'age': i % 90,
+    })
+    yield insertRows(engine, pets, size / 2, lambda i: {
+        'id': i, 'owner_id': i * 2, 'name': 'pet %d' % (i,)})
+    yield insertRows(engine, nicknames, size, lambda i: {
+        'id': i, 'person_id': i, 'nickname': 'nick %d' % (i,)})
+
+
+@defer.inlineCallbacks
+def insertRows(engine, table, count, makeRow):
+    for start in xrange(1, count + 1, INSERT_CHUNK):
+        rows = [makeRow(i) for i in xrange(start,
+                                           min(start + INSERT_CHUNK,
+                                               count + 1))]
+        yield engine.execute(table.insert(), rows)
+
+
+
+class Suite(object):
+    """
+    I run benchmarks and collect their results.
+    """
+
+    def __init__(self, repeat, only=None, out=sys.stdout):
+        self.repeat = repeat
+        self.only = only
+        self.out = out
+        self.results = []
+
+
+    @defer.inlineCallbacks
+    def measure(self, name, backend, size, func, ops=1):
+        """
+        Time C{func} (which may return a Deferred) C{repeat} times.
+
+        @param ops: The number of things C{func} does, for working out a
+            rate.
+        """
+        if self.only and not [x for x in self.only if fnmatch(name, x)]:
+            return
+        times = []
+        for i in xrange(self.repeat):
+            start = time.time()
+            yield defer.maybeDeferred(func)
+            times.append(time.time() - start)
+        times.sort()
+        median = times[len(times) / 2]
+        result = {
+            'name': name,
+            'backend': backend,
+            'size': size,
+            'ops': ops,
+            'times': times,
+            'min': times[0],
+            'median': median,
+            'ops_per_sec': ops / median if median else None,
+        }
+        self.results.append(result)
+        self.out.write('%-8s %8d %-24s %10.5fs %12.0f ops/s\n' % (
+            backend, size, name, median, result['ops_per_sec'] or 0))
+        self.out.flush()
+
+
+    @defer.inlineCallbacks
+    def run(self, engine, backend, size):
+        """
+        Run every benchmark on a populated C{engine}.
+        """
+        measure = lambda name, func, ops=1: self.measure(name, backend,
+                                                         size, func, ops)
+        crud = makeCrud()
+
+        # writes
+        counter = iter(xrange(size * 10, sys.maxint))
+        @defer.inlineCallbacks
+        def create():
+            for i in xrange(100):
+                yield crud.create(engine, makePerson(counter.next()))
+        yield measure('create', create, 100)
+        yield measure('createMany', lambda: crud.createMany(engine,
+            [makePerson(counter.next()) for i in xrange(FETCH_ROWS)]),
+            FETCH_ROWS)
+
+        # reads
+        where = people.c.id > size / 2
+        for single in (0, 1, len(SINGLE_REFS)):
+            for multiple in (0, 1, len(MULTI_REFS)):
+                c = makeCrud(single, multiple)
+                yield measure('fetch/%dsingle-%dmulti' % (single, multiple),
+                    lambda c=c: c.fetch(engine, where, order=people.c.id,
+                                        limit=FETCH_ROWS),
+                    FETCH_ROWS)
+
+        for single in (0, 1, len(SINGLE_REFS)):
+            c = makeCrud(single)
+            result = yield engine.execute(c._fetchQuery(where,
+                order=people.c.id, limit=FETCH_ROWS))
+            rows = yield result.fetchall()
+            decode = c.row_decoder.decode
+            yield measure('decode/%dsingle' % (single,),
+                lambda rows=rows, decode=decode: [decode(x) for x in rows],
+                len(rows))
+
+        chain = makeSanitizer()
+        context = SanitizationContext(engine, 'create', None)
+        records = [makePerson(i) for i in xrange(FETCH_ROWS)]
+        @defer.inlineCallbacks
+        def sanitize():
+            for record in records:
+                yield chain.sanitize(context, dict(record))
+        yield measure('sanitize/chain', sanitize, len(records))
+
+        yield measure('count/plain', lambda: crud.count(engine))
+        c = makeCrud(len(SINGLE_REFS))
+        yield measure('count/%dsingle' % (len(SINGLE_REFS),),
+                      lambda: c.count(engine))
+        yield measure('count/where', lambda: crud.count(engine,
+                                                        people.c.age < 30))
+
+        # deep pages
+        pager = Paginator(crud, page_size=PAGE_SIZE, order=people.c.id)
+        last = size / PAGE_SIZE - 1
+        yield measure('page/offset', lambda: pager.page(engine, last),
+                      PAGE_SIZE)
+        yield measure('page/keyset', lambda: pager.pageAfter(engine,
+            (last * PAGE_SIZE,)), PAGE_SIZE)
+        # ordered by an indexed column other than the primary key
+        age_pager = Paginator(crud, page_size=PAGE_SIZE, order=people.c.age)
+        yield measure('page/keyset-age', lambda: age_pager.pageAfter(engine,
+            (88, last * PAGE_SIZE)), PAGE_SIZE)
+        yield measure('page/withCount', lambda: pager.pageWithCount(engine,
+            last), PAGE_SIZE)
+        c = makeCrud(1)
+        ref_pager = Paginator(c, page_size=PAGE_SIZE, order=people.c.id)
+        yield measure('page/offset-1single',
+                      lambda: ref_pager.page(engine, last), PAGE_SIZE)
+
+
+
+def environment():
+    """
+    Describe where the benchmarks are being run.
+    """
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+            stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'commit': commit,
+        'crudset': version,
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'sqlalchemy': sqlalchemy.__version__,
+        'sqlite': sqlite3.sqlite_version,
+        'platform': platform.platform(),
+    }
+
+
+def compare(old_path, new_path, out=sys.stdout):
+    """
+    Print the change in median time of each benchmark between two result
+    files.
+    """
+    old = json.load(open(old_path))
+    new = json.load(open(new_path))
+    key = lambda x: (x['backend'], x['size'], x['name'])
+    old_results = dict([(key(x), x) for x in old['results']])
+    for result in new['results']:
+        before = old_results.get(key(result))
+        if before is None:
+            change = 'new'
+        else:
+            change = '%+7.1f%%' % (
+                (result['median'] / before['median'] - 1) * 100,)
+        out.write('%-8s %8d %-24s %10.5fs %s\n' % (
+            result['backend'], result['size'], result['name'],
+            result['median'], change))
+
+
+@defer.inlineCallbacks
+def main(reactor, argv):
+    parser = ArgumentParser(description='Benchmark crudset.')
+    parser.add_argument('--sizes', default=','.join(map(str, SIZES)),
+        help='Comma separated numbers of people (default: %(default)s)')
+    parser.add_argument('--backends', default=','.join(BACKENDS),
+        help='Comma separated SQLite backends (default: %(default)s)')
+    parser.add_argument('--repeat', type=int, default=5,
+        help='Times to run each benchmark (default: %(default)s)')
+    parser.add_argument('--only', action='append',
+        help='Only run benchmarks matching this glob (may be repeated)')
+    parser.add_argument('--output', default='benchmark-results.json',
+        help='Where to write the results (default: %(default)s)')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'),
+        help='Compare two result files instead of running')
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    suite = Suite(args.repeat, args.only)
+    directory = tempfile.mkdtemp()
+    try:
+        for size in [int(x) for x in args.sizes.split(',')]:
+            for backend in args.backends.split(','):
+                engine = makeEngine(reactor, backend, directory)
+                start = time.time()
+                yield populate(engine, size)
+                sys.stdout.write('%-8s %8d populated in %.1fs\n' % (
+                    backend, size, time.time() - start))
+                yield suite.run(engine, backend, size)
+    finally:
+        shutil.rmtree(directory)
+
+    with open(args.output, 'w') as fh:
+        json.dump({'environment': environment(), 'results': suite.results},
+                  fh, indent=2, sort_keys=True)
+    sys.stdout.write('wrote %s\n' % (args.output,))
+
+
+if __name__ == '__main__':
+    task.react(main, [sys.argv[1:]])
@@ -1,8 +1,13 @@
 __all__ = [
     'Crud', 'Readset', 'Writeset', 'Paginator', 'Ref', 'Sanitizer',
-    'crudFromSpec', '__version__',
+    'crudFromSpec', 'QueryCache', 'LazyList', 'Record', 'Histograms',
+    'transaction', 'Router', '__version__',
 ]
 
 from crudset.crud import Crud, Readset, Paginator, Ref, Sanitizer, Writeset
-from crudset.crud import crudFromSpec
+from crudset.crud import crudFromSpec, LazyList, Record
+from crudset.cache import QueryCache
+from crudset.instrument import Histograms
+from crudset.engine import transaction
+from crudset.router import Router
 from crudset.version import version as __version__
@@ -0,0 +1,504 @@
+import time
+import weakref
+from collections import OrderedDict
+from copy import deepcopy
+
+from sqlalchemy.schema import Column
+from sqlalchemy.sql import expression as sql
+
+
+
+# every live QueryCache, so that a write through any Crud can invalidate
+# all of them.
+_caches = weakref.WeakKeyDictionary()
+
+
+
+def invalidateTable(table):
+    """
+    Tell every L{QueryCache} that C{table} has been written to.
+    """
+    for cache in list(_caches):
+        cache.invalidate(table)
+
+
+
+def queryKey(engine, query, statements=None):
+    """
+    Get a hashable key identifying the results of running C{query} on
+    C{engine}: the engine, the compiled SQL and its parameters.
+
+    @param statements: An optional L{StatementCache} to compile C{query}
+        with.
+    """
+    if statements is None:
+        compiled = query.compile(dialect=engine.dialect)
+        params = compiled.params
+    else:
+        compiled, params = statements.compile(engine.dialect, query)
+        if compiled is query:
+            compiled = query.compile(dialect=engine.dialect)
+            params = compiled.params
+        else:
+            params = compiled.construct_params(params)
+    params = sorted(params.items())
+    try:
+        hash(tuple(params))
+    except TypeError:
+        params = repr(params)
+    return (engine, str(compiled), tuple(params))
+
+
+
+class QueryCache(object):
+    """
+    I cache the results of read queries for a L{Crud}.
+
+    Entries are keyed on the engine, the compiled SQL and its parameters.
+    The least recently used entries are evicted once there are more than
+    C{max_size} of them, and entries older than C{ttl} seconds are never
+    returned.  A write to any of the tables an entry was read from (through
+    any L{Crud}) invalidates it.
+
+    @ivar hits: The number of lookups that found an entry.
+    @ivar misses: The number of lookups that didn't.
+    """
+
+    def __init__(self, max_size=1000, ttl=None, clock=None):
+        """
+        @param max_size: The most entries to keep.
+        @param ttl: If not C{None}, the number of seconds an entry is good
+            for.
+        @param clock: An object with a C{seconds()} method such as the
+            reactor.  Defaults to the system time.
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self._now = time.time if clock is None else clock.seconds
+        self._entries = OrderedDict()
+        self._tables = {}
+        self._versions = {}
+        self.hits = 0
+        self.misses = 0
+        _caches[self] = True
+
+
+    def __repr__(self):
+        return 'QueryCache(max_size=%r, ttl=%r)' % (self.max_size, self.ttl)
+
+
+    def __len__(self):
+        return len(self._entries)
+
+
+    def key(self, engine, query, statements=None):
+        """
+        Get the cache key for running C{query} on C{engine}.
+
+        @param statements: An optional L{StatementCache} to compile C{query}
+            with.
+        """
+        return queryKey(engine, query, statements)
+
+
+    def get(self, key):
+        """
+        Look up an entry.
+
+        @return: A tuple of C{(found, value)}.  C{value} is a copy of what
+            was cached, so callers are free to change it.
+        """
+        entry = self._entries.get(key)
+        if entry is not None:
+            value, tables, stored = entry
+            if self.ttl is None or self._now() - stored < self.ttl:
+                del self._entries[key]
+                self._entries[key] = entry
+                self.hits += 1
+                return True, deepcopy(value)
+            self._remove(key)
+        self.misses += 1
+        return False, None
+
+
+    def versions(self, tables):
+        """
+        Get a token for the current state of C{tables}, to be passed to
+        L{put} once a query reading them has finished.
+        """
+        return tuple([self._versions.get(x, 0) for x in tables])
+
+
+    def put(self, key, value, tables, versions):
+        """
+        Store an entry, unless one of C{tables} was written to since
+        C{versions} was taken (in which case C{value} may be stale).
+
+        @param tables: The tables C{value} was read from.
+        @param versions: The result of L{versions} for C{tables} from
+            before the query was run.
+        """
+        tables = tuple(tables)
+        if self.versions(tables) != versions:
+            return
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (deepcopy(value), tables, self._now())
+        for table in tables:
+            self._tables.setdefault(table, set()).add(key)
+        while len(self._entries) > self.max_size:
+            self._remove(iter(self._entries).next())
+
+
+    def invalidate(self, table):
+        """
+        Forget every entry read from C{table}.
+        """
+        self._versions[table] = self._versions.get(table, 0) + 1
+        for key in list(self._tables.pop(table, [])):
+            self._remove(key)
+
+
+    def clear(self):
+        """
+        Forget every entry.
+        """
+        for table in list(self._tables):
+            self.invalidate(table)
+
+
+    def _remove(self, key):
+        value, tables, stored = self._entries.pop(key)
+        for table in tables:
+            keys = self._tables.get(table)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tables[table]
+
+
+
+class StatementCache(object):
+    """
+    I cache compiled statements, so that statements of the same shape
+    (differing only in the values of their parameters) are compiled once.
+
+    The shape of a C{SELECT} covers its columns, joins, C{WHERE} clause
+    structure, order and whether it has a limit and offset, but not their
+    values.  The least recently used compiled statements are evicted once
+    there are more than C{max_size} of them.
+
+        compiled, params = statements.compile(engine.dialect, query)
+        result = yield engine.execute(compiled, params)
+
+    @ivar hits: The number of statements which had already been compiled.
+    @ivar misses: The number which had to be compiled.
+    @ivar uncacheable: The number which couldn't be cached (they use
+        constructs I don't know the shape of) and so were left alone.
+    """
+
+    # stand-ins for the limit and offset, so that the parameters the
+    # compiler makes for them can be picked out
+    _limit = -1239876541
+    _offset = -1239876542
+
+    def __init__(self, max_size=200):
+        """
+        @param max_size: The most compiled statements to keep.
+        """
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._parts = {}
+        self.hits = 0
+        self.misses = 0
+        self.uncacheable = 0
+
+
+    def __repr__(self):
+        return 'StatementCache(max_size=%r)' % (self.max_size,)
+
+
+    def __len__(self):
+        return len(self._entries)
+
+
+    def compile(self, dialect, statement):
+        """
+        Compile C{statement} for C{dialect}, unless one of the same shape
+        has been already.
+
+        @return: A tuple of C{(compiled, params)} to execute.  If
+            C{statement} can't be cached, it's returned as it is (with
+            empty C{params}) to be executed the usual way.
+        """
+        if len(self._parts) > self.max_size:
+            self._parts.clear()
+        binds = []
+        try:
+            key = (dialect, _selectShape(statement, binds, self._parts))
+            hash(key)
+        except (_Uncacheable, TypeError):
+            self.uncacheable += 1
+            return statement, {}
+
+        try:
+            entry = self._entries.pop(key)
+        except KeyError:
+            # the shapes that can't be cached are remembered too, so as not
+            # to compile them twice every time
+            entry = self._compile(dialect, statement, binds)
+            hit = False
+        else:
+            hit = True
+        self._entries[key] = entry
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+        if entry is None:
+            self.uncacheable += 1
+            return statement, {}
+        elif hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+
+        compiled, names, limit_name, offset_name = entry
+        params = dict(zip(names, [x.effective_value for x in binds]))
+        if limit_name is not None:
+            params[limit_name] = statement._limit
+        if offset_name is not None:
+            params[offset_name] = statement._offset
+        return compiled, params
+
+
+    def _compile(self, dialect, statement, binds):
+        """
+        Compile C{statement} and work out the names of its parameters.
+
+        @return: A tuple of the compiled statement, the names of C{binds}
+            and the names of the limit and offset parameters (or C{None}),
+            or C{None} if the names can't be worked out.
+        """
+        if statement._limit is not None:
+            statement = statement.limit(self._limit)
+        if statement._offset is not None:
+            statement = statement.offset(self._offset)
+        compiled = statement.compile(dialect=dialect)
+        bind_names = compiled.bind_names
+        try:
+            names = [bind_names[x] for x in binds]
+        except KeyError:
+            return None
+
+        limit_name = offset_name = None
+        known = set(binds)
+        for bind, name in bind_names.items():
+            if bind in known:
+                continue
+            # other parameters made by the compiler keep their values
+            if bind.value == self._limit:
+                limit_name = name
+            elif bind.value == self._offset:
+                offset_name = name
+        if (limit_name is None) != (statement._limit is None) or \
+           (offset_name is None) != (statement._offset is None):
+            # the dialect put them straight into the SQL
+            return None
+        return compiled, names, limit_name, offset_name
+
+
+
+class _Uncacheable(Exception):
+    """
+    A statement has something whose shape I don't know.
+    """
+
+
+
+def _shape(element, binds):
+    """
+    Get a hashable description of the SQL C{element} compiles to, leaving
+    out the values of its bound parameters, which are appended to C{binds}
+    in the order they're found.
+
+    @raise _Uncacheable: If C{element} has something I don't know how to
+        describe.
+    """
+    cls = type(element)
+    shaper = _shapers.get(cls)
+    if shaper is None:
+        shaper = _uncacheableShape
+        for bases, func in _shaper_bases:
+            if issubclass(cls, bases):
+                shaper = func
+                break
+        _shapers[cls] = shaper
+    return shaper(element, binds)
+
+
+
+def _bindShape(element, binds):
+    if element.callable is not None or (element.required and
+                                         element.value is None):
+        raise _Uncacheable(element)
+    binds.append(element)
+    return (sql.BindParameter, element._orig_key, element.unique,
+            _typeShape(element.type))
+
+
+def _identityShape(element, binds):
+    # tables and their columns live as long as the metadata, so are their
+    # own description (the id is compared first, so as not to make SQL
+    # of ==)
+    return (id(element), element)
+
+
+def _columnShape(element, binds):
+    if element.table is not None:
+        return (id(element), element)
+    return (sql.ColumnClause, element.name, element.is_literal,
+            _typeShape(element.type))
+
+
+def _labelShape(element, binds):
+    return (sql.Label, element.name, _typeShape(element.type),
+            _shape(element.element, binds))
+
+
+def _binaryShape(element, binds):
+    return (sql.BinaryExpression, element.operator, element.negate,
+            tuple(sorted(element.modifiers.items())),
+            _typeShape(element.type),
+            _shape(element.left, binds), _shape(element.right, binds))
+
+
+def _unaryShape(element, binds):
+    return (sql.UnaryExpression, element.operator, element.modifier,
+            element.negate, _typeShape(element.type),
+            _shape(element.element, binds))
+
+
+def _clauseListShape(element, binds):
+    return (type(element), element.operator, element.group,
+            element.group_contents,
+            tuple([_shape(x, binds) for x in element.clauses]))
+
+
+def _groupingShape(element, binds):
+    return (type(element), _shape(element.element, binds))
+
+
+def _joinShape(element, binds):
+    return (sql.Join, element.isouter, _shape(element.left, binds),
+            _shape(element.right, binds), _shape(element.onclause, binds))
+
+
+def _functionShape(element, binds):
+    return (type(element), getattr(element, 'name', None),
+            tuple(getattr(element, 'packagenames', ())),
+            _typeShape(element.type),
+            _shape(element.clause_expr, binds))
+
+
+def _overShape(element, binds):
+    return (sql.Over, _shape(element.func, binds),
+            _optionalShape(element.partition_by, binds),
+            _optionalShape(element.order_by, binds))
+
+
+def _castShape(element, binds):
+    return (sql.Cast, _typeShape(element.type),
+            _shape(element.clause, binds))
+
+
+def _constantShape(element, binds):
+    return type(element)
+
+
+def _uncacheableShape(element, binds):
+    raise _Uncacheable(element)
+
+
+# how to describe each kind of element, most specific first
+_shaper_bases = [
+    (sql.BindParameter, _bindShape),
+    ((Column, sql.TableClause), _identityShape),
+    (sql.ColumnClause, _columnShape),
+    (sql.Label, _labelShape),
+    (sql.BinaryExpression, _binaryShape),
+    (sql.UnaryExpression, _unaryShape),
+    (sql.ClauseList, _clauseListShape),
+    ((sql.Grouping, sql.FromGrouping), _groupingShape),
+    (sql.Join, _joinShape),
+    (sql.FunctionElement, _functionShape),
+    (sql.Over, _overShape),
+    (sql.Cast, _castShape),
+    ((sql.Null, sql.True_, sql.False_), _constantShape),
+]
+
+# the above, looked up for each class found
+_shapers = {}
+
+
+
+def _optionalShape(element, binds):
+    if element is None:
+        return None
+    return _shape(element, binds)
+
+
+
+def _selectShape(select, binds, parts=None):
+    """
+    Describe a C{SELECT} like L{_shape} does other things.  Only the
+    outermost one is described: the SQL of a subquery depends on what it's
+    correlated with.
+
+    @param parts: A dict to remember the descriptions of lists of columns
+        and C{FROM}s in, since they're shared by the copies C{where()},
+        C{order_by()}, etc. make.
+    """
+    if type(select) is not sql.Select:
+        raise _Uncacheable(select)
+    if (select._distinct not in (True, False) or select._hints or
+            select._prefixes):
+        raise _Uncacheable(select)
+    # execution options (such as stream_results) go along with the
+    # compiled statement, so they're part of the shape
+    return (sql.Select, tuple(sorted(select._execution_options.items())),
+            select.use_labels, select._distinct,
+            select.for_update, select._limit is not None,
+            select._offset is not None,
+            _partShape(select._raw_columns, binds, parts),
+            _partShape(select._from_obj, binds, parts),
+            _optionalShape(select._whereclause, binds),
+            _optionalShape(select._having, binds),
+            _shape(select._order_by_clause, binds),
+            _shape(select._group_by_clause, binds))
+
+
+
+def _partShape(elements, binds, parts):
+    """
+    Describe a list of elements, remembering the description in C{parts}
+    (unless there are parameters in it).
+    """
+    if parts is not None:
+        found = parts.get(id(elements))
+        if found is not None and found[0] is elements:
+            return found[1]
+    count = len(binds)
+    shape = tuple([_shape(x, binds) for x in elements])
+    if parts is not None and len(binds) == count:
+        parts[id(elements)] = (elements, shape)
+    return shape
+
+
+
+def _typeShape(type_):
+    """
+    Describe a type by its class and settings (leaving out what the
+    compiler caches on it).
+    """
+    return (type(type_), tuple(sorted([(k, v) for (k, v) in vars(type_).items()
+                                       if not k.startswith('_')])))
@@ -1,7 +1,29 @@
+import re
+from array import array
+from collections import OrderedDict
+from copy import deepcopy
+from functools import partial
+from itertools import izip
+from operator import itemgetter
+
 from twisted.internet import defer
-from sqlalchemy.sql import select, and_
+from twisted.python import failure
+from sqlalchemy.sql import select, and_, or_, operators, bindparam, func
+from sqlalchemy.sql.util import find_tables
+from sqlalchemy import types
+
+from crudset.error import TooMany, MissingRequiredFields, NotReadable
+from crudset.error import NotLoaded
+from crudset.cache import invalidateTable, queryKey, StatementCache
+from crudset.instrument import instrumented, timeSanitizer, recordCount
+from crudset.instrument import unwrap
+from crudset.engine import driven, driverFor, isAwaitable, asDeferred
+from crudset.engine import Transaction, TwistedDriver
+from crudset.router import onPrimary
+
+
 
-from crudset.error import TooMany, MissingRequiredFields
+_identifier = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
 
 
 
@@ -10,19 +32,59 @@ class Ref(object):
     A reference to another object or list of objects for use within a L{Readset}.
     """
 
-    def __init__(self, readset, join, multiple=False):
+    def __init__(self, readset, join, multiple=False, to_one=None,
+                 lazy=False):
         """
         @param multiple: If C{True} then this is a reference to multiple things
             rather than just one thing (the default).
+
+        @param lazy: If C{True} (and C{multiple} is C{True}) then the things
+            aren't fetched along with the referencing records.  Instead each
+            record gets a L{LazyList} which must be L{LazyList.load}ed.
+
+        @param to_one: If C{True} then the join matches at most one row of the
+            referenced table for each row of the referencing table, so it can
+            be left out of queries that only count rows.  If C{None} (the
+            default) this is guessed from C{join}: it's C{True} if C{join}
+            compares the referenced table's whole primary key (or a unique
+            column) for equality with something from outside the table.
         """
         self.readset = readset
         self.join = join
         self.multiple = multiple
+        if to_one is None:
+            to_one = not multiple and self._guessToOne()
+        self.to_one = to_one
+        self.lazy = lazy
 
 
     def __repr__(self):
-        return 'Ref(%r, %r, multiple=%r)' % (
-            self.readset, self.join, self.multiple)
+        return 'Ref(%r, %r, multiple=%r, lazy=%r)' % (
+            self.readset, self.join, self.multiple, self.lazy)
+
+
+    def _guessToOne(self):
+        table = self.readset.table
+        clauses = [self.join]
+        if getattr(self.join, 'operator', None) is operators.and_:
+            clauses = self.join.clauses
+
+        matched = []
+        for clause in clauses:
+            if getattr(clause, 'operator', None) is not operators.eq:
+                continue
+            for (mine, other) in [(clause.left, clause.right),
+                                  (clause.right, clause.left)]:
+                if getattr(mine, 'table', None) is not table:
+                    continue
+                if getattr(other, 'table', None) is table:
+                    continue
+                if getattr(mine, 'unique', False):
+                    return True
+                if table.primary_key.columns.contains_column(mine):
+                    matched.append(mine.name)
+        pk_names = [x.name for x in table.primary_key]
+        return bool(pk_names) and set(matched) == set(pk_names)
 
 
 
@@ -60,12 +122,22 @@ class SaniChain(object):
         return 'SaniChain(%r, table=%r)' % (self.sanitizers, self.table)
 
 
-    @defer.inlineCallbacks
     def sanitize(self, context, data):
-        output = data
+        return _driverForContext(context).call(self._sanitize, context, data)
+
+
+    def _sanitize(self, context, data):
+        """
+        Like L{sanitize} but only returns a Deferred if one of the chained
+        sanitizers does.
+        """
+        steps = []
         for sanitizer in self.sanitizers:
-            output = yield sanitizer.sanitize(context, output)
-        defer.returnValue(output)
+            if _canSkipDriver(sanitizer):
+                steps.append(partial(sanitizer._sanitize, context))
+            else:
+                steps.append(partial(sanitizer.sanitize, context))
+        return _runSteps(data, steps, context)
 
 
 class Readset(object):
@@ -91,6 +163,42 @@ class Readset(object):
             self.table, list(self.readable), self.references)
 
 
+    def project(self, fields):
+        """
+        Make a L{Readset} with only some of my fields and references.
+
+        @param fields: A list of readable field names and reference names.
+            Only some fields of a reference can be chosen with dotted paths
+            such as C{'owner.name'}.
+
+        @raise NotReadable: If one of C{fields} isn't readable.
+        """
+        names = set()
+        ref_fields = {}
+        for field in fields:
+            name, dot, rest = field.partition('.')
+            if name in self.references:
+                if not dot:
+                    ref_fields[name] = None
+                elif ref_fields.get(name, []) is not None:
+                    ref_fields.setdefault(name, []).append(rest)
+            elif not dot and name in self.readable:
+                names.add(name)
+            else:
+                raise NotReadable('Not a readable field: %s' % (field,))
+
+        references = {}
+        for name, subfields in ref_fields.items():
+            ref = self.references[name]
+            readset = ref.readset
+            if subfields is not None:
+                readset = readset.project(subfields)
+            references[name] = Ref(readset, ref.join, ref.multiple,
+                                   ref.to_one, ref.lazy)
+        readable = [x.name for x in self.readable_columns if x.name in names]
+        return Readset(self.table, readable, references)
+
+
 class Writeset(object):
     """
     A description of the fields that are writeable.
@@ -120,13 +228,17 @@ class Writeset(object):
 
 
     def sanitize(self, context, data):
+        return _driverForContext(context).call(self._sanitize, context, data)
+
+
+    def _sanitize(self, context, data):
         ret = {}
         union = set(data) & self.writeable
         if context.action == 'create':
             union = union | self.create_writeable
         for key in union:
             ret[key] = data[key]
-        return defer.succeed(ret)
+        return ret
 
 
 
@@ -198,24 +310,34 @@ class Sanitizer(object):
         return deco
 
 
-    @defer.inlineCallbacks
     def sanitize(self, context, data, instance=None):
-        result = data
-        for func in self.sanitizeMethods():
-            result = yield func(instance, context, result)
-        stripped = yield self._writeset.sanitize(context, result)
-        defer.returnValue(stripped)
+        return _driverForContext(context).call(self._sanitize, context, data,
+                                               instance)
+
+
+    def _sanitize(self, context, data, instance=None):
+        """
+        Like L{sanitize} but only returns a Deferred if one of my sanitization
+        functions does.  When they are all synchronous, the data is
+        sanitized with plain function calls.
+        """
+        steps = [partial(method, instance, context)
+                 for method in self.sanitizeMethods()]
+        steps.append(partial(self._writeset._sanitize, context))
+        return _runSteps(data, steps, context)
 
 
     def _fieldSanitizer(self, func, field):
-        @defer.inlineCallbacks
         def _sanitizer(instance, context, data):
             if field not in data:
-                defer.returnValue(data)
-            else:
-                output = yield func(instance, context, data, field)
-                data[field] = output
-                defer.returnValue(data)
+                return data
+            output = func(instance, context, data, field)
+            if isAwaitable(output):
+                output = asDeferred(output, _driverForContext(context).loop)
+            if isinstance(output, defer.Deferred):
+                return output.addCallback(_setItem, data, field)
+            data[field] = output
+            return data
         return _sanitizer
 
 
@@ -253,7 +375,13 @@ class _BoundSanitizer(object):
 
 
     def sanitize(self, context, data):
-        return self.sanitizer.sanitize(context, data, self.instance)        
+        return self.sanitizer.sanitize(context, data, self.instance)
+
+
+    def _sanitize(self, context, data):
+        if not _canSkipDriver(self.sanitizer):
+            return self.sanitizer.sanitize(context, data, self.instance)
+        return self.sanitizer._sanitize(context, data, self.instance)
 
 
     @property
@@ -262,16 +390,116 @@ class _BoundSanitizer(object):
 
 
 
+_sync_sanitizers = (SaniChain, Writeset, Sanitizer, _BoundSanitizer)
+
+# whether each class of sanitizer seen by L{_canSkipDriver} can be
+_skips_driver = {}
+
+
+
+def _canSkipDriver(sanitizer):
+    """
+    Return C{True} if C{sanitizer} is one of mine whose C{_sanitize} can be
+    called instead of C{sanitize}, skipping the driver: that is, if its
+    class doesn't override C{sanitize}.
+    """
+    cls = type(sanitizer)
+    skips = _skips_driver.get(cls)
+    if skips is None:
+        skips = False
+        for base in _sync_sanitizers:
+            if issubclass(cls, base):
+                skips = cls.sanitize.__func__ is base.sanitize.__func__
+                break
+        _skips_driver[cls] = skips
+    return skips
+
+
+
+def _runSteps(value, steps, context):
+    """
+    Pass C{value} through each of C{steps} in turn.
+
+    Steps are called directly for as long as they return plain values.
+    Once one returns a Deferred (or an asyncio Future or coroutine), the
+    remaining steps are chained onto it.
+
+    @param steps: A list of functions which take a single argument.
+    @param context: The L{SanitizationContext}, whose engine's event loop
+        runs any coroutines.
+
+    @return: The final value, or a Deferred which fires with it.
+    """
+    for i, step in enumerate(steps):
+        value = step(value)
+        if isAwaitable(value):
+            value = asDeferred(value, _driverForContext(context).loop)
+        if isinstance(value, defer.Deferred):
+            return value.addCallback(_runSteps, steps[i+1:], context)
+    return value
+
+
+
+def _driverForContext(context):
+    """
+    Get the driver for sanitizing in C{context}, so that sanitizers return
+    the same kind of result as the L{Crud} calling them.
+    """
+    return driverFor(getattr(context, 'engine', None))
+
+
+
+def _setItem(value, data, key):
+    data[key] = value
+    return data
+
+
+
+def _columnLength(columns):
+    """
+    Count the records in the result of L{Crud.fetchColumns}.
+    """
+    for column in columns.values():
+        if isinstance(column, dict):
+            return _columnLength(column)
+        return len(column)
+    return 0
+
+
+
 class Crud(object):
     """
     This turns a L{Readset} and a L{Sanitizer} into a CRUD.
-    See my L{create}, L{fetch}, L{count}, L{update} and L{delete} methods.
+    See my L{create}, L{createMany}, L{fetch}, L{count}, L{update},
+    L{updateMany} and L{delete} methods.
 
     Also, you can use L{fix} to make new L{Crud} instances with certain
     attributes fixed (unchangeable by the user).
+
+    @ivar multi_ref_chunk_size: The most parent records whose
+        C{Ref(multiple=True)} children are loaded by a single query.
+    @ivar create_batch_size: The default number of records inserted and
+        read back at a time by L{createMany}.
+    @ivar update_batch_size: The default number of records updated and
+        read back at a time by L{updateMany}.
+    @ivar projection_cache_size: The most L{Crud}s made for different
+        C{fields} (see L{fetch}) kept for reuse.
+    @ivar statement_cache_size: The most compiled C{SELECT}s kept in my
+        L{statements} cache, or C{0} to compile every one.
+    @ivar statements: The L{StatementCache} my reads are compiled by (shared
+        with the L{Crud}s made from me by L{fix}), whose C{hits} and
+        C{misses} show how well it's doing; or C{None}.
     """
 
-    def __init__(self, readset, sanitizer=None, table_attr=None, table_map=None):
+    multi_ref_chunk_size = 500
+    create_batch_size = 500
+    update_batch_size = 500
+    projection_cache_size = 100
+    statement_cache_size = 200
+
+    def __init__(self, readset, sanitizer=None, table_attr=None, table_map=None,
+                 cache=None, records=False, instrument=None,
+                 single_flight=False):
         """
         @param readset: A L{Readset} instance.
         @param sanitizer: An object with a C{sanitize(context, data)} method
@@ -286,6 +514,21 @@ class Crud(object):
 
         @param table_map: If C{table_attr} is set then this dictionary will
             map table names to something else.
+
+        @param cache: An optional L{QueryCache} for the results of L{fetch},
+            L{getOne} and L{count}.
+
+        @param records: If C{True}, return compact L{Record}s rather than
+            dictionaries.
+
+        @param instrument: An optional function called with an
+            L{OperationEvent} after each of my operations, such as a
+            L{Histograms}.
+
+        @param single_flight: If C{True}, identical L{fetch}, L{getOne} and
+            L{count} calls made while one is already running (on this
+            L{Crud} or one made from it by L{fix}) share its database call
+            instead of making their own.
         """
         self.readset = readset
         
@@ -301,9 +544,21 @@ class Crud(object):
 
         self.table_attr = table_attr
         self.table_map = table_map or {}
+        self.cache = cache
+        self.records = records
+        self.instrument = instrument
+        self.single_flight = single_flight
+        self._origin = self
+        self._in_flight = {}
         self._fixed = {}
-        self._select_columns = []
+        self._unfixed = self
+        self.statements = None
+        if self.statement_cache_size:
+            self.statements = StatementCache(self.statement_cache_size)
+        self._select_columns = None
         self._base_query = None
+        self._row_decoder = None
+        self._projections = OrderedDict()
 
 
     def __repr__(self):
@@ -311,6 +566,24 @@ class Crud(object):
             self.readset, self.sanitizer, self.table_attr, self.table_map)
 
 
+    def loader(self, engine, clock=None):
+        """
+        Make a L{Loader} for getting my records by primary key, with the
+        requests made in one reactor iteration coalesced into one query.
+        This needs a Twisted engine: there's nothing to coalesce when each
+        request blocks.
+
+        @param clock: The reactor (or a L{twisted.internet.task.Clock}) to
+            schedule batches with.  Defaults to the global reactor.
+
+        @raise TypeError: If C{engine} isn't a Twisted engine.
+        """
+        if not isinstance(driverFor(engine), TwistedDriver):
+            raise TypeError('Loaders need a Twisted engine, not %r' % (
+                            engine,))
+        return Loader(self, engine, clock)
+
+
     def fix(self, attrs):
         """
         Fix some attributes to a particular value.
@@ -319,37 +592,114 @@ class Crud(object):
 
         @return: A new L{Crud}.
         """
-        crud = Crud(self.readset, self.sanitizer, self.table_attr,
-                    self.table_map)
+        crud = type(self)(self.readset, self.sanitizer, self.table_attr,
+                          self.table_map, self.cache, self.records,
+                          self.instrument, self.single_flight)
+        crud._origin = self._origin
+        crud._in_flight = self._in_flight
         crud._fixed = self._fixed.copy()
         crud._fixed.update(attrs)
+        # share the unconstrained query (and everything else that doesn't
+        # depend on the fixed values) instead of building it again
+        crud._unfixed = self._unfixed
+        crud.statements = self.statements
         return crud
 
 
-    @defer.inlineCallbacks
-    def create(self, engine, attrs):
+    @instrumented('create', rows=recordCount)
+    @onPrimary
+    @driven
+    def create(self, engine, attrs, return_rows=True):
         """
         Create a single record.
+
+        @param return_rows: If C{False}, don't read the new record back and
+            return C{None} instead.
         """
         # fixed attributes
         attrs.update(self._fixed)
 
         # sanitize
         context = SanitizationContext(engine, 'create', None)
-        sanitized = yield self.sanitizer.sanitize(context, attrs)
+        sanitized = yield timeSanitizer(self.sanitizer.sanitize,
+                                        context, attrs)
 
         # do it
         table = self.sanitizer.table
-        result = yield engine.execute(table.insert().values(**sanitized))
+        insert = table.insert().values(**sanitized)
+        if not return_rows:
+            yield self._executeWrite(engine, insert)
+            defer.returnValue(None)
+        elif self._canReturnRows(engine):
+            rows = yield self._executeReturning(engine, insert)
+            defer.returnValue(rows[0])
+
+        result = yield self._executeWrite(engine, insert)
         pk = result.inserted_primary_key
         obj = yield self._getOne(engine, pk)
         defer.returnValue(obj)
 
 
-    @defer.inlineCallbacks
-    def update(self, engine, attrs, where=None):
+    @instrumented('createMany', rows=recordCount)
+    @onPrimary
+    @driven
+    def createMany(self, engine, attrs_list, batch_size=None,
+                   return_rows=True):
+        """
+        Create several records.
+
+        Each item is sanitized just like with L{create}, all of them before
+        anything is inserted, so one bad item leaves nothing half done.
+        The records are then inserted and read back in batches of
+        C{batch_size}.  When the primary key of every record in a batch is
+        known before inserting, the batch is inserted with C{executemany}.
+        Otherwise, if the dialect supports C{RETURNING}, each set of records
+        with the same columns is inserted by one multi-row C{INSERT} which
+        returns their primary keys; if it doesn't, each record is inserted
+        on its own to learn its primary key.
+
+        @param attrs_list: A list of dicts, one per record.
+        @param batch_size: Defaults to L{create_batch_size}.
+        @param return_rows: If C{False}, don't read the new records back and
+            return C{None} instead.
+
+        @return: A list of the created records, in the same order as
+            C{attrs_list}.
+        """
+        batch_size = batch_size or self.create_batch_size
+        rows = []
+        for attrs in attrs_list:
+            attrs.update(self._fixed)
+            context = SanitizationContext(engine, 'create', None)
+            sanitized = yield timeSanitizer(self.sanitizer.sanitize,
+                                            context, attrs)
+            rows.append(sanitized)
+
+        ret = []
+        for i in xrange(0, len(rows), batch_size):
+            pks = yield self._insertMany(engine, rows[i:i+batch_size])
+            if return_rows:
+                records = yield self._getMany(engine, pks)
+                ret.extend(records)
+        if not return_rows:
+            defer.returnValue(None)
+        defer.returnValue(ret)
+
+
+    @instrumented('update', rows=recordCount)
+    @onPrimary
+    @driven
+    def update(self, engine, attrs, where=None, return_rows=True):
         """
         Update a set of records.
+
+        @param return_rows: If C{False}, don't read the updated records back
+            and return C{None} instead.
+
+        @return: The updated records, whether or not they still match
+            C{where}.  If the dialect supports C{RETURNING}, they're returned
+            by the update; otherwise their primary keys are read first and
+            they're read back afterwards.
         """
         up = self._applyConstraints(self.sanitizer.table.update())
 
@@ -363,54 +713,256 @@ class Crud(object):
             query = query.where(where)
 
         context = SanitizationContext(engine, 'update', query)
-        sanitized = yield self.sanitizer.sanitize(context, attrs)
+        sanitized = yield timeSanitizer(self.sanitizer.sanitize,
+                                        context, attrs)
 
         if sanitized:
             up = up.values(**sanitized)
-            yield engine.execute(up)
-
+            if not return_rows:
+                yield self._executeWrite(engine, up)
+            elif self._canReturnRows(engine):
+                rows = yield self._executeReturning(engine, up)
+                defer.returnValue(rows)
+            else:
+                # read back the records that were updated, even if they no
+                # longer match where, as RETURNING does
+                pk_column = list(self.sanitizer.table.primary_key)
+                result = yield self._execute(engine,
+                    query.with_only_columns(pk_column).order_by(*pk_column))
+                pks = yield result.fetchall()
+                yield self._executeWrite(engine, up)
+                rows = yield self._getMany(engine, pks)
+                defer.returnValue(rows)
+
+        if not return_rows:
+            defer.returnValue(None)
         rows = yield self.fetch(engine, where)
         defer.returnValue(rows)
 
 
-    @defer.inlineCallbacks
-    def fetch(self, engine, where=None, order=None, limit=None, offset=None):
+    @instrumented('updateMany', rows=recordCount)
+    @onPrimary
+    @driven
+    def updateMany(self, engine, items, batch_size=None, return_rows=True):
+        """
+        Update several records by primary key, each with its own values.
+
+        Each item is sanitized just like with L{update}, all of them before
+        anything is updated, so one bad item leaves nothing half done.
+        Items changing the same set of fields are updated together with
+        C{executemany} in batches of C{batch_size}, and the records are then
+        read back with one query per batch.  Records outside of my fixed
+        attributes are left alone and not returned.
+
+        @param items: A list of dicts, each with the primary key of the
+            record to update and the values to change.
+        @param batch_size: Defaults to L{update_batch_size}.
+        @param return_rows: If C{False}, don't read the updated records back
+            and return C{None} instead.
+
+        @return: A list of the updated records, in the same order as
+            C{items}.
+        """
+        table = self.sanitizer.table
+        pk_column = list(table.primary_key)
+        batch_size = batch_size or self.update_batch_size
+        pks = []
+        updates = []
+        for item in items:
+            attrs = item.copy()
+            missing = [x.name for x in pk_column if x.name not in attrs]
+            if missing:
+                raise MissingRequiredFields('Missing primary key '
+                    'fields: %s' % (', '.join(missing),))
+            pk = tuple([attrs.pop(x.name) for x in pk_column])
+            pks.append(pk)
+
+            # you can't update fixed attributes
+            for attr in self._fixed:
+                attrs.pop(attr, None)
+
+            query = self._applyConstraints(table.select())
+            query = query.where(and_(*[x == y for (x,y)
+                                       in zip(pk_column, pk)]))
+            context = SanitizationContext(engine, 'update', query)
+            sanitized = yield timeSanitizer(self.sanitizer.sanitize,
+                                            context, attrs)
+            updates.append(sanitized)
+
+        ret = []
+        for i in xrange(0, len(items), batch_size):
+            groups = {}
+            for pk, sanitized in zip(pks[i:i+batch_size],
+                                     updates[i:i+batch_size]):
+                if not sanitized:
+                    continue
+                params = dict([('crudset_pk_%d' % (j,), y)
+                               for (j,y) in enumerate(pk)])
+                params.update(sanitized)
+                groups.setdefault(frozenset(sanitized), []).append(params)
+
+            for fields, params in groups.items():
+                up = self._applyConstraints(table.update())
+                up = up.where(and_(*[x == bindparam('crudset_pk_%d' % (j,))
+                                     for (j,x) in enumerate(pk_column)]))
+                up = up.values(**dict([(x, bindparam(x)) for x in fields]))
+                yield self._executeWrite(engine, up, params)
+
+            if return_rows:
+                records = yield self._getMany(engine, pks[i:i+batch_size])
+                ret.extend(records)
+        if not return_rows:
+            defer.returnValue(None)
+        defer.returnValue(ret)
+
+
+    @instrumented('fetch', rows=recordCount)
+    def fetch(self, engine, where=None, order=None, limit=None, offset=None,
+              fields=None):
         """
         Get a set of records.
 
         @param where: Extra restriction of scope.
+        @param order: An order by clause or a list of them.
+        @param fields: If given, only read these fields of each record.  See
+            L{Readset.project}.  References that aren't asked for aren't
+            joined or fetched.
         """
-        query = self.base_query
+        return driverFor(engine).call(self._fetch, engine, where, order,
+                                      limit, offset, fields)
 
-        if where is not None:
-            query = query.where(where)
 
-        if order is not None:
-            query = query.order_by(order)
+    def _fetch(self, engine, where, order, limit, offset, fields):
+        if fields is not None:
+            return self._project(fields).fetch(engine, where, order, limit,
+                                               offset)
+        query = self._fetchQuery(where, order, limit, offset)
+        return self._cachedRead(engine, query, where, self._fetchAll)
 
-        if limit is not None:
-            query = query.limit(limit)
 
-        if offset is not None:
-            query = query.offset(offset)
+    @instrumented('fetchChunks', rows=int)
+    @driven
+    def fetchChunks(self, engine, callback, where=None, order=None,
+                    chunk_size=1000):
+        """
+        Stream a set of records to C{callback} in lists of at most
+        C{chunk_size} records, so that large results needn't be held in
+        memory all at once.
 
-        result = yield engine.execute(query)
-        rows = yield result.fetchall()
-        ret = []
-        for row in rows:
-            d = yield self._rowToDict(engine, row)
-            ret.append(d)
+        The query asks for a server-side cursor (C{stream_results}), so
+        with drivers that support one, such as psycopg2, only about a chunk
+        of rows is held at a time.  SQLite reads rows as they're fetched
+        anyway.  Other drivers may still buffer the whole result when it's
+        executed, in which case only the records made from it are kept to a
+        chunk at a time.
+
+        References are handled the same as with L{fetch}.
+
+        @param callback: A function called with each list of records.  If it
+            returns a Deferred, no more rows are read until that Deferred
+            fires.
+
+        @return: A Deferred which fires with the number of records once all
+            of them have been handed to C{callback}.
+        """
+        query = self._fetchQuery(where, order)
+        query = query.execution_options(stream_results=True)
+        result = yield self._execute(engine, query)
+        total = 0
+        try:
+            while True:
+                rows = yield _fetchmany(result, chunk_size)
+                if not rows:
+                    break
+                chunk = yield self._rowsToDicts(engine, rows)
+                total += len(chunk)
+                yield callback(chunk)
+        except Exception:
+            err = failure.Failure()
+            yield _closeResult(result)
+            err.raiseException()
+        defer.returnValue(total)
+
+
+    @instrumented('fetchColumns', rows=_columnLength)
+    @driven
+    def fetchColumns(self, engine, where=None, order=None, limit=None,
+                     offset=None, fields=None, chunk_size=1000,
+                     use_numpy=False):
+        """
+        Get a set of records as columns rather than rows.
+
+        Numeric columns that can't be null (integers and non-decimal floats
+        declared with C{nullable=False}) are read into C{array.array}s;
+        everything else is read into lists.  Columns of single references
+        may always be null, so they are lists.  Multiple references aren't
+        read.
+
+        Rows are read C{chunk_size} at a time and go straight into the
+        columns without being made into records.
+
+        @param use_numpy: If C{True}, numeric columns are NumPy arrays
+            instead (sharing memory with the C{array.array}s).  NumPy must
+            be installed.
+
+        @return: A Deferred which fires with a dict mapping each readable
+            field to its column of values.  Each single reference maps to a
+            dict of its own columns.
+        """
+        if fields is not None:
+            crud = self._project(fields)
+            ret = yield crud.fetchColumns(engine, where, order, limit, offset,
+                chunk_size=chunk_size, use_numpy=use_numpy)
+            defer.returnValue(ret)
+
+        ret = {}
+        columns = []
+        pk_len = len(self.readset.table.primary_key)
+        for (ref_name, col) in self.select_columns[pk_len:]:
+            if ref_name is None:
+                typecode = _arrayTypecode(col)
+                target = ret
+            else:
+                typecode = None
+                target = ret.setdefault(ref_name, {})
+            if typecode is None:
+                target[col.name] = []
+            else:
+                target[col.name] = array(typecode)
+            columns.append(target[col.name])
+
+        query = self._fetchQuery(where, order, limit, offset)
+        result = yield self._execute(engine, query)
+        try:
+            while True:
+                rows = yield _fetchmany(result, chunk_size)
+                if not rows:
+                    break
+                for column, values in izip(columns, zip(*rows)[pk_len:]):
+                    column.extend(values)
+        except Exception:
+            err = failure.Failure()
+            yield _closeResult(result)
+            err.raiseException()
+
+        if use_numpy:
+            import numpy
+            for name, column in ret.items():
+                if isinstance(column, array):
+                    ret[name] = numpy.frombuffer(column, column.typecode)
         defer.returnValue(ret)
 
 
-    @defer.inlineCallbacks
-    def getOne(self, engine, where=None):
+    @instrumented('getOne', rows=recordCount)
+    @driven
+    def getOne(self, engine, where=None, fields=None):
         """
         Get one record or fail trying.
 
         @param where: Where clause.
+        @param fields: If given, only read these fields.  See L{fetch}.
         """
-        rows = yield self.fetch(engine, where, limit=2)
+        rows = yield self.fetch(engine, where, limit=2, fields=fields)
         if len(rows) > 1:
             raise TooMany("Expecting one and found more than that")
         elif not rows:
@@ -418,22 +970,26 @@ class Crud(object):
         defer.returnValue(rows[0])
 
 
-    @defer.inlineCallbacks
+    @instrumented('count')
     def count(self, engine, where=None):
         """
         Count a set of records.
+
+        Single references declared (or guessed) as C{to_one} can't change
+        the number of records, so they aren't joined unless C{where} needs
+        them.
         """
-        query = self.base_query
+        return driverFor(engine).call(self._count, engine, where)
 
-        if where is not None:
-            query = query.where(where)
 
-        result = yield engine.execute(query.alias().count())
-        rows = yield result.fetchone()
-        defer.returnValue(rows[0])
+    def _count(self, engine, where):
+        return self._cachedRead(engine, self._countQuery(where), where,
+                                self._fetchScalar)
 
 
-    @defer.inlineCallbacks
+    @instrumented('delete')
+    @onPrimary
+    @driven
     def delete(self, engine, where=None):
         """
         Delete a set of records.
@@ -444,7 +1000,202 @@ class Crud(object):
         if where is not None:
             delete = delete.where(where)
 
-        yield engine.execute(delete)
+        yield self._executeWrite(engine, delete)
+
+
+    @driven
+    def _fetchAll(self, engine, query):
+        result = yield self._execute(engine, query)
+        rows = yield result.fetchall()
+        ret = yield self._rowsToDicts(engine, rows)
+        defer.returnValue(ret)
+
+
+    @driven
+    def _fetchScalar(self, engine, query):
+        result = yield self._execute(engine, query)
+        rows = yield result.fetchone()
+        defer.returnValue(rows[0])
+
+
+    def _cachedRead(self, engine, query, where, read):
+        """
+        Call C{read(engine, query)} unless its result is in my cache.
+
+        Reads in a L{Transaction} can see its uncommitted writes, so they
+        are neither cached nor shared.
+
+        @param where: The where clause given for C{query}, for finding the
+            tables it depends on.
+        """
+        if isinstance(unwrap(engine), Transaction):
+            return read(engine, query)
+        if self.cache is None:
+            if not self.single_flight:
+                return read(engine, query)
+            return self._singleFlight(engine,
+                queryKey(unwrap(engine), query, self.statements), query,
+                read)
+        return self._readThroughCache(engine, query, where, read)
+
+
+    @driven
+    def _readThroughCache(self, engine, query, where, read):
+        key = self.cache.key(unwrap(engine), query, self.statements)
+        found, value = self.cache.get(key)
+        if found:
+            defer.returnValue(value)
+
+        tables = set([self.readset.table])
+        for ref in self.readset.references.values():
+            tables.add(ref.readset.table)
+        if where is not None:
+            tables.update(find_tables(where, check_columns=True))
+        tables = tuple(tables)
+        versions = self.cache.versions(tables)
+
+        if self.single_flight:
+            value = yield self._singleFlight(engine, key, query, read)
+        else:
+            value = yield read(engine, query)
+        self.cache.put(key, value, tables, versions)
+        defer.returnValue(value)
+
+
+    @driven
+    def _singleFlight(self, engine, key, query, read):
+        """
+        Call C{read(engine, query)}, unless an identical read (with the
+        same C{key}) is already running, in which case wait for its result
+        instead.  Every caller gets its own copy of the result.
+        """
+        waiting = self._in_flight.get(key)
+        if waiting is not None:
+            d = defer.Deferred()
+            waiting.append(d)
+            result = yield d
+            defer.returnValue(result)
+
+        waiting = self._in_flight[key] = []
+        try:
+            result = yield read(engine, query)
+        except Exception:
+            err = failure.Failure()
+            del self._in_flight[key]
+            for d in waiting:
+                d.errback(err)
+            err.raiseException()
+        del self._in_flight[key]
+        for d in waiting:
+            d.callback(deepcopy(result))
+        defer.returnValue(result)
+
+
+    def _execute(self, engine, query):
+        """
+        Execute a C{SELECT}, compiled by my L{statements} cache.
+        """
+        if self.statements is None:
+            return engine.execute(query)
+        compiled, params = self.statements.compile(engine.dialect, query)
+        if compiled is query:
+            return engine.execute(query)
+        return engine.execute(compiled, params)
+
+
+    @driven
+    def _executeWrite(self, engine, statement, *multiparams):
+        """
+        Execute a statement which writes to my table, invalidating cached
+        reads of it.
+        """
+        txn = unwrap(engine)
+        if isinstance(txn, Transaction):
+            txn.written.add(self.sanitizer.table)
+        try:
+            result = yield engine.execute(statement, *multiparams)
+        finally:
+            invalidateTable(self.sanitizer.table)
+        defer.returnValue(result)
+
+
+    def _project(self, fields):
+        """
+        Get a L{Crud} like me that only reads C{fields}.
+        """
+        key = frozenset(fields)
+        crud = self._projections.pop(key, None)
+        if crud is None:
+            crud = type(self)(self.readset.project(fields), self.sanitizer,
+                              self.table_attr, self.table_map, self.cache,
+                              self.records, self.instrument,
+                              self.single_flight)
+            crud._origin = self._origin
+            crud._in_flight = self._in_flight
+            crud._fixed = self._fixed
+            crud.statements = self.statements
+            if self._unfixed is not self:
+                crud._unfixed = self._unfixed._project(fields)
+        self._projections[key] = crud
+        while len(self._projections) > self.projection_cache_size:
+            self._projections.popitem(last=False)
+        return crud
+
+
+    def _countQuery(self, where=None):
+        """
+        Build a query counting my records, with only the joins that can
+        change the count or that C{where} refers to.
+        """
+        refs = [ref for (ref_name, ref) in self.readset.references.items()
+                if not ref.multiple]
+        needed = set()
+        if where is not None:
+            needed.update(find_tables(where, check_columns=True))
+        kept = set()
+        changed = True
+        while changed:
+            # a kept join may refer to the tables of other references
+            changed = False
+            for i, ref in enumerate(refs):
+                if i in kept:
+                    continue
+                if not ref.to_one or ref.readset.table in needed:
+                    kept.add(i)
+                    needed.update(find_tables(ref.join, check_columns=True))
+                    changed = True
+
+        join = self.readset.table
+        for i, ref in enumerate(refs):
+            if i in kept:
+                join = join.outerjoin(ref.readset.table, ref.join)
+        query = select([func.count()]).select_from(join)
+        query = self._applyConstraints(query)
+        if where is not None:
+            query = query.where(where)
+        return query
+
+
+    def _fetchQuery(self, where=None, order=None, limit=None, offset=None):
+        """
+        Build the query for fetching records.
+        """
+        query = self.base_query
+
+        if where is not None:
+            query = query.where(where)
+
+        if isinstance(order, (list, tuple)):
+            query = query.order_by(*order)
+        elif order is not None:
+            query = query.order_by(order)
+
+        if limit is not None:
+            query = query.limit(limit)
+
+        if offset is not None:
+            query = query.offset(offset)
+        return query
 
 
     @property
@@ -460,7 +1211,33 @@ class Crud(object):
             self._select_columns, self._base_query = self._generateBaseQueryAndColumns()
         return self._base_query
 
+
+    @property
+    def row_decoder(self):
+        if self._unfixed is not self:
+            return self._unfixed.row_decoder
+        if self._row_decoder is None:
+            self._row_decoder = _RowDecoder(self.readset.table,
+                self.select_columns, self.readset.references,
+                self.table_attr, self._tableName, self.records)
+        return self._row_decoder
+
+
     def _generateBaseQueryAndColumns(self):
+        """
+        Build the query my records are fetched with, before any C{where},
+        C{order}, etc., along with the C{(ref_name, column)} pairs it
+        selects.
+
+        L{Crud}s made by L{fix} share the query of the L{Crud} they were
+        made from (without fixed attributes) and add their own constraints
+        to it.
+        """
+        unfixed = self._unfixed
+        if unfixed is not self:
+            return (unfixed.select_columns,
+                    self._applyConstraints(unfixed.base_query))
+
         # grab the primary key for later
         columns = [(None, x.label('pk-%d'%(i,))) for (i,x) in enumerate(self.readset.table.primary_key)]
         columns = columns + [(None,x) for x in self.readset.readable_columns]
@@ -481,9 +1258,16 @@ class Crud(object):
 
 
     def _applyConstraints(self, query):
+        """
+        Limit C{query} to records with my fixed attributes.
+
+        The fixed values are bound parameters, always in the same order, so
+        L{Crud}s fixing the same attributes make the same SQL whatever the
+        values.
+        """
         if self._fixed:
             where = None
-            for k, v in self._fixed.items():
+            for k, v in sorted(self._fixed.items()):
                 col = getattr(self.readset.table.c, k)
                 comp = col == v
                 if where is not None:
@@ -494,7 +1278,143 @@ class Crud(object):
         return query
 
 
-    @defer.inlineCallbacks
+    def _canReturnRows(self, engine):
+        """
+        Return C{True} if written records can be read back with a
+        C{RETURNING} clause on C{engine} instead of a separate query.
+
+        This is only possible if the dialect supports C{RETURNING} and there
+        are no single references to join.  (SQLAlchemy 0.8 can't compile
+        C{RETURNING} for SQLite.)
+        """
+        if not getattr(engine.dialect, 'implicit_returning', False):
+            return False
+        for ref in self.readset.references.values():
+            if not ref.multiple:
+                return False
+        return True
+
+
+    @driven
+    def _executeReturning(self, engine, statement):
+        """
+        Execute an insert or update, getting the written records back in
+        the same statement.
+        """
+        table = self.readset.table
+        columns = list(table.primary_key) + self.readset.readable_columns
+        result = yield self._executeWrite(engine,
+                                          statement.returning(*columns))
+        rows = yield result.fetchall()
+        records = yield self._rowsToDicts(engine, rows)
+        defer.returnValue(records)
+
+
+    @driven
+    def _insertMany(self, engine, rows):
+        """
+        Insert sanitized rows.
+
+        @return: A list of the primary key tuples of the rows.
+        """
+        table = self.sanitizer.table
+        pk_names = [x.name for x in table.primary_key]
+        pks = []
+        for row in rows:
+            pk = tuple([row.get(x) for x in pk_names])
+            if None in pk:
+                break
+            pks.append(pk)
+        else:
+            # every primary key is known, so executemany each group of
+            # rows with the same set of columns.
+            groups = {}
+            for row in rows:
+                groups.setdefault(frozenset(row), []).append(row)
+            for group in groups.values():
+                yield self._executeWrite(engine, table.insert(), group)
+            defer.returnValue(pks)
+
+        if getattr(engine.dialect, 'implicit_returning', False):
+            pks = yield self._insertReturningPks(engine, rows)
+            defer.returnValue(pks)
+
+        pks = []
+        for row in rows:
+            result = yield self._executeWrite(engine,
+                                              table.insert().values(**row))
+            pks.append(tuple(result.inserted_primary_key))
+        defer.returnValue(pks)
+
+
+    @driven
+    def _insertReturningPks(self, engine, rows):
+        """
+        Insert sanitized rows with a multi-row C{INSERT ... RETURNING} for
+        each set of columns, relying on the primary keys coming back in the
+        same order as the rows.
+
+        @return: A list of the primary key tuples of the rows.
+        """
+        table = self.sanitizer.table
+        pk_columns = list(table.primary_key)
+        pks = [None] * len(rows)
+        groups = {}
+        for i, row in enumerate(rows):
+            groups.setdefault(frozenset(row), []).append(i)
+        for columns, indexes in groups.items():
+            if columns:
+                inserts = [table.insert().values([rows[i] for i in indexes])]
+            else:
+                # there are no VALUES to give several rows of
+                inserts = [table.insert().values() for i in indexes]
+            returned = []
+            for insert in inserts:
+                result = yield self._executeWrite(engine,
+                    insert.returning(*pk_columns))
+                rows_back = yield result.fetchall()
+                returned.extend(rows_back)
+            for i, pk in zip(indexes, returned):
+                pks[i] = tuple(pk)
+        defer.returnValue(pks)
+
+
+    @driven
+    def _getMany(self, engine, pks):
+        """
+        Get the records with the given primary keys with one query.
+
+        @param pks: A list of primary key tuples.
+
+        @return: A list of records in the same order as C{pks}.  Records
+            which aren't found (for instance because of my fixed
+            attributes) are left out.
+        """
+        by_pk = yield self._getByPk(engine, pks)
+        defer.returnValue([by_pk[tuple(x)] for x in pks
+                           if tuple(x) in by_pk])
+
+
+    @driven
+    def _getByPk(self, engine, pks):
+        """
+        Get the records with the given primary keys with one query.
+
+        @param pks: A list of primary key tuples.
+
+        @return: A dict mapping the primary key tuple of each record found
+            to the record.
+        """
+        pk_column = list(self.readset.table.primary_key)
+        query = self.base_query.where(_pkIn(pk_column, pks))
+        result = yield self._execute(engine, query)
+        rows = yield result.fetchall()
+        records = yield self._rowsToDicts(engine, rows)
+        defer.returnValue(dict(zip([tuple(x[:len(pk_column)]) for x in rows],
+                                   records)))
+
+
+    @driven
     def _getOne(self, engine, pk):
         # base query
         query = self.base_query
@@ -503,76 +1423,667 @@ class Crud(object):
         where = [x == y for (x,y) in zip(table.primary_key.columns, pk)]
         query = query.where(*where)
         
-        result = yield engine.execute(query)
+        result = yield self._execute(engine, query)
         row = yield result.fetchone()
-        data = yield self._rowToDict(engine, row)
-        defer.returnValue(data)
+        data = yield self._rowsToDicts(engine, [row])
+        defer.returnValue(data[0])
 
 
     def _tableName(self, table):
         return self.table_map.get(table, table.name)
 
 
-    @defer.inlineCallbacks
-    def _rowToDict(self, engine, row):
-        # XXX you could make this way faster
+    @driven
+    def _rowsToDicts(self, engine, rows):
+        """
+        Turn result rows into dictionaries (or L{Record}s), including
+        references.  The children of each multiple L{Ref} are loaded for all
+        the rows at once.
+        """
+        decoder = self.row_decoder
+        if not (rows and decoder.multi_names):
+            defer.returnValue([decoder.decode(row) for row in rows])
+
+        pk_len = len(self.readset.table.primary_key)
+        pks = [tuple(row[:pk_len]) for row in rows]
+        multi_values = []
+        for ref_name in decoder.multi_names:
+            ref = self.readset.references[ref_name]
+            if ref.lazy:
+                batch = _LazyBatch(self, unwrap(engine), ref_name, ref)
+                multi_values.append([batch.add(pk) for pk in pks])
+                continue
+            children = yield self._fetchMultiRef(engine, ref_name, ref, pks)
+            multi_values.append([children.get(pk, []) for pk in pks])
+        defer.returnValue([decoder.decode(row, values) for (row, values)
+                           in izip(rows, izip(*multi_values))])
+
+
+    @driven
+    def _fetchMultiRef(self, engine, ref_name, ref, pks):
+        """
+        Fetch the children of a multiple L{Ref} for many parent records with
+        one query per L{multi_ref_chunk_size} parents.
+
+        @param pks: A list of parent primary key tuples.
+
+        @return: A dict mapping parent primary key tuples to lists of child
+            dictionaries (or L{Record}s).
+        """
+        make = self.row_decoder.children[ref_name]
+        pk_column = list(self.readset.table.primary_key)
+        columns = ref.readset.readable_columns
+        join = self.readset.table.join(ref.readset.table, ref.join)
+        query = select(
+            [x.label('pk-%d' % (i,)) for (i,x) in enumerate(pk_column)]
+            + columns).select_from(join)
+
+        unique_pks = list(set(pks))
         ret = {}
-        pk_column = self.readset.table.primary_key
-        pk_value = row[:len(pk_column)]
-
-        row = row[len(pk_column):]
-        columns = self.select_columns[len(pk_column):]
-
-        if self.table_attr:
-            ret[self.table_attr] = self._tableName(self.readset.table)
-        # XXX the null-reference checking seems less than optimal (lots of
-        # looping and branching.  Maybe there's a way to have the response
-        # tell us clearly whether the record is null or not)
-        has_value = {}
-        for ((ref_name,col), v) in zip(columns, row):
+        for i in xrange(0, len(unique_pks), self.multi_ref_chunk_size):
+            chunk = unique_pks[i:i+self.multi_ref_chunk_size]
+            result = yield self._execute(
+                engine, query.where(_pkIn(pk_column, chunk)))
+            rows = yield result.fetchall()
+            for row in rows:
+                ret.setdefault(tuple(row[:len(pk_column)]), []).append(
+                    make(list(row[len(pk_column):])))
+        defer.returnValue(ret)
+
+
+
+class LazyList(object):
+    """
+    A list of records from a lazy multiple L{Ref} which isn't fetched until
+    something calls L{load}.
+
+    Loading any L{LazyList} loads those of every record from the same fetch
+    with a single query.  Once loaded, I behave like a (read-only) list;
+    before that, using me as a list raises L{NotLoaded}.
+    """
+
+    def __init__(self, batch, pk):
+        self._batch = batch
+        self._pk = pk
+        self._items = None
+
+
+    def __repr__(self):
+        if self._items is None:
+            return '<LazyList (not loaded)>'
+        return 'LazyList(%r)' % (self._items,)
+
+
+    @property
+    def loaded(self):
+        return self._items is not None
+
+
+    def load(self):
+        """
+        Fetch the records.
+
+        @return: A Deferred (or whatever the engine's operations return)
+            which fires with the list of records.
+        """
+        return driverFor(self._batch.engine).run(self._batch.load(self))
+
+
+    def _list(self):
+        if self._items is None:
+            raise NotLoaded("Call load() first")
+        return self._items
+
+
+    def __iter__(self):
+        return iter(self._list())
+
+
+    def __len__(self):
+        return len(self._list())
+
+
+    def __getitem__(self, index):
+        return self._list()[index]
+
+
+    def __contains__(self, item):
+        return item in self._list()
+
+
+    def __eq__(self, other):
+        if isinstance(other, LazyList):
+            other = other._list()
+        return self._list() == other
+
+
+    def __ne__(self, other):
+        return not self == other
+
+
+    def __deepcopy__(self, memo):
+        # cached results share the same (not yet) loaded list
+        return self
+
+
+
+class _LazyBatch(object):
+    """
+    I load the L{LazyList}s of one lazy L{Ref} for all the records of a
+    single fetch.
+    """
+
+    def __init__(self, crud, engine, ref_name, ref):
+        self.crud = crud
+        self.engine = engine
+        self.ref_name = ref_name
+        self.ref = ref
+        self.lists = []
+        self._waiting = None
+
+
+    def add(self, pk):
+        """
+        Make a L{LazyList} for the record with primary key C{pk}.
+        """
+        lazy = LazyList(self, pk)
+        self.lists.append(lazy)
+        return lazy
+
+
+    def load(self, lazy):
+        """
+        Load every L{LazyList} (unless already loaded or loading), to be
+        run by the engine's driver.
+
+        @return: A generator which returns the items of C{lazy}.
+        """
+        if lazy._items is not None:
+            defer.returnValue(lazy._items)
+        elif self._waiting is not None:
+            d = defer.Deferred()
+            self._waiting.append(d)
+            yield d
+            defer.returnValue(lazy._items)
+
+        self._waiting = []
+        pks = [x._pk for x in self.lists]
+        try:
+            children = yield self.crud._fetchMultiRef(self.engine,
+                self.ref_name, self.ref, pks)
+        except Exception:
+            err = failure.Failure()
+            waiting, self._waiting = self._waiting, None
+            for d in waiting:
+                d.errback(err)
+            err.raiseException()
+
+        for x in self.lists:
+            x._items = children.get(x._pk, [])
+        waiting, self._waiting = self._waiting, None
+        for d in waiting:
+            d.callback(None)
+        defer.returnValue(lazy._items)
+
+
+
+class Loader(object):
+    """
+    I get records by primary key for a L{Crud}, DataLoader-style: every
+    key asked for by L{load} in one reactor iteration is fetched with a
+    single C{IN} query.  Get one from L{Crud.loader}.
+
+    Nothing is remembered between batches.
+
+    @ivar max_batch_size: The most keys fetched by a single query.
+    """
+
+    max_batch_size = 500
+
+    def __init__(self, crud, engine, clock=None):
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.crud = crud
+        self.engine = engine
+        self.clock = clock
+        self.instrument = crud.instrument
+        self._origin = crud._origin
+        self._pending = {}
+        self._call = None
+
+
+    def __repr__(self):
+        return 'Loader(%r, %r)' % (self.crud, self.engine)
+
+
+    def load(self, pk):
+        """
+        Get the record with primary key C{pk}.
+
+        @param pk: A primary key value, or a tuple of them for a composite
+            primary key.
+
+        @return: A Deferred which fires with the record, or C{None} if
+            there is no such record.  Callers asking for the same key each
+            get their own copy.
+        """
+        if not isinstance(pk, tuple):
+            pk = (pk,)
+        d = defer.Deferred()
+        self._pending.setdefault(pk, []).append(d)
+        if self._call is None:
+            self._call = self.clock.callLater(0, self._dispatch)
+        return d
+
+
+    def _dispatch(self):
+        self._call = None
+        pending, self._pending = self._pending, {}
+        keys = pending.keys()
+        for i in xrange(0, len(keys), self.max_batch_size):
+            batch = dict([(k, pending[k])
+                          for k in keys[i:i + self.max_batch_size]])
+            self._load(self.engine, list(batch)).addCallbacks(
+                self._loaded, self._failed,
+                callbackArgs=(batch,), errbackArgs=(batch,))
+
+
+    @instrumented('load', rows=len)
+    def _load(self, engine, keys):
+        return self.crud._getByPk(engine, keys)
+
+
+    def _loaded(self, records, batch):
+        for pk, waiting in batch.items():
+            record = records.get(pk)
+            # copy before any caller can change the record
+            copies = [record] + [deepcopy(record) for d in waiting[1:]]
+            for d, copy in zip(waiting, copies):
+                d.callback(copy)
+
+
+    def _failed(self, err, batch):
+        for waiting in batch.values():
+            for d in waiting:
+                d.errback(err)
+
+
+
+class Record(object):
+    """
+    A compact record returned by a L{Crud} made with C{records=True}.
+
+    Fields can be read as attributes (if the field name is a valid
+    identifier) or as items, like a read-mostly C{dict}.  Each L{Readset}
+    gets its own subclass of me, whose instances hold just a list of
+    values.
+    """
+
+    __slots__ = ('_values',)
+    _fields = ()
+    _index = {}
+
+    def __init__(self, values):
+        self._values = values
+
+
+    def __repr__(self):
+        return '%s(%s)' % (type(self).__name__, ', '.join(
+            ['%s=%r' % x for x in zip(self._fields, self._values)]))
+
+
+    def __getitem__(self, key):
+        return self._values[self._index[key]]
+
+
+    def __setitem__(self, key, value):
+        self._values[self._index[key]] = value
+
+
+    def __contains__(self, key):
+        return key in self._index
+
+
+    def __iter__(self):
+        return iter(self._fields)
+
+
+    def __len__(self):
+        return len(self._fields)
+
+
+    def __eq__(self, other):
+        if isinstance(other, Record):
+            return (self._fields == other._fields
+                    and self._values == other._values)
+        elif isinstance(other, dict):
+            return self.to_dict() == other
+        return NotImplemented
+
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+
+    __hash__ = None
+
+
+    def __deepcopy__(self, memo):
+        return type(self)(deepcopy(self._values, memo))
+
+
+    def get(self, key, default=None):
+        if key in self._index:
+            return self[key]
+        return default
+
+
+    def keys(self):
+        return list(self._fields)
+
+
+    def values(self):
+        return list(self._values)
+
+
+    def items(self):
+        return zip(self._fields, self._values)
+
+
+    def to_dict(self):
+        """
+        Convert me (and any records I refer to) into dictionaries.
+        """
+        return dict([(k, _toDict(v)) for (k, v) in self.items()])
+
+
+
+def _toDict(value):
+    if isinstance(value, Record):
+        return value.to_dict()
+    elif isinstance(value, list) or (isinstance(value, LazyList)
+                                     and value.loaded):
+        return [_toDict(x) for x in value]
+    return value
+
+
+
+_record_classes = {}
+
+def _recordClass(table, fields):
+    """
+    Get the subclass of L{Record} for records of C{table} with C{fields}.
+    """
+    key = (table, fields)
+    cls = _record_classes.get(key)
+    if cls is None:
+        attrs = {
+            '__slots__': (),
+            '_fields': fields,
+            '_index': dict([(x, i) for (i, x) in enumerate(fields)]),
+        }
+        for i, field in enumerate(fields):
+            if _identifier.match(field) and not hasattr(Record, field):
+                attrs[field] = _fieldProperty(i, field)
+        cls = _record_classes[key] = type(
+            str('%sRecord' % (table.name.title().replace(' ', ''),)),
+            (Record,), attrs)
+    return cls
+
+
+
+def _fieldProperty(index, field):
+    return property(lambda self: self._values[index],
+                    doc='The %s field.' % (field,))
+
+
+
+class _RowDecoder(object):
+    """
+    I turn result rows from a L{Crud}'s base query into dictionaries (or
+    L{Record}s).
+
+    The work of figuring out which row indexes belong to which dictionary
+    is done once, up front, so that decoding a row doesn't need to branch
+    on every cell.
+    """
+
+    def __init__(self, table, select_columns, references=None,
+                 table_attr=None, tableName=None, records=False):
+        """
+        @param table: The base table of the rows.
+        @param select_columns: A list of C{(ref_name, column)} tuples as
+            found in L{Crud.select_columns}, starting with the primary key
+            columns of C{table} (which are skipped).
+        @param references: The references of the L{Readset} being decoded.
+            Multiple references are filled in from values passed to
+            L{decode}, in the order of my C{multi_names}.
+        @param table_attr: See L{Crud}.
+        @param tableName: A function which returns the name of a table to
+            be stored in C{table_attr}.
+        @param records: If C{True}, decode into L{Record}s instead of
+            dictionaries.
+        """
+        base = []
+        refs = {}
+        ref_order = []
+        pk_len = len(table.primary_key)
+        for i, (ref_name, col) in enumerate(select_columns):
+            if i < pk_len:
+                continue
             if ref_name is None:
-                # base object attribute
-                ret[col.name] = v
+                base.append((col.name, i))
             else:
-                if ref_name not in has_value:
-                    has_value[ref_name] = False
-                # referenced object attribute
-                if ref_name not in ret:
-                    ret[ref_name] = {}
-                    if self.table_attr:
-                        ret[ref_name][self.table_attr] = self._tableName(col.table)
-                ret[ref_name][col.name] = v
-                if v is not None:
-                    has_value[ref_name] = True
-
-        # set Nulls
-        for ref_name, ref_has_value in has_value.items():
-            if not ref_has_value:
-                ret[ref_name] = None
-
-        # get multi references
-        for (ref_name, ref) in self.readset.references.items():
+                if ref_name not in refs:
+                    refs[ref_name] = (col.table, [])
+                    ref_order.append(ref_name)
+                refs[ref_name][1].append((col.name, i))
+
+        self.constants = {}
+        if table_attr:
+            self.constants[table_attr] = tableName(table)
+        self.names = tuple([x[0] for x in base])
+        self.getter = _tupleGetter([x[1] for x in base])
+
+        self.refs = []
+        for ref_name in ref_order:
+            ref_table, columns = refs[ref_name]
+            constants = {}
+            if table_attr:
+                constants[table_attr] = tableName(ref_table)
+            names = tuple([x[0] for x in columns])
+            make = None
+            if records:
+                make = _recordClass(ref_table,
+                                    tuple(constants) + names)
+            self.refs.append((
+                ref_name,
+                names,
+                _tupleGetter([x[1] for x in columns]),
+                len(columns),
+                constants,
+                tuple(constants.values()),
+                make,
+            ))
+
+        self.multi_names = ()
+        self.children = {}
+        for ref_name, ref in (references or {}).items():
             if not ref.multiple:
                 continue
-            join = self.readset.table.join(
-                ref.readset.table, ref.join)
-            query = select(ref.readset.readable_columns).select_from(join)
-            where = [x == y for (x,y) in zip(pk_column, pk_value)]
-            query = query.where(*where)
-            result = yield engine.execute(query)
-            rows = yield result.fetchall()
-            
-            return_rows = []
-            for row in rows:
-                d = {}
-                for (k,v) in zip(ref.readset.readable_columns, row):
-                    d[k.name] = v
-                return_rows.append(d)
-            if ref_name not in ret:
-                ret[ref_name] = []
-            ret[ref_name] = return_rows
+            self.multi_names += (ref_name,)
+            names = tuple([x.name for x in ref.readset.readable_columns])
+            if records:
+                self.children[ref_name] = _recordClass(ref.readset.table,
+                                                       names)
+            else:
+                self.children[ref_name] = partial(_zipDict, names)
+
+        if records:
+            self.record_class = _recordClass(table, tuple(self.constants)
+                + self.names + tuple([x[0] for x in self.refs])
+                + self.multi_names)
+            self.prefix = tuple(self.constants.values())
+            self.decode = self._decodeRecord
+
+
+    def decode(self, row, multi_values=()):
+        """
+        Turn a single row into a dictionary.
+
+        @param multi_values: The values of my multiple references for this
+            row.
+        """
+        ret = self.constants.copy()
+        ret.update(izip(self.names, self.getter(row)))
+        for (ref_name, names, getter, size, constants, _, _) in self.refs:
+            values = getter(row)
+            if values.count(None) == size:
+                # every column null means there is no referenced row
+                ret[ref_name] = None
+            else:
+                d = constants.copy()
+                d.update(izip(names, values))
+                ret[ref_name] = d
+        if multi_values:
+            ret.update(izip(self.multi_names, multi_values))
+        return ret
+
+
+    def _decodeRecord(self, row, multi_values=()):
+        """
+        Turn a single row into a L{Record}.
+        """
+        values = list(self.prefix)
+        values.extend(self.getter(row))
+        for (ref_name, names, getter, size, _, prefix, make) in self.refs:
+            ref_values = getter(row)
+            if ref_values.count(None) == size:
+                values.append(None)
+            else:
+                values.append(make(list(prefix + ref_values)))
+        values.extend(multi_values)
+        return self.record_class(values)
+
+
+
+def _zipDict(names, values):
+    return dict(izip(names, values))
+
+
+
+def _tupleGetter(indexes):
+    """
+    Like C{operator.itemgetter} but always returns a tuple, even for zero
+    or one indexes.
+    """
+    if len(indexes) == 1:
+        i = indexes[0]
+        return lambda row: (row[i],)
+    elif not indexes:
+        return lambda row: ()
+    return itemgetter(*indexes)
+
+
+
+def _arrayTypecode(column):
+    """
+    Get the C{array.array} typecode to hold the values of C{column}, or
+    C{None} if its values might not be numbers.
+    """
+    if column.nullable:
+        return None
+    if isinstance(column.type, types.Integer):
+        return 'l'
+    elif isinstance(column.type, types.Float) and not column.type.asdecimal:
+        return 'd'
+    return None
+
+
+
+def _fetchmany(result, size):
+    """
+    Fetch up to C{size} rows from C{result}.
+
+    alchimia's result proxy doesn't expose C{fetchmany}, so in that case
+    call the wrapped result proxy in alchimia's thread pool.
+    """
+    if hasattr(result, 'fetchmany'):
+        return result.fetchmany(size)
+    return result._engine._defer_to_thread(
+        result._result_proxy.fetchmany, size)
+
+
+
+def _closeResult(result):
+    """
+    Release the cursor of a partially read C{result}.
+    """
+    if hasattr(result, 'close'):
+        return result.close()
+    return result._engine._defer_to_thread(result._result_proxy.close)
+
+
+
+def _keysetAfter(keys, values):
+    """
+    Make a where clause matching rows that sort after C{values}.
+
+    @param keys: A list of C{(column, descending)} tuples.
+    @param values: The values of the columns in C{keys} for the last row.
+    """
+    clauses = []
+    for i, (col, desc) in enumerate(keys):
+        if desc:
+            comp = col < values[i]
+        else:
+            comp = col > values[i]
+        equal = [x[0] == y for (x, y) in zip(keys[:i], values[:i])]
+        clauses.append(and_(*(equal + [comp])))
+    where = or_(*clauses)
+    if len(keys) > 1:
+        # an index can't seek on the OR alone, so also give it a range of
+        # the first column to start from
+        col, desc = keys[0]
+        if desc:
+            where = and_(col <= values[0], where)
+        else:
+            where = and_(col >= values[0], where)
+    return where
+
+
+
+def _supportsWindowFunctions(dialect):
+    """
+    Return C{True} if C{dialect} can run window functions such as
+    C{COUNT(*) OVER ()}.
+    """
+    if dialect.name == 'sqlite':
+        version = getattr(dialect.dbapi, 'sqlite_version_info', (0,))
+        return version >= (3, 25)
+    return dialect.name in ('postgresql', 'oracle', 'mssql')
+
+
+
+def _pkIn(pk_column, pks):
+    """
+    Make a where clause matching any of the given primary key tuples.
+    """
+    if len(pk_column) == 1:
+        return pk_column[0].in_([x[0] for x in pks])
+    return or_(*[and_(*[x == y for (x,y) in zip(pk_column, pk)])
+                 for pk in pks])
+
+
+def _pageLength(result):
+    """
+    Count the records in a C{(records, extra)} tuple from a L{Paginator}.
+    """
+    return len(result[0])
 
-        defer.returnValue(ret)
 
 
 class Paginator(object):
@@ -580,10 +2091,17 @@ class Paginator(object):
     I provide pagination for a L{Crud}.
     """
 
-    def __init__(self, crud, page_size=10, order=None):
+    def __init__(self, crud, page_size=10, order=None, instrument=None):
+        """
+        @param instrument: A function to call with an L{OperationEvent}
+            after each of my operations.  Defaults to C{crud}'s.
+        """
         self.crud = crud
         self.page_size = page_size
         self.order = order
+        if instrument is None:
+            instrument = crud.instrument
+        self.instrument = instrument
 
 
     def __repr__(self):
@@ -591,35 +2109,148 @@ class Paginator(object):
             self.crud, self.page_size, self.order)
 
 
-    def page(self, engine, number, where=None):
+    @instrumented('page', rows=recordCount)
+    def page(self, engine, number, where=None, fields=None):
         """
         Return a page of results.
 
         @param number: Page number.
         @param where: filter results by this where.
+        @param fields: If given, only read these fields.  See L{Crud.fetch}.
         """
         limit = self.page_size
         offset = number * limit
         return self.crud.fetch(engine, where=where, limit=limit, offset=offset,
-                               order=self.order)
+                               order=self.order, fields=fields)
+
+
+    @instrumented('pageAfter', rows=_pageLength)
+    @driven
+    def pageAfter(self, engine, cursor=None, where=None):
+        """
+        Return the page of results following C{cursor}.
 
+        Unlike L{page}, this doesn't use C{OFFSET}: the next page is found
+        by comparing my C{order} columns (and the primary key, to break
+        ties) against the last record of the previous page, so deep pages
+        are as cheap as the first one on indexed columns.  The order
+        columns should not be nullable.
 
-    @defer.inlineCallbacks
+        @param cursor: C{None} for the first page, or the cursor returned
+            along with the previous page.
+        @param where: filter results by this where.
+
+        @return: A tuple of C{(records, next_cursor)}.  C{next_cursor} is
+            an opaque value to pass to the next call, or C{None} if this is
+            the last page.
+        """
+        keys = self._keysetColumns()
+        query = self.crud._fetchQuery(where,
+            [col.desc() if desc else col for (col, desc) in keys],
+            limit=self.page_size + 1)
+        for i, (col, desc) in enumerate(keys):
+            query = query.column(col.label('key-%d' % (i,)))
+        if cursor is not None:
+            query = query.where(_keysetAfter(keys, cursor))
+
+        result = yield self.crud._execute(engine, query)
+        rows = yield result.fetchall()
+
+        next_cursor = None
+        if len(rows) > self.page_size:
+            rows = rows[:self.page_size]
+            next_cursor = tuple(rows[-1][-len(keys):])
+        records = yield self.crud._rowsToDicts(engine, rows)
+        defer.returnValue((records, next_cursor))
+
+
+    def _keysetColumns(self):
+        """
+        Get the list of C{(column, descending)} tuples that determine
+        the order of keyset pages.
+        """
+        order = self.order
+        if order is None:
+            order = []
+        elif not isinstance(order, (list, tuple)):
+            order = [order]
+
+        keys = []
+        for clause in order:
+            modifier = getattr(clause, 'modifier', None)
+            if modifier is operators.desc_op:
+                keys.append((clause.element, True))
+            elif modifier is operators.asc_op:
+                keys.append((clause.element, False))
+            else:
+                keys.append((clause, False))
+
+        for col in self.crud.readset.table.primary_key:
+            if not [x for (x, desc) in keys if x is col]:
+                keys.append((col, False))
+        return keys
+
+
+    @instrumented('pageCount')
+    @driven
     def pageCount(self, engine, where=None):
         """
         Return the total number of pages in the set.
         """
         count = yield self.crud.count(engine, where=where)
-        if count == 0:
-            defer.returnValue(0)
+        defer.returnValue(self._pagesFor(count))
 
-        pages = ((count - 1) / self.page_size) + 1
-        defer.returnValue(pages)
+
+    @instrumented('pageWithCount', rows=_pageLength)
+    @driven
+    def pageWithCount(self, engine, number, where=None):
+        """
+        Return a page of results along with the total number of pages.
+
+        Where the database supports window functions this takes a single
+        query (using C{COUNT(*) OVER ()}); elsewhere it's the same as
+        calling L{page} and L{pageCount}.
+
+        @param number: Page number.
+        @param where: filter results by this where.
+
+        @return: A tuple of C{(records, page_count)}.
+        """
+        if not _supportsWindowFunctions(engine.dialect):
+            records = yield self.page(engine, number, where)
+            pages = yield self.pageCount(engine, where)
+            defer.returnValue((records, pages))
+
+        limit = self.page_size
+        query = self.crud._fetchQuery(where, self.order, limit=limit,
+                                      offset=number * limit)
+        query = query.column(func.count().over().label('total-count'))
+        result = yield self.crud._execute(engine, query)
+        rows = yield result.fetchall()
+        if rows:
+            count = rows[0]['total-count']
+        elif number == 0:
+            count = 0
+        else:
+            # past the last page, so there was no row to carry the count
+            count = yield self.crud.count(engine, where=where)
+        records = yield self.crud._rowsToDicts(engine, rows)
+        defer.returnValue((records, self._pagesFor(count)))
+
+
+    def _pagesFor(self, count):
+        """
+        Get the number of pages needed for C{count} records.
+        """
+        if count == 0:
+            return 0
+        return ((count - 1) / self.page_size) + 1
 
 
 
 
-def crudFromSpec(cls, table_attr=None, table_map=None):
+def crudFromSpec(cls, table_attr=None, table_map=None, cache=None,
+                 records=False, instrument=None, single_flight=False):
     """
     Create a Crud from a specification class.  See README.md for an example.
 
@@ -645,7 +2276,11 @@ def crudFromSpec(cls, table_attr=None, table_map=None):
         Readset(table, readable, references),
         sanitizers,
         table_attr=table_attr,
-        table_map=table_map)
+        table_map=table_map,
+        cache=cache,
+        records=records,
+        instrument=instrument,
+        single_flight=single_flight)
 
 
 
@@ -0,0 +1,568 @@
+"""
+Running crudset's operations on different kinds of engine.
+
+L{Crud}, L{Paginator} and the sanitizers build their queries and decode
+their rows the same way whatever the engine.  Their operations are written
+as generators which yield whatever the engine returns (or plain values),
+and a driver chosen from the engine runs the generator:
+
+  - alchimia's Twisted engines (and anything else by default) get
+    Deferreds, from L{TwistedDriver}.
+  - An L{AsyncioEngine} gets asyncio Futures, from L{AsyncioDriver}.
+  - Plain SQLAlchemy engines and connections get plain values, from
+    L{SyncDriver}.
+
+Other kinds of engine can have a C{crudsetDriver()} method returning the
+driver to use.
+
+L{transaction} runs several operations on one connection, committing once.
+"""
+
+import sys
+from functools import partial, wraps
+
+from twisted.internet import defer
+from twisted.python import failure
+
+from sqlalchemy.engine import Engine, Connection
+
+from crudset.cache import invalidateTable
+from crudset.error import WouldBlock
+
+try:
+    import asyncio
+except ImportError:
+    try:
+        import trollius as asyncio
+    except ImportError:
+        asyncio = None
+
+
+
+def driverFor(engine):
+    """
+    Get the driver for running operations on C{engine}.
+    """
+    # looked up on the type so that mock engines don't grow one
+    getter = getattr(type(engine), 'crudsetDriver', None)
+    if getter is not None:
+        return getter(engine)
+    elif isinstance(engine, (Engine, Connection)):
+        return sync_driver
+    return twisted_driver
+
+
+
+def driven(method):
+    """
+    Decorate a generator method taking an engine as its first argument so
+    that it's run by the engine's driver.
+
+    Like with C{inlineCallbacks}, finish with C{defer.returnValue(value)}.
+    """
+    @wraps(method)
+    def wrapper(self, engine, *args, **kwargs):
+        return driverFor(engine).run(method(self, engine, *args, **kwargs))
+    return wrapper
+
+
+
+def isAwaitable(value):
+    """
+    Return C{True} if C{value} is an asyncio Future or coroutine.
+    """
+    if asyncio is None or isinstance(value, _plain_types):
+        return False
+    return isinstance(value, asyncio.Future) or asyncio.iscoroutine(value)
+
+
+# common results which are quick to rule out
+_plain_types = (dict, list, tuple, defer.Deferred, type(None))
+
+
+
+def asDeferred(value, loop):
+    """
+    Get a Deferred which fires with the result of the asyncio Future or
+    coroutine C{value}.
+
+    @param loop: The event loop to run a coroutine on.
+
+    @raise TypeError: If C{loop} is C{None} (as it is for Twisted and
+        blocking engines), since nothing would ever run C{value}.
+    """
+    if loop is None:
+        raise TypeError('%r needs an AsyncioEngine to run on' % (value,))
+    future = asyncio.ensure_future(value, loop=loop)
+    d = defer.Deferred()
+    def done(future):
+        if future.exception() is not None:
+            d.errback(future.exception())
+        else:
+            d.callback(future.result())
+    future.add_done_callback(done)
+    return d
+
+
+
+def _returned(exc):
+    return getattr(exc, 'value', None)
+
+
+
+class TwistedDriver(object):
+    """
+    I run operations with C{inlineCallbacks}, returning Deferreds.
+    """
+
+    loop = None
+
+    def run(self, gen):
+        """
+        Run the generator C{gen}.
+
+        @return: A Deferred which fires with its result.
+        """
+        return defer.inlineCallbacks(lambda: gen)()
+
+
+    def call(self, func, *args, **kwargs):
+        """
+        Call C{func}.
+
+        @return: A Deferred which fires with its result, whether it returns
+            a value or a Deferred.  If it returns an asyncio Future or
+            coroutine, the Deferred fails with C{TypeError}: there's no
+            event loop to run it on.
+        """
+        try:
+            result = func(*args, **kwargs)
+        except:
+            return defer.fail()
+        if isinstance(result, defer.Deferred):
+            return result
+        elif isAwaitable(result):
+            return defer.maybeDeferred(asDeferred, result, self.loop)
+        return defer.succeed(result)
+
+
+twisted_driver = TwistedDriver()
+
+
+
+class SyncDriver(object):
+    """
+    I run operations straight through on a blocking engine, returning plain
+    values.
+
+    Operations may yield Deferreds which have already fired (such as those
+    returned by Twisted-style sanitizers that don't really wait), but not
+    ones which haven't, nor asyncio Futures or coroutines: those raise
+    L{WouldBlock}.
+    """
+
+    loop = None
+
+    def run(self, gen):
+        """
+        Run the generator C{gen}.
+
+        @return: Its result.
+        """
+        value = None
+        err = None
+        while True:
+            try:
+                if err is None:
+                    yielded = gen.send(value)
+                else:
+                    yielded = err.throwExceptionIntoGenerator(gen)
+            except StopIteration:
+                return None
+            except defer._DefGen_Return as e:
+                return _returned(e)
+            value, err = self._outcome(yielded)
+
+
+    def call(self, func, *args, **kwargs):
+        """
+        Call C{func}.
+
+        @return: Its result, which may not be an unfired Deferred.
+        """
+        value, err = self._outcome(func(*args, **kwargs))
+        if err is not None:
+            err.raiseException()
+        return value
+
+
+    def _outcome(self, value):
+        """
+        Get C{(result, None)} or C{(None, failure)} from a (fired) Deferred,
+        or C{(value, None)} from anything else.
+        """
+        if isinstance(value, defer.Deferred):
+            outcome = []
+            value.addBoth(outcome.append)
+            if not outcome:
+                raise WouldBlock('%r has not fired' % (value,))
+            result = outcome[0]
+            if isinstance(result, failure.Failure):
+                return None, result
+            return result, None
+        elif isAwaitable(value):
+            raise WouldBlock('%r needs an event loop' % (value,))
+        return value, None
+
+
+sync_driver = SyncDriver()
+
+
+
+def transaction(engine, func, *args, **kwargs):
+    """
+    Call C{func(txn, *args, **kwargs)} in a database transaction.
+
+    C{txn} is a L{Transaction}, which can be given to L{Crud}s and
+    L{Paginator}s in place of C{engine}: all their statements share one
+    connection and are committed together once C{func} (or the Deferred,
+    Future or coroutine it returns) succeeds.  If it fails, they're rolled
+    back.
+
+        def addFamily(txn, surname, names):
+            family = yield families.create(txn, {'surname': surname})
+            for name in names:
+                yield people.create(txn, {'name': name,
+                                          'family_id': family['id']})
+            defer.returnValue(family)
+
+        d = transaction(engine, defer.inlineCallbacks(addFamily),
+                        'Jones', ['Sam', 'Sue'])
+
+    If C{engine} is already a L{Transaction}, C{func} joins it.
+
+    @return: Whatever C{func}'s result resolves to, in the form C{engine}'s
+        driver returns (such as a Deferred).
+    """
+    driver = driverFor(engine)
+    if isinstance(engine, Transaction):
+        return driver.call(func, engine, *args, **kwargs)
+    return driver.run(_transaction(engine, func, args, kwargs))
+
+
+
+def _transaction(engine, func, args, kwargs):
+    connection = yield engine.connect()
+    try:
+        trans = yield connection.begin()
+        txn = Transaction(engine, connection)
+        try:
+            result = yield func(txn, *args, **kwargs)
+        except Exception:
+            err = failure.Failure()
+            yield trans.rollback()
+            err.raiseException()
+        yield trans.commit()
+        # reads on other connections may have cached what was there before
+        # the commit since the writes invalidated them
+        for table in txn.written:
+            invalidateTable(table)
+    finally:
+        yield connection.close()
+    defer.returnValue(result)
+
+
+
+class Transaction(object):
+    """
+    An engine whose statements are executed in one connection's
+    transaction.  See L{transaction}.
+
+    @ivar engine: The engine the connection came from.
+    @ivar connection: The connection.
+    @ivar written: The set of tables written to, whose cached reads are
+        invalidated again once the transaction is committed.
+    """
+
+    def __init__(self, engine, connection):
+        self.engine = engine
+        self.connection = connection
+        self.written = set()
+
+
+    def __repr__(self):
+        return 'Transaction(%r)' % (self.engine,)
+
+
+    def crudsetDriver(self):
+        return driverFor(self.engine)
+
+
+    @property
+    def dialect(self):
+        return self.engine.dialect
+
+
+    def execute(self, *args, **kwargs):
+        return self.connection.execute(*args, **kwargs)
+
+
+
+class AsyncioDriver(object):
+    """
+    I run operations on an asyncio event loop, returning Futures.
+
+    Operations may yield asyncio Futures and coroutines, or Deferreds (such
+    as those returned by Twisted-style sanitizers).
+    """
+
+    def __init__(self, loop):
+        self.loop = loop
+
+
+    def run(self, gen):
+        """
+        Run the generator C{gen}.
+
+        @return: A Future which resolves to its result.
+        """
+        future = asyncio.Future(loop=self.loop)
+        self._step(gen, future, None, None)
+        return future
+
+
+    def call(self, func, *args, **kwargs):
+        """
+        Call C{func}.
+
+        @return: A Future which resolves to its result, whether it returns
+            a value, a Deferred or an asyncio Future or coroutine.
+        """
+        return self.run(self._call(func, args, kwargs))
+
+
+    def _call(self, func, args, kwargs):
+        result = yield func(*args, **kwargs)
+        defer.returnValue(result)
+
+
+    def _step(self, gen, future, value, exc):
+        while True:
+            try:
+                if exc is None:
+                    yielded = gen.send(value)
+                else:
+                    yielded = gen.throw(type(exc), exc)
+            except StopIteration:
+                future.set_result(None)
+                return
+            except defer._DefGen_Return as e:
+                future.set_result(_returned(e))
+                return
+            except Exception:
+                future.set_exception(sys.exc_info()[1])
+                return
+
+            value, exc = yielded, None
+            waiting = self._asFuture(yielded)
+            if waiting is None:
+                continue
+            elif not waiting.done():
+                waiting.add_done_callback(
+                    partial(self._wake, gen, future))
+                return
+            value, exc = self._outcome(waiting)
+
+
+    def _wake(self, gen, future, waiting):
+        value, exc = self._outcome(waiting)
+        self._step(gen, future, value, exc)
+
+
+    def _outcome(self, waiting):
+        exc = waiting.exception()
+        if exc is not None:
+            return None, exc
+        return waiting.result(), None
+
+
+    def _asFuture(self, value):
+        """
+        Get a Future for C{value} if it's something to wait for.
+        """
+        if isinstance(value, defer.Deferred):
+            future = asyncio.Future(loop=self.loop)
+            def failed(err):
+                future.set_exception(err.value)
+            value.addCallbacks(future.set_result, failed)
+            return future
+        elif isAwaitable(value):
+            return asyncio.ensure_future(value, loop=self.loop)
+        return None
+
+
+
+class AsyncioEngine(object):
+    """
+    I run a SQLAlchemy engine's statements for an asyncio event loop, so
+    that L{Crud}s, L{Paginator}s and sanitizers given me return Futures.
+
+    DB-API drivers block, so statements run on C{executor}.  The default is
+    a single thread, which suits SQLite (whose connections should be made
+    with C{check_same_thread=False}).
+    """
+
+    def __init__(self, engine, loop=None, executor=None):
+        """
+        @param engine: A plain SQLAlchemy engine.
+        @param loop: The event loop.  Defaults to the current one.
+        @param executor: A C{concurrent.futures} executor to run statements
+            on.
+        """
+        if asyncio is None:
+            raise ImportError('asyncio (or trollius) is required')
+        if loop is None:
+            loop = asyncio.get_event_loop()
+        if executor is None:
+            from concurrent.futures import ThreadPoolExecutor
+            executor = ThreadPoolExecutor(1)
+        self.engine = engine
+        self.loop = loop
+        self.executor = executor
+        self._driver = AsyncioDriver(loop)
+
+
+    def __repr__(self):
+        return 'AsyncioEngine(%r)' % (self.engine,)
+
+
+    def crudsetDriver(self):
+        return self._driver
+
+
+    @property
+    def dialect(self):
+        return self.engine.dialect
+
+
+    def execute(self, *args, **kwargs):
+        """
+        Execute a statement.
+
+        @return: A Future which resolves to an L{AsyncioResult}.
+        """
+        return self._run(lambda: AsyncioResult(
+            self, self.engine.execute(*args, **kwargs)))
+
+
+    def connect(self):
+        """
+        Check out a connection.
+
+        @return: A Future which resolves to an L{AsyncioConnection}.
+        """
+        return self._run(lambda: AsyncioConnection(self, self.engine.connect()))
+
+
+    def _run(self, func, *args):
+        return self.loop.run_in_executor(self.executor, partial(func, *args))
+
+
+
+class AsyncioConnection(object):
+    """
+    A connection from L{AsyncioEngine.connect}.  Methods which might block
+    return Futures.
+    """
+
+    def __init__(self, engine, connection):
+        self._engine = engine
+        self._connection = connection
+
+
+    def execute(self, *args, **kwargs):
+        return self._engine._run(lambda: AsyncioResult(
+            self._engine, self._connection.execute(*args, **kwargs)))
+
+
+    def begin(self):
+        return self._engine._run(lambda: AsyncioTransaction(
+            self._engine, self._connection.begin()))
+
+
+    def close(self):
+        return self._engine._run(self._connection.close)
+
+
+
+class AsyncioTransaction(object):
+    """
+    A transaction from L{AsyncioConnection.begin}.
+    """
+
+    def __init__(self, engine, transaction):
+        self._engine = engine
+        self._transaction = transaction
+
+
+    def commit(self):
+        return self._engine._run(self._transaction.commit)
+
+
+    def rollback(self):
+        return self._engine._run(self._transaction.rollback)
+
+
+
+class AsyncioResult(object):
+    """
+    The result of L{AsyncioEngine.execute}.  Methods which might block
+    return Futures.
+    """
+
+    def __init__(self, engine, result):
+        self._engine = engine
+        self._result = result
+
+
+    @property
+    def inserted_primary_key(self):
+        return self._result.inserted_primary_key
+
+
+    @property
+    def rowcount(self):
+        return self._result.rowcount
+
+
+    @property
+    def returns_rows(self):
+        return self._result.returns_rows
+
+
+    def keys(self):
+        return self._result.keys()
+
+
+    def fetchone(self):
+        return self._engine._run(self._result.fetchone)
+
+
+    def fetchall(self):
+        return self._engine._run(self._result.fetchall)
+
+
+    def fetchmany(self, size):
+        return self._engine._run(self._result.fetchmany, size)
+
+
+    def first(self):
+        return self._engine._run(self._result.first)
+
+
+    def scalar(self):
+        return self._engine._run(self._result.scalar)
+
+
+    def close(self):
+        return self._engine._run(self._result.close)
@@ -4,4 +4,7 @@ class Error(Exception): pass
 
 class MissingRequiredFields(Error): pass
 class NotEditable(Error): pass
-class TooMany(Error): pass
\ No newline at end of file
+class NotReadable(Error): pass
+class NotLoaded(Error): pass
+class TooMany(Error): pass
+class WouldBlock(Error): pass
@@ -0,0 +1,302 @@
+import time
+from bisect import bisect_left
+from functools import wraps
+
+from twisted.internet import defer
+from twisted.python import failure
+
+from crudset.engine import driverFor
+
+
+
+# the clock used to time operations; replaced in tests.
+_now = time.time
+
+
+
+class OperationEvent(object):
+    """
+    What happened during one L{Crud} (or L{Paginator}) operation.
+
+    @ivar source: The L{Crud} or L{Paginator} the operation was called on
+        (or, for a L{Crud} made by L{Crud.fix}, the one it was made from).
+    @ivar operation: The name of the method called, such as C{'fetch'}.
+    @ivar seconds: The wall time taken by the whole operation.
+    @ivar statements: The number of SQL statements executed, including
+        those needed for references and by sanitizers.
+    @ivar rows: The number of records returned, or C{None} if the
+        operation doesn't return records (like L{Crud.count}).
+    @ivar sanitize_seconds: The part of C{seconds} spent sanitizing.
+    @ivar failure: The L{Failure} the operation failed with, or C{None}.
+    """
+
+    def __init__(self, source, operation):
+        self.source = source
+        self.operation = operation
+        self.seconds = 0.0
+        self.statements = 0
+        self.rows = None
+        self.sanitize_seconds = 0.0
+        self.failure = None
+
+
+    def __repr__(self):
+        return ('<OperationEvent %s %r seconds=%r statements=%r rows=%r'
+                ' sanitize_seconds=%r failed=%r>' % (
+                    self.operation, self.source, self.seconds,
+                    self.statements, self.rows, self.sanitize_seconds,
+                    self.failure is not None))
+
+
+
+class InstrumentedEngine(object):
+    """
+    I wrap an engine for the length of one operation, counting the
+    statements executed on it.
+
+    Everything but C{execute} is passed through to the wrapped engine.
+    """
+
+    def __init__(self, engine, event):
+        self.wrapped = engine
+        self.event = event
+
+
+    def __repr__(self):
+        return 'InstrumentedEngine(%r)' % (self.wrapped,)
+
+
+    def crudsetDriver(self):
+        return driverFor(self.wrapped)
+
+
+    def __getattr__(self, name):
+        return getattr(self.wrapped, name)
+
+
+    def execute(self, *args, **kwargs):
+        self.event.statements += 1
+        return self.wrapped.execute(*args, **kwargs)
+
+
+
+def unwrap(engine):
+    """
+    Get the engine an L{InstrumentedEngine} wraps (or C{engine} itself if
+    it isn't one).
+    """
+    if isinstance(engine, InstrumentedEngine):
+        return engine.wrapped
+    return engine
+
+
+
+def instrumented(operation, rows=None):
+    """
+    Decorate a method taking an engine as its first argument so that it
+    reports an L{OperationEvent} to its object's C{instrument}.
+
+    Operations started by another instrumented operation (and so given an
+    L{InstrumentedEngine}) are counted as part of the outer one rather than
+    reported on their own.
+
+    @param operation: The name of the operation.
+    @param rows: A function which returns the number of records in the
+        method's result, or C{None} if it doesn't return records.
+    """
+    def deco(method):
+        @wraps(method)
+        def wrapper(self, engine, *args, **kwargs):
+            instrument = self.instrument
+            if instrument is None or isinstance(engine, InstrumentedEngine):
+                return method(self, engine, *args, **kwargs)
+            # fix()ed and projected Cruds report as the Crud they came from
+            source = getattr(self, '_origin', self)
+            event = OperationEvent(source, operation)
+            wrapped = InstrumentedEngine(engine, event)
+            return driverFor(engine).run(_measure(event, instrument, rows,
+                method, self, wrapped, *args, **kwargs))
+        return wrapper
+    return deco
+
+
+
+def _measure(event, instrument, rows, method, *args, **kwargs):
+    """
+    Run C{method} (with a driver), filling in and reporting C{event}.
+    """
+    start = _now()
+    try:
+        result = yield method(*args, **kwargs)
+    except Exception:
+        event.failure = failure.Failure()
+        event.seconds = _now() - start
+        instrument(event)
+        event.failure.raiseException()
+    event.seconds = _now() - start
+    if rows is not None:
+        event.rows = rows(result)
+    instrument(event)
+    defer.returnValue(result)
+
+
+
+def timeSanitizer(sanitize, context, data):
+    """
+    Call C{sanitize(context, data)}, adding the time it takes to the
+    operation C{context.engine} belongs to (if any).
+    """
+    engine = context.engine
+    if not isinstance(engine, InstrumentedEngine):
+        return sanitize(context, data)
+    return driverFor(engine).run(_measureSanitizer(engine.event, sanitize,
+                                                   context, data))
+
+
+
+def _measureSanitizer(event, sanitize, context, data):
+    start = _now()
+    try:
+        result = yield sanitize(context, data)
+    finally:
+        event.sanitize_seconds += _now() - start
+    defer.returnValue(result)
+
+
+
+def recordCount(result):
+    """
+    Count the records in the result of an operation.
+    """
+    if result is None:
+        return 0
+    elif isinstance(result, list):
+        return len(result)
+    return 1
+
+
+
+class Histogram(object):
+    """
+    Latency statistics for one operation.
+
+    @ivar bounds: The upper bounds, in seconds, of each bucket but the last
+        (which holds everything slower).
+    @ivar buckets: The number of operations in each bucket.
+    @ivar count: The number of operations.
+    @ivar failures: How many of them failed.
+    @ivar seconds: Their total wall time.
+    @ivar sanitize_seconds: Their total time spent sanitizing.
+    @ivar statements: Their total number of SQL statements.
+    @ivar rows: Their total number of records returned.
+    @ivar max_seconds: The slowest of them.
+    """
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.buckets = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.failures = 0
+        self.seconds = 0.0
+        self.sanitize_seconds = 0.0
+        self.statements = 0
+        self.rows = 0
+        self.max_seconds = 0.0
+
+
+    def __repr__(self):
+        return '<Histogram count=%d mean=%r p50=%r p99=%r>' % (
+            self.count, self.mean(), self.percentile(50),
+            self.percentile(99))
+
+
+    def add(self, event):
+        """
+        Count an L{OperationEvent}.
+        """
+        self.buckets[bisect_left(self.bounds, event.seconds)] += 1
+        self.count += 1
+        if event.failure is not None:
+            self.failures += 1
+        self.seconds += event.seconds
+        self.sanitize_seconds += event.sanitize_seconds
+        self.statements += event.statements
+        self.rows += event.rows or 0
+        self.max_seconds = max(self.max_seconds, event.seconds)
+
+
+    def mean(self):
+        """
+        Get the mean wall time, or C{None} if nothing has been counted.
+        """
+        if not self.count:
+            return None
+        return self.seconds / self.count
+
+
+    def percentile(self, percent):
+        """
+        Get (the upper bound of the bucket holding) the C{percent}th
+        percentile of wall time, or C{None} if nothing has been counted.
+        The slowest bucket is bounded by the slowest operation.
+        """
+        if not self.count:
+            return None
+        wanted = self.count * percent / 100.0
+        seen = 0
+        for bound, count in zip(self.bounds, self.buckets):
+            seen += count
+            if seen >= wanted:
+                return min(bound, self.max_seconds)
+        return self.max_seconds
+
+
+
+class Histograms(object):
+    """
+    An instrument which keeps a L{Histogram} for each combination of
+    source (L{Crud} or L{Paginator}) and operation.
+
+        stats = Histograms()
+        crud = Crud(readset, sanitizer, instrument=stats)
+        ...
+        stats.get(crud, 'fetch').percentile(99)
+
+    @ivar histograms: A dict mapping C{(source, operation)} to
+        L{Histogram}s.
+    """
+
+    bounds = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+              0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, bounds=None):
+        """
+        @param bounds: The upper bounds, in seconds, of the histogram
+            buckets.
+        """
+        if bounds is not None:
+            self.bounds = tuple(bounds)
+        self.histograms = {}
+
+
+    def __call__(self, event):
+        key = (event.source, event.operation)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram(self.bounds)
+        histogram.add(event)
+
+
+    def get(self, source, operation):
+        """
+        Get the L{Histogram} for C{operation} on C{source}, or C{None} if
+        there hasn't been one.
+        """
+        return self.histograms.get((source, operation))
+
+
+    def clear(self):
+        """
+        Forget everything.
+        """
+        self.histograms.clear()
@@ -0,0 +1,155 @@
+"""
+Routing reads to replicas and writes to a primary.
+"""
+
+from functools import wraps
+from itertools import cycle
+
+from twisted.internet import defer
+
+from sqlalchemy.sql.expression import SelectBase
+from sqlalchemy.engine.interfaces import Compiled
+
+from crudset.engine import driverFor, isAwaitable
+from crudset.instrument import InstrumentedEngine, unwrap
+
+
+
+class Router(object):
+    """
+    An engine which sends C{SELECT}s to a pool of replicas and everything
+    else to a primary.
+
+        router = Router(primary, [replica1, replica2])
+        crud.fetch(router)              # on a replica
+        crud.create(router, {...})      # on the primary
+
+    L{Crud} operations which write (C{create}, C{createMany}, C{update},
+    C{updateMany} and C{delete}) run entirely on the primary, so they read
+    back what they wrote.  So do L{transaction}s.  Each statement of a read
+    operation is routed separately, so one which needs several statements
+    (for multiple references, say) may use more than one replica.
+
+    The engines may be of any kind, but should all be of the same kind.
+
+    @ivar primary: The engine to write to.
+    @ivar replicas: The engines to read from.
+    @ivar policy: How a replica is chosen for each statement:
+        C{'round-robin'}, or C{'least-outstanding'} for the one with the
+        fewest statements still executing.
+    @ivar outstanding: A list of the number of statements executing on each
+        replica.
+    """
+
+    policies = ('round-robin', 'least-outstanding')
+
+    def __init__(self, primary, replicas, policy='round-robin'):
+        """
+        @param primary: The engine to write to.
+        @param replicas: A list of engines to read from.  If it's empty,
+            reads go to the primary, too.
+        @param policy: One of L{policies}.
+        """
+        if policy not in self.policies:
+            raise ValueError('Unknown policy %r; expected one of %r' % (
+                             policy, self.policies))
+        self.primary = primary
+        self.replicas = list(replicas)
+        self.policy = policy
+        self.outstanding = [0] * len(self.replicas)
+        self._next = cycle(range(len(self.replicas)))
+
+
+    def __repr__(self):
+        return 'Router(%r, %r, policy=%r)' % (self.primary, self.replicas,
+                                              self.policy)
+
+
+    def crudsetDriver(self):
+        return driverFor(self.primary)
+
+
+    @property
+    def dialect(self):
+        return self.primary.dialect
+
+
+    def connect(self):
+        return self.primary.connect()
+
+
+    def execute(self, statement, *multiparams, **params):
+        if isinstance(statement, Compiled):
+            query = statement.statement
+        else:
+            query = statement
+        if not self.replicas or not isinstance(query, SelectBase):
+            return self.primary.execute(statement, *multiparams, **params)
+
+        index = self._choose()
+        self.outstanding[index] += 1
+        try:
+            result = self.replicas[index].execute(statement, *multiparams,
+                                                  **params)
+        except:
+            self.outstanding[index] -= 1
+            raise
+        _whenDone(result, self._release, index)
+        return result
+
+
+    def _choose(self):
+        """
+        Get the index of the replica to read from next.
+        """
+        if self.policy == 'round-robin':
+            return next(self._next)
+        return self.outstanding.index(min(self.outstanding))
+
+
+    def _release(self, index):
+        self.outstanding[index] -= 1
+
+
+
+def _whenDone(result, func, *args):
+    """
+    Call C{func(*args)} once C{result} (a Deferred, asyncio Future or plain
+    value) is done.
+    """
+    if isinstance(result, defer.Deferred):
+        def done(value):
+            func(*args)
+            return value
+        result.addBoth(done)
+    elif isAwaitable(result):
+        result.add_done_callback(lambda future: func(*args))
+    else:
+        func(*args)
+
+
+
+def primaryOf(engine):
+    """
+    Get the engine to write (and read back what was written) with: the
+    primary, if C{engine} is a L{Router}, or C{engine} itself if not.
+    An L{InstrumentedEngine} stays instrumented.
+    """
+    router = unwrap(engine)
+    if not isinstance(router, Router):
+        return engine
+    elif router is engine:
+        return router.primary
+    return InstrumentedEngine(router.primary, engine.event)
+
+
+
+def onPrimary(method):
+    """
+    Decorate a method taking an engine as its first argument so that,
+    given a L{Router}, it runs on the primary.
+    """
+    @wraps(method)
+    def wrapper(self, engine, *args, **kwargs):
+        return method(self, primaryOf(engine), *args, **kwargs)
+    return wrapper
@@ -0,0 +1,303 @@
+from datetime import date
+
+from twisted.trial.unittest import TestCase
+from twisted.internet.task import Clock
+
+from sqlalchemy import MetaData, Table, Column, Integer, String
+from sqlalchemy import create_engine, select, union, func, Date
+from sqlalchemy.sql.expression import Label
+from sqlalchemy.dialects import postgresql
+
+from crudset.cache import QueryCache, StatementCache, invalidateTable
+
+
+metadata = MetaData()
+families = Table('family', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('surname', String),
+)
+
+people = Table('people', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('name', String),
+)
+
+
+
+class QueryCacheTest(TestCase):
+
+
+    def test_key(self):
+        """
+        Keys depend on the engine, the SQL and the parameters.
+        """
+        cache = QueryCache()
+        engine1 = create_engine('sqlite://')
+        engine2 = create_engine('sqlite://')
+        q1 = families.select().where(families.c.surname == 'Jones')
+        q2 = families.select().where(families.c.surname == 'Smith')
+        q3 = families.select().where(families.c.id == 'Jones')
+
+        self.assertEqual(cache.key(engine1, q1),
+                         cache.key(engine1, families.select().where(
+                            families.c.surname == 'Jones')))
+        self.assertNotEqual(cache.key(engine1, q1), cache.key(engine2, q1))
+        self.assertNotEqual(cache.key(engine1, q1), cache.key(engine1, q2))
+        self.assertNotEqual(cache.key(engine1, q1), cache.key(engine1, q3))
+
+
+    def test_getPut(self):
+        """
+        You can store and retrieve copies of values.
+        """
+        cache = QueryCache()
+        self.assertEqual(cache.get('foo'), (False, None))
+
+        value = [{'a': 1}]
+        cache.put('foo', value, [families], cache.versions([families]))
+        value[0]['a'] = 2
+
+        found, cached = cache.get('foo')
+        self.assertTrue(found)
+        self.assertEqual(cached, [{'a': 1}])
+        cached[0]['a'] = 3
+        self.assertEqual(cache.get('foo'), (True, [{'a': 1}]))
+        self.assertEqual(cache.hits, 2)
+        self.assertEqual(cache.misses, 1)
+
+
+    def test_lru(self):
+        """
+        The least recently used entries are evicted first.
+        """
+        cache = QueryCache(max_size=2)
+        cache.put('a', 1, [], ())
+        cache.put('b', 2, [], ())
+        cache.get('a')
+        cache.put('c', 3, [], ())
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.get('b'), (False, None))
+        self.assertEqual(cache.get('a'), (True, 1))
+        self.assertEqual(cache.get('c'), (True, 3))
+
+
+    def test_ttl(self):
+        """
+        Entries expire after ttl seconds.
+        """
+        clock = Clock()
+        cache = QueryCache(ttl=10, clock=clock)
+        cache.put('a', 1, [], ())
+        clock.advance(9)
+        self.assertEqual(cache.get('a'), (True, 1))
+        clock.advance(1)
+        self.assertEqual(cache.get('a'), (False, None))
+        self.assertEqual(len(cache), 0)
+
+
+    def test_invalidate(self):
+        """
+        Invalidating a table forgets only the entries read from it.
+        """
+        cache = QueryCache()
+        cache.put('fam', 1, [families], cache.versions([families]))
+        cache.put('both', 2, [families, people],
+                  cache.versions([families, people]))
+        cache.put('people', 3, [people], cache.versions([people]))
+
+        cache.invalidate(families)
+        self.assertEqual(cache.get('fam'), (False, None))
+        self.assertEqual(cache.get('both'), (False, None))
+        self.assertEqual(cache.get('people'), (True, 3))
+
+
+    def test_invalidateTable(self):
+        """
+        invalidateTable invalidates every cache.
+        """
+        cache1 = QueryCache()
+        cache2 = QueryCache()
+        cache1.put('a', 1, [families], cache1.versions([families]))
+        cache2.put('a', 1, [families], cache2.versions([families]))
+        invalidateTable(families)
+        self.assertEqual(cache1.get('a'), (False, None))
+        self.assertEqual(cache2.get('a'), (False, None))
+
+
+    def test_staleValue(self):
+        """
+        A value isn't stored if one of its tables was written to after the
+        query producing it started.
+        """
+        cache = QueryCache()
+        versions = cache.versions([families])
+        cache.invalidate(families)
+        cache.put('a', 1, [families], versions)
+        self.assertEqual(cache.get('a'), (False, None))
+
+
+    def test_clear(self):
+        """
+        You can forget everything.
+        """
+        cache = QueryCache()
+        cache.put('a', 1, [families], cache.versions([families]))
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+
+
+
+class StatementCacheTest(TestCase):
+
+
+    def setUp(self):
+        self.engine = create_engine('sqlite://')
+        metadata.create_all(self.engine)
+        for surname in ['Jones', 'Smith', 'Brown', 'Green']:
+            self.engine.execute(families.insert().values(surname=surname))
+        self.statements = StatementCache()
+
+
+    def fetch(self, query):
+        """
+        Run C{query} through C{self.statements}, returning the rows.
+        """
+        compiled, params = self.statements.compile(self.engine.dialect, query)
+        if compiled is query:
+            return self.engine.execute(query).fetchall()
+        return self.engine.execute(compiled, params).fetchall()
+
+
+    def counts(self):
+        return (self.statements.hits, self.statements.misses,
+                self.statements.uncacheable)
+
+
+    def test_sameShape(self):
+        """
+        Statements differing only in their parameters are compiled once,
+        but run with their own parameters.
+        """
+        query = families.select().order_by(families.c.id)
+        jones = self.fetch(query.where(families.c.surname == 'Jones'))
+        smith = self.fetch(query.where(families.c.surname == 'Smith'))
+        self.assertEqual(jones, [(1, 'Jones')])
+        self.assertEqual(smith, [(2, 'Smith')])
+        self.assertEqual(self.counts(), (1, 1, 0))
+        self.assertEqual(len(self.statements), 1)
+
+
+    def test_differentShape(self):
+        """
+        The structure of the C{WHERE} clause and the order are part of the
+        shape.
+        """
+        query = families.select()
+        self.fetch(query.where(families.c.id == 1))
+        self.fetch(query.where(families.c.id > 1))
+        self.fetch(query.where(families.c.surname == 1))
+        self.fetch(query.where(families.c.id.in_([1, 2])))
+        self.fetch(query.where(families.c.id.in_([1, 2, 3])))
+        self.fetch(query.where(families.c.id == 1).order_by(families.c.id))
+        self.assertEqual(self.counts(), (0, 6, 0))
+
+
+    def test_types(self):
+        """
+        The types of functions and labels are part of the shape, since they
+        decide how results are processed.
+        """
+        self.engine.execute(families.insert().values(surname='2014-01-02'))
+        where = families.c.id == 5
+        surname = families.c.surname
+        queries = [
+            lambda t: select([func.coalesce(surname, 'x', type_=t)]),
+            lambda t: select([Label('x', surname, type_=t)]),
+        ]
+        for query in queries:
+            rows = self.fetch(query(String).where(where))
+            self.assertEqual(rows, [('2014-01-02',)])
+            rows = self.fetch(query(Date).where(where))
+            self.assertEqual(rows, [(date(2014, 1, 2),)])
+        self.assertEqual(self.counts(), (0, 4, 0))
+
+
+    def test_executionOptions(self):
+        """
+        Execution options are part of the shape, since they go along with
+        the compiled statement.
+        """
+        query = lambda id: families.select().where(families.c.id == id)
+        self.fetch(query(1))
+        self.fetch(query(1).execution_options(stream_results=True))
+        compiled, params = self.statements.compile(self.engine.dialect,
+            query(2).execution_options(stream_results=True))
+        self.assertEqual(params, {'id_1': 2})
+        self.assertEqual(compiled.statement._execution_options,
+                         {'stream_results': True})
+        self.assertEqual(self.counts(), (1, 2, 0))
+
+
+    def test_limitOffset(self):
+        """
+        Whether there's a limit and offset is part of the shape, but their
+        values aren't.
+        """
+        query = select([families.c.surname]).order_by(families.c.id)
+        self.assertEqual(self.fetch(query.limit(2)), [('Jones',), ('Smith',)])
+        self.assertEqual(self.fetch(query.limit(1)), [('Jones',)])
+        self.assertEqual(self.fetch(query.offset(3)), [('Green',)])
+        self.assertEqual(self.fetch(query.offset(2)),
+                         [('Brown',), ('Green',)])
+        self.assertEqual(self.fetch(query.limit(1).offset(1)), [('Smith',)])
+        self.assertEqual(self.fetch(query.limit(2).offset(2)),
+                         [('Brown',), ('Green',)])
+        self.assertEqual(self.counts(), (3, 3, 0))
+
+
+    def test_uncacheable(self):
+        """
+        Statements using things I don't know the shape of are returned to
+        be run as they are.
+        """
+        subquery = select([people.c.id]).where(people.c.name == 'Sam')
+        queries = [
+            union(families.select(), families.select()),
+            families.select().where(families.c.id.in_(subquery)),
+            families.insert().values(surname='Jones'),
+        ]
+        for query in queries:
+            self.assertEqual(self.statements.compile(self.engine.dialect,
+                                                     query), (query, {}))
+        self.assertEqual(self.counts(), (0, 0, 3))
+
+
+    def test_dialect(self):
+        """
+        Statements are compiled separately for each dialect.
+        """
+        query = families.select().where(families.c.id == 1)
+        self.statements.compile(self.engine.dialect, query)
+        compiled, params = self.statements.compile(postgresql.dialect(), query)
+        self.assertIn('%(id_1)s', str(compiled))
+        self.assertEqual(params, {'id_1': 1})
+        self.assertEqual(self.counts(), (0, 2, 0))
+
+
+    def test_lru(self):
+        """
+        The least recently used statements are evicted first.
+        """
+        self.statements = StatementCache(max_size=2)
+        one = families.select().where(families.c.id == 1)
+        two = families.select().where(families.c.surname == 'Jones')
+        three = families.select().where(families.c.id > 1)
+        self.fetch(one)
+        self.fetch(two)
+        self.fetch(one)
+        self.fetch(three)
+        self.assertEqual(len(self.statements), 2)
+        self.fetch(one)
+        self.assertEqual(self.counts(), (2, 3, 0))
+        self.fetch(two)
+        self.assertEqual(self.counts(), (2, 4, 0))
@@ -1,20 +1,34 @@
-from twisted.trial.unittest import TestCase
+from array import array
+
+from twisted.trial.unittest import TestCase, SkipTest
 from twisted.internet import defer, reactor
+from twisted.internet.task import deferLater, Clock
 
 from mock import MagicMock
 
 from alchimia import TWISTED_STRATEGY
 
 from sqlalchemy import MetaData, Table, Column, Integer, String, DateTime
-from sqlalchemy import create_engine, ForeignKey
+from sqlalchemy import create_engine, ForeignKey, select, text, event
 from sqlalchemy.schema import CreateTable
 from sqlalchemy.pool import StaticPool
+from sqlalchemy.dialects import postgresql
 
-from crudset.error import TooMany, MissingRequiredFields
+from crudset.error import TooMany, MissingRequiredFields, NotReadable
+from crudset.error import NotLoaded
 from crudset.crud import Crud, Paginator, Ref, Sanitizer, Readset, Writeset
 from crudset.crud import SanitizationContext, SaniChain, crudFromSpec
+from crudset.crud import LazyList, Record
+from crudset.cache import QueryCache
+from crudset.instrument import Histograms
+from crudset import instrument
 
 from twisted.python import log
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 import logging
 class TwistedLogStream(object):
     def write(self, msg):
@@ -50,6 +64,22 @@ pets = Table('pets', metadata,
 
 
 
+def countQueries(engine):
+    """
+    Record the statements executed by C{engine}.
+
+    @return: A list that will have every executed statement appended to it.
+    """
+    executed = []
+    real_execute = engine.execute
+    def execute(statement, *args, **kwargs):
+        executed.append(statement)
+        return real_execute(statement, *args, **kwargs)
+    engine.execute = execute
+    return executed
+
+
+
 class CrudTest(TestCase):
 
     timeout = 10
@@ -79,6 +109,34 @@ class CrudTest(TestCase):
         self.assertEqual(crud.sanitizer.sanitizers, [sani, sani])
 
 
+    def test_sanitizerChain_overridden(self):
+        """
+        Chained sanitizers whose classes override C{sanitize} are sanitized
+        with it.
+        """
+        class Upper(Writeset):
+            def sanitize(self, context, data):
+                d = Writeset.sanitize(self, context, data)
+                return d.addCallback(lambda data: dict(
+                    data, surname=data['surname'].upper()))
+
+        class Exclaim(Sanitizer):
+            def sanitize(self, context, data, instance=None):
+                d = Sanitizer.sanitize(self, context, data, instance)
+                return d.addCallback(lambda data: dict(
+                    data, surname=data['surname'] + '!'))
+
+        class Foo(object):
+            sanitizer = Exclaim(families)
+
+        chain = SaniChain([Sanitizer(families), Upper(families, ['surname']),
+                           Foo().sanitizer,
+                           SaniChain([Exclaim(families)])])
+        context = SanitizationContext(None, 'create', None)
+        d = chain.sanitize(context, {'surname': 'jones'})
+        self.assertEqual(self.successResultOf(d), {'surname': 'JONES!!'})
+
+
     def test_read_write_tablesDiffer(self):
         """
         The Readset and Writeset tables must be the same
@@ -138,6 +196,264 @@ class CrudTest(TestCase):
         self.assertEqual(called['context'].query, None)
 
 
+    @defer.inlineCallbacks
+    def test_create_noReturn(self):
+        """
+        You can create without reading the record back.
+        """
+        engine = yield self.engine()
+        crud = Crud(Readset(families), Sanitizer(families))
+
+        executed = countQueries(engine)
+        result = yield crud.create(engine, {'surname': 'Jones'},
+                                   return_rows=False)
+        self.assertEqual(result, None)
+        self.assertEqual(len(executed), 1, "Should only insert")
+
+        fams = yield crud.fetch(engine)
+        self.assertEqual(fams[0]['surname'], 'Jones')
+
+
+    def returningEngine(self, rows):
+        """
+        Make a fake engine for a dialect that supports RETURNING, whose
+        statements all return C{rows}.
+        """
+        engine = MagicMock()
+        engine.dialect.implicit_returning = True
+        def execute(statement):
+            result = MagicMock()
+            result.fetchall.return_value = defer.succeed(rows)
+            return defer.succeed(result)
+        engine.execute.side_effect = execute
+        return engine
+
+
+    def test_create_returning(self):
+        """
+        If the dialect supports RETURNING, the created record is returned by
+        the insert rather than by a second query.
+        """
+        engine = self.returningEngine([(1, 1, None, 'Jones')])
+        crud = Crud(Readset(families), Sanitizer(families))
+
+        fam = self.successResultOf(crud.create(engine, {'surname': 'Jones'}))
+        self.assertEqual(fam, {'id': 1, 'location': None, 'surname': 'Jones'})
+        self.assertEqual(engine.execute.call_count, 1)
+        statement = engine.execute.call_args[0][0]
+        sql = str(statement.compile(dialect=postgresql.dialect()))
+        self.assertIn('RETURNING family.id, family.id, family.location, '
+                      'family.surname', sql)
+
+
+    def test_update_returning(self):
+        """
+        If the dialect supports RETURNING, the updated records are returned
+        by the update rather than by a second query.
+        """
+        engine = self.returningEngine([(1, 'Jones'), (2, 'Jones')])
+        crud = Crud(Readset(families, ['surname']), Sanitizer(families))
+
+        fams = self.successResultOf(crud.update(engine, {'surname': 'Jones'},
+                                                families.c.id < 3))
+        self.assertEqual(fams, [{'surname': 'Jones'}, {'surname': 'Jones'}])
+        self.assertEqual(engine.execute.call_count, 1)
+        statement = engine.execute.call_args[0][0]
+        sql = str(statement.compile(dialect=postgresql.dialect()))
+        self.assertTrue(sql.startswith('UPDATE family'), sql)
+        self.assertIn('RETURNING family.id, family.surname', sql)
+
+
+    def test_canReturnRows(self):
+        """
+        Records can't be read back with RETURNING if single references have
+        to be joined, or if the dialect doesn't support it.
+        """
+        engine = self.returningEngine([])
+        crud = Crud(Readset(people))
+        self.assertTrue(crud._canReturnRows(engine))
+
+        crud = Crud(Readset(families, references={
+            'pets': Ref(Readset(pets), pets.c.family_id == families.c.id,
+                multiple=True),
+        }))
+        self.assertTrue(crud._canReturnRows(engine),
+                        "Multiple references are fetched separately anyway")
+
+        crud = Crud(Readset(people, references={
+            'family': Ref(Readset(families),
+                          people.c.family_id == families.c.id),
+        }))
+        self.assertFalse(crud._canReturnRows(engine))
+
+        engine.dialect.implicit_returning = False
+        self.assertFalse(Crud(Readset(people))._canReturnRows(engine))
+
+
+    @defer.inlineCallbacks
+    def test_createMany(self):
+        """
+        You can create several records at once.  They are returned in the
+        same order.
+        """
+        engine = yield self.engine()
+        crud = Crud(Readset(families), Sanitizer(families))
+
+        fams = yield crud.createMany(engine, [
+            {'surname': 'Jones'},
+            {'surname': 'Arnold', 'location': 'Nowhere'},
+            {'surname': 'Zed'},
+        ])
+        self.assertEqual([x['surname'] for x in fams],
+                         ['Jones', 'Arnold', 'Zed'])
+        self.assertEqual(fams[1]['location'], 'Nowhere')
+        self.assertEqual(len(set([x['id'] for x in fams])), 3)
+
+        all_fams = yield crud.fetch(engine, order=families.c.id)
+        self.assertEqual(all_fams, fams)
+
+
+    @defer.inlineCallbacks
+    def test_createMany_fixedSanitized(self):
+        """
+        Fixed attributes and sanitizers are applied to every record.
+        """
+        engine = yield self.engine()
+        class Foo(object):
+            sanitizer = Sanitizer(families)
+            @sanitizer.sanitizeField('surname')
+            def surname(self, context, data, field):
+                self.context = context
+                return data[field].upper()
+        foo = Foo()
+        crud = Crud(Readset(families), foo.sanitizer)
+        crud = crud.fix({'location': 'Sunnyville'})
+
+        fams = yield crud.createMany(engine, [
+            {'surname': 'Jones', 'location': 'Nowhere'},
+            {'surname': 'Arnold'},
+        ])
+        self.assertEqual([(x['surname'], x['location']) for x in fams],
+                         [('JONES', 'Sunnyville'), ('ARNOLD', 'Sunnyville')])
+        self.assertEqual(foo.context.action, 'create')
+
+
+    @defer.inlineCallbacks
+    def test_createMany_knownPrimaryKeys(self):
+        """
+        If the primary keys are given, each batch is inserted with a
+        single executemany and read back with a single query.
+        """
+        engine = yield self.engine()
+        crud = Crud(Readset(families), Sanitizer(families))
+
+        executed = countQueries(engine)
+        fams = yield crud.createMany(engine, [
+            {'id': 10 - i, 'surname': str(i)} for i in xrange(5)],
+            batch_size=3)
+        self.assertEqual(len(executed), 4, "Should insert and read each "
+                         "of two batches with one query each")
+        self.assertEqual([x['id'] for x in fams], [10, 9, 8, 7, 6])
+        self.assertEqual([x['surname'] for x in fams],
+                         ['0', '1', '2', '3', '4'])
+
+
+    @defer.inlineCallbacks
+    def test_createMany_batchSize(self):
+        """
+        Generated primary keys are read back with one query per batch.
+        """
+        engine = yield self.engine()
+        crud = Crud(Readset(families), Sanitizer(families))
+        crud.create_batch_size = 2
+
+        executed = countQueries(engine)
+        fams = yield crud.createMany(engine, [
+            {'surname': str(i)} for i in xrange(5)])
+        self.assertEqual(len(executed), 5 + 3, "Should insert each record "
+                         "and read back each of three batches")
+        self.assertEqual([x['surname'] for x in fams],
+                         ['0', '1', '2', '3', '4'])
+
+
+    @defer.inlineCallbacks
+    def test_createMany_invalid(self):
+        """
+        Every record is sanitized before any is inserted, so an invalid one
+        leaves nothing inserted.
+        """
+        engine = yield self.engine()
+        crud = Crud(Readset(families), Sanitizer(families,
+                                                 required=['surname']))
+        executed = countQueries(engine)
+        yield self.assertFailure(crud.createMany(engine, [
+            {'surname': 'Jones'}, {'surname': 'Smith'}, {'surname': 'Brown'},
+            {'location': 'Nowhere'}], batch_size=2), MissingRequiredFields)
+        self.assertEqual(executed, [])
+
+
+    def test_createMany_returning(self):
+        """
+        If the dialect supports RETURNING, records with the same columns
+        are inserted by one statement which returns their primary keys.
+        """
+        engine = self.returningEngine([])
+        returned = {
+            'INSERT INTO family (surname) VALUES '
+            '(%(surname_0)s), (%(surname_1)s) RETURNING family.id':
+                [[(1,), (3,)]],
+            'INSERT INTO family (location, surname) VALUES '
+            '(%(location_0)s, %(surname_0)s) RETURNING family.id':
+                [[(2,)]],
+            'INSERT INTO family DEFAULT VALUES RETURNING family.id':
+                [[(4,)], [(5,)]],
+        }
+        def execute(statement):
+            sql = str(statement.compile(dialect=postgresql.dialect()))
+            result = MagicMock()
+            result.fetchall.return_value = defer.succeed(
+                returned[sql].pop(0))
+            return defer.succeed(result)
+        engine.execute.side_effect = execute
+        crud = Crud(Readset(families), Sanitizer(families))
+        crud._getMany = lambda engine, pks: defer.succeed(pks)
+
+        d = crud.createMany(engine, [
+            {'surname': 'Jones'}, {'surname': 'Smith', 'location': 'Here'},
+            {'surname': 'Brown'}, {}, {}])
+        self.assertEqual(self.successResultOf(d),
+                         [(1,), (2,), (3,), (4,), (5,)])
+        self.assertEqual(engine.execute.call_count, 4)
+        self.assertEqual(returned.values(), [[], [], []])
+
+
+    @defer.inlineCallbacks
+    def test_createMany_empty(self):
+        """
+        Creating no records does nothing.
+        """
+        engine = yield self.engine()
+        crud = Crud(Readset(families), Sanitizer(families))
+        executed = countQueries(engine)
+        fams = yield crud.createMany(engine, [])
+        self.assertEqual(fams, [])
+        self.assertEqual(executed, [])
+
+
+    def test_fix_subclass(self):
+        """
+        Fixed and projected L{Crud}s are of the same class, so they keep
+        its settings.
+        """
+        class SmallBatches(Crud):
+            create_batch_size = 2
+        crud = SmallBatches(Readset(families), Sanitizer(families))
+        for derived in [crud.fix({'surname': 'Jones'}),
+                        crud._project(['surname'])]:
+            self.assertTrue(isinstance(derived, SmallBatches))
+            self.assertEqual(derived.create_batch_size, 2)
+
+
     @defer.inlineCallbacks
     def test_fix_succession(self):
         """
@@ -153,6 +469,39 @@ class CrudTest(TestCase):
         self.assertEqual(family['location'], 'Sunnyville')
 
 
+    def test_fix_sharesQuery(self):
+        """
+        Fixed L{Crud}s add their constraints to the query of the L{Crud}
+        they were made from rather than building their own, and share its
+        row decoder.  The SQL only depends on which attributes are fixed.
+        """
+        crud = Crud(Readset(people, references={
+            'family': Ref(Readset(families),
+                          people.c.family_id == families.c.id),
+        }))
+        jones = crud.fix({'family_id': 1}).fix({'name': 'Sam'})
+        smith = crud.fix({'name': 'Sue', 'family_id': 2})
+
+        self.assertIdentical(jones.select_columns, crud.select_columns)
+        self.assertIdentical(jones.row_decoder, crud.row_decoder)
+        self.assertIdentical(smith.row_decoder, crud.row_decoder)
+        self.assertEqual(jones.base_query._froms, crud.base_query._froms)
+
+        self.assertEqual(str(jones.base_query), str(smith.base_query))
+        self.assertEqual(sorted(jones.base_query.compile().params.values()),
+                         [1, 'Sam'])
+        self.assertEqual(sorted(smith.base_query.compile().params.values()),
+                         [2, 'Sue'])
+        self.assertNotEqual(str(crud.fix({'name': 'Sam'}).base_query),
+                            str(jones.base_query))
+
+        projected = jones._project(['name'])
+        self.assertIdentical(projected.row_decoder,
+                             crud._project(['name']).row_decoder)
+        self.assertEqual(projected.base_query.compile().params.values(),
+                         jones.base_query.compile().params.values())
+
+
     @defer.inlineCallbacks
     def test_fetch(self):
         """
@@ -260,177 +609,774 @@ class CrudTest(TestCase):
 
 
     @defer.inlineCallbacks
-    def test_getOne(self):
+    def test_fetch_statementCache(self):
         """
-        You can get just one item.
+        Reads of the same shape are compiled once, by a cache shared with
+        fixed L{Crud}s, and still get their own results.
         """
         engine = yield self.engine()
         crud = Crud(Readset(families), Sanitizer(families))
-        fam = yield crud.create(engine, {'surname': 'hey'})
-        one = yield crud.getOne(engine)
-        self.assertEqual(one, fam)
+        fams = []
+        for i in xrange(10):
+            fam = yield crud.create(engine, {'surname': 'abcdefghij'[i]})
+            fams.append(fam)
+        statements = crud.statements
+        hits, misses = statements.hits, statements.misses
+
+        for offset in xrange(0, 10, 3):
+            results = yield crud.fetch(engine, families.c.id > 1, limit=3,
+                                       offset=offset, order=families.c.id)
+            self.assertEqual(results, fams[1:][offset:offset+3])
+        fixed = crud.fix({'surname': 'c'})
+        self.assertIdentical(fixed.statements, crud.statements)
+        fam = yield fixed.getOne(engine)
+        self.assertEqual(fam, fams[2])
+        fam = yield crud.fix({'surname': 'd'}).getOne(engine)
+        self.assertEqual(fam, fams[3])
+
+        self.assertEqual(statements.hits - hits, 4)
+        self.assertEqual(statements.misses - misses, 2)
 
 
     @defer.inlineCallbacks
-    def test_getOne_where(self):
+    def test_fetch_noStatementCache(self):
         """
-        You can get one by a where clause
+        The statement cache can be turned off.
+        """
+        class UncachedCrud(Crud):
+            statement_cache_size = 0
+        engine = yield self.engine()
+        crud = UncachedCrud(Readset(families), Sanitizer(families))
+        self.assertEqual(crud.statements, None)
+
+        fam = yield crud.create(engine, {'surname': 'Jones'})
+        results = yield crud.fetch(engine, families.c.id == fam['id'])
+        self.assertEqual(results, [fam])
+
+
+    @defer.inlineCallbacks
+    def test_fetchChunks(self):
+        """
+        You can stream the records to a callback in chunks.
         """
         engine = yield self.engine()
         crud = Crud(Readset(families), Sanitizer(families))
-        fam1 = yield crud.create(engine, {'surname': 'bob'})
-        yield crud.create(engine, {'surname': 'Jones'})
-        one = yield crud.getOne(engine, families.c.surname == 'bob')
-        self.assertEqual(one, fam1)
+        expected = []
+        for i in xrange(7):
+            fam = yield crud.create(engine, {'surname': str(i)})
+            expected.append(fam)
+
+        chunks = []
+        total = yield crud.fetchChunks(engine, chunks.append,
+                                       order=families.c.id, chunk_size=3)
+        self.assertEqual(total, 7)
+        self.assertEqual([len(x) for x in chunks], [3, 3, 1])
+        self.assertEqual(sum(chunks, []), expected)
 
 
     @defer.inlineCallbacks
-    def test_getOne_moreThanOne(self):
+    def test_fetchChunks_streamResults(self):
         """
-        If getOne returns more than one, it's an exception.
+        Streaming asks for a server-side cursor, and its statement is still
+        compiled once.
         """
         engine = yield self.engine()
-        crud = Crud(Readset(families))
-        yield crud.create(engine, {'surname': 'bob'})
+        crud = Crud(Readset(families), Sanitizer(families))
         yield crud.create(engine, {'surname': 'Jones'})
-        self.assertFailure(crud.getOne(engine), TooMany)
+        executed = countQueries(engine)
+        hits = crud.statements.hits
+        for i in xrange(2):
+            total = yield crud.fetchChunks(engine, lambda chunk: None)
+            self.assertEqual(total, 1)
+        self.assertEqual(crud.statements.hits, hits + 1)
+        for statement in executed:
+            statement = getattr(statement, 'statement', statement)
+            self.assertEqual(statement._execution_options['stream_results'],
+                             True)
 
 
     @defer.inlineCallbacks
-    def test_getOne_None(self):
+    def test_fetchChunks_where(self):
         """
-        If there is no result, return None.
+        Streaming obeys fixed attributes and where clauses and includes
+        references.
         """
         engine = yield self.engine()
-        crud = Crud(Readset(families))
-        one = yield crud.getOne(engine)
-        self.assertEqual(one, None)
+        fam_crud = Crud(Readset(families), Sanitizer(families))
+        johnson = yield fam_crud.create(engine, {'surname': 'Johnson'})
+        crud = Crud(Readset(people, references={
+            'family': Ref(Readset(families),
+                          people.c.family_id == families.c.id),
+        }), Sanitizer(people)).fix({'family_id': johnson['id']})
+        yield crud.create(engine, {'name': 'John'})
+        yield crud.create(engine, {'name': 'Jim'})
+        yield Crud(Readset(people), Sanitizer(people)).create(engine,
+            {'name': 'John'})
+
+        chunks = []
+        total = yield crud.fetchChunks(engine, chunks.append,
+                                       people.c.name == 'John')
+        self.assertEqual(total, 1)
+        self.assertEqual(chunks[0][0]['name'], 'John')
+        self.assertEqual(chunks[0][0]['family'], johnson)
 
 
     @defer.inlineCallbacks
-    def test_count(self):
+    def test_fetchChunks_slowConsumer(self):
         """
-        You can count the records.
+        If the callback returns a Deferred, no more rows are read until it
+        fires.
         """
         engine = yield self.engine()
-        crud = Crud(Readset(families))
-        for i in xrange(14):
+        crud = Crud(Readset(families), Sanitizer(families))
+        for i in xrange(4):
             yield crud.create(engine, {'surname': str(i)})
 
-        count = yield crud.count(engine)
-        self.assertEqual(count, 14)
+        waiting = []
+        def callback(chunk):
+            d = defer.Deferred()
+            waiting.append((chunk, d))
+            return d
+        done = crud.fetchChunks(engine, callback, chunk_size=2)
+
+        # give the first chunk a chance to be read
+        while not waiting:
+            yield deferLater(reactor, 0.01, lambda: None)
+        yield deferLater(reactor, 0.05, lambda: None)
+        self.assertEqual(len(waiting), 1, "Should wait for the consumer")
+
+        waiting[0][1].callback(None)
+        while len(waiting) < 2:
+            yield deferLater(reactor, 0.01, lambda: None)
+        waiting[1][1].callback(None)
+        total = yield done
+        self.assertEqual(total, 4)
 
 
     @defer.inlineCallbacks
-    def test_count_where(self):
+    def test_fetchChunks_error(self):
         """
-        You can count filtered records.
+        Errors from the callback are passed on.
         """
         engine = yield self.engine()
         crud = Crud(Readset(families), Sanitizer(families))
-        for i in xrange(14):
+        for i in xrange(4):
             yield crud.create(engine, {'surname': str(i)})
 
-        count = yield crud.count(engine, families.c.surname == '12')
-        self.assertEqual(count, 1)
+        def callback(chunk):
+            raise ValueError('foo')
+        yield self.assertFailure(crud.fetchChunks(engine, callback,
+                                                  chunk_size=2), ValueError)
+
+        fams = yield crud.fetch(engine)
+        self.assertEqual(len(fams), 4, "The engine should still be usable")
 
 
     @defer.inlineCallbacks
-    def test_count_fixed(self):
+    def test_fetch_fields(self):
         """
-        The count is restricted by fixed attributes.
+        You can choose which fields to fetch.
         """
         engine = yield self.engine()
         crud = Crud(Readset(families), Sanitizer(families))
-        yield crud.create(engine, {'surname': 'Jones'})
-        yield crud.create(engine, {'surname': 'Arnold'})
+        yield crud.create(engine, {'surname': 'Jones', 'location': 'Here'})
 
-        crud2 = crud.fix({'surname': 'Arnold'})
-        count = yield crud2.count(engine)
-        self.assertEqual(count, 1)
+        fams = yield crud.fetch(engine, fields=['surname'])
+        self.assertEqual(fams, [{'surname': 'Jones'}])
+        self.assertNotIn('location', str(crud._project(['surname']).base_query))
+        self.assertIdentical(crud._project(['surname']),
+                             crud._project(['surname']),
+                             "Projections should be reused")
+
+        fam = yield crud.getOne(engine, fields=['id', 'location'])
+        self.assertEqual(sorted(fam), ['id', 'location'])
+
+
+    def test_fetch_fields_lru(self):
+        """
+        Only the most recently used projections are kept.
+        """
+        crud = Crud(Readset(families), Sanitizer(families))
+        crud.projection_cache_size = 2
+        surname = crud._project(['surname'])
+        crud._project(['location'])
+        self.assertIdentical(crud._project(['surname']), surname)
+        crud._project(['id'])
+        self.assertEqual(set(crud._projections),
+                         set([frozenset(['id']), frozenset(['surname'])]))
+        self.assertIdentical(crud._project(['surname']), surname)
 
 
     @defer.inlineCallbacks
-    def test_update(self):
+    def test_fetch_fields_references(self):
         """
-        You can update sets.
+        References that aren't asked for aren't joined or fetched, and you
+        can choose fields of references with dotted paths.
         """
         engine = yield self.engine()
-        crud = Crud(Readset(families), Sanitizer(families))
-        yield crud.create(engine, {'surname': 'Jones'})
-        fams = yield crud.update(engine, {'surname': 'Jamison'})
-        self.assertEqual(len(fams), 1)
-        self.assertEqual(fams[0]['surname'], 'Jamison')
+        fam_crud = Crud(Readset(families), Sanitizer(families))
+        johnson = yield fam_crud.create(engine, {'surname': 'Johnson',
+                                                 'location': 'Here'})
+        yield Crud(Readset(pets)).create(engine, {'family_id': johnson['id'],
+                                                  'name': 'cat'})
+        crud = Crud(Readset(people, references={
+            'family': Ref(Readset(families),
+                          people.c.family_id == families.c.id),
+            'pets': Ref(Readset(pets), pets.c.owner_id == people.c.id,
+                        multiple=True),
+        }), Sanitizer(people)).fix({'family_id': johnson['id']})
+        sam = yield crud.create(engine, {'name': 'Sam'})
+        yield Crud(Readset(pets)).create(engine, {'owner_id': sam['id'],
+                                                  'name': 'dog'})
+
+        executed = countQueries(engine)
+        peeps = yield crud.fetch(engine, fields=['name'])
+        self.assertEqual(peeps, [{'name': 'Sam'}])
+        self.assertEqual(len(executed), 1, "Should not fetch the pets")
+        self.assertNotIn('JOIN', str(executed[0]))
+
+        peeps = yield crud.fetch(engine, fields=['name', 'family.surname',
+                                                 'pets.name'])
+        self.assertEqual(peeps, [{
+            'name': 'Sam',
+            'family': {'surname': 'Johnson'},
+            'pets': [{'name': 'dog'}],
+        }])
+
+        peeps = yield crud.fetch(engine, fields=['family', 'family.surname'])
+        self.assertEqual(peeps, [{'family': johnson}])
 
 
     @defer.inlineCallbacks
-    def test_update_fixed(self):
+    def test_fetch_fields_notReadable(self):
         """
-        Fixed attributes are part of the update.
+        You can't fetch fields that aren't readable.
         """
         engine = yield self.engine()
-        crud = Crud(Readset(families), Sanitizer(families))
-        yield crud.create(engine, {'surname': 'Jones', 'location': 'anvilania'})
-        yield crud.create(engine, {'surname': 'James', 'location': 'gotham'})
+        crud = Crud(Readset(people, ['name'], references={
+            'family': Ref(Readset(families, ['surname']),
+                          people.c.family_id == families.c.id),
+        }), Sanitizer(people))
+        yield self.assertFailure(crud.fetch(engine, fields=['id']),
+                                 NotReadable)
+        yield self.assertFailure(crud.fetch(engine, fields=['family.id']),
+                                 NotReadable)
+        yield self.assertFailure(crud.fetch(engine, fields=['name.foo']),
+                                 NotReadable)
 
-        crud2 = crud.fix({'surname': 'James'})
-        yield crud2.update(engine, {'location': 'middle earth'})
 
-        fams = yield crud.fetch(engine, families.c.surname == u'Jones')
-        self.assertEqual(fams[0]['location'], 'anvilania')
+    @defer.inlineCallbacks
+    def test_fetchColumns(self):
+        """
+        You can fetch records as columns.  Numbers that can't be null are
+        read into arrays.
+        """
+        engine = yield self.engine()
+        crud = Crud(Readset(families), Sanitizer(families))
+        yield crud.create(engine, {'surname': 'Jones'})
+        yield crud.create(engine, {'surname': 'Smith', 'location': 'here'})
+        yield crud.create(engine, {'surname': 'Brown'})
 
-        fams = yield crud.fetch(engine, families.c.surname == u'James')
-        self.assertEqual(fams[0]['location'], 'middle earth')
+        executed = countQueries(engine)
+        cols = yield crud.fetchColumns(engine, families.c.surname != 'Brown',
+                                       order=families.c.id, chunk_size=1)
+        self.assertEqual(len(executed), 1)
+        self.assertEqual(sorted(cols), ['id', 'location', 'surname'])
+        self.assertEqual(cols['id'], array('l', [1, 2]))
+        self.assertEqual(cols['surname'], ['Jones', 'Smith'])
+        self.assertEqual(cols['location'], [None, 'here'])
+
+        cols = yield crud.fetchColumns(engine, families.c.id == 10)
+        self.assertEqual(cols['id'], array('l'))
+        self.assertEqual(cols['surname'], [])
 
 
     @defer.inlineCallbacks
-    def test_update_fixedNoChange(self):
+    def test_fetchColumns_fixedAndReferences(self):
         """
-        You aren't allowed to update the fixed attributes.
+        Fixed attributes are respected, and single references are dicts of
+        columns.
         """
         engine = yield self.engine()
-        crud = Crud(Readset(families), Sanitizer(families))
-        yield crud.create(engine, {'surname': 'Jones', 'location': 'bar'})
+        fam_crud = Crud(Readset(families), Sanitizer(families))
+        family = yield fam_crud.create(engine, {'surname': 'Jones'})
+        crud = Crud(Readset(people, references={
+            'family': Ref(Readset(families),
+                          people.c.family_id == families.c.id),
+            'pets': Ref(Readset(pets), pets.c.owner_id == people.c.id,
+                        multiple=True),
+        }), Sanitizer(people))
+        yield crud.create(engine, {'name': 'Sam', 'family_id': family['id']})
+        yield crud.create(engine, {'name': 'John'})
+        yield crud.create(engine, {'name': 'Sam'})
 
-        crud2 = crud.fix({'surname': 'Jones'})
-        fams = yield crud2.update(engine, {'surname': 'Allison',
-                                           'location': 'hawaii'})
-        fam = fams[0]
-        self.assertEqual(fam['surname'], 'Jones', "Should keep fixed value")
+        cols = yield crud.fix({'name': 'Sam'}).fetchColumns(engine,
+            order=people.c.id)
+        self.assertEqual(cols['name'], ['Sam', 'Sam'])
+        self.assertEqual(cols['family_id'], [family['id'], None])
+        self.assertEqual(cols['family'], {
+            'id': [family['id'], None],
+            'surname': ['Jones', None],
+            'location': [None, None],
+        })
+        self.assertNotIn('pets', cols)
+
+        cols = yield crud.fetchColumns(engine, fields=['name', 'family.id'])
+        self.assertEqual(sorted(cols), ['family', 'name'])
+        self.assertEqual(sorted(cols['family']), ['id'])
 
 
     @defer.inlineCallbacks
-    def test_update_nothing(self):
+    def test_fetchColumns_numpy(self):
         """
-        It's a no-op to update nothing.
+        Numeric columns can be NumPy arrays.
         """
+        if numpy is None:
+            raise SkipTest('NumPy is not installed')
         engine = yield self.engine()
         crud = Crud(Readset(families), Sanitizer(families))
         yield crud.create(engine, {'surname': 'Jones'})
-        fams = yield crud.update(engine, {})
-        fam = fams[0]
-        self.assertEqual(fam['surname'], 'Jones')
+        cols = yield crud.fetchColumns(engine, use_numpy=True)
+        self.assertTrue(isinstance(cols['id'], numpy.ndarray))
+        self.assertEqual(list(cols['id']), [1])
+        self.assertEqual(cols['surname'], ['Jones'])
 
 
     @defer.inlineCallbacks
-    def test_update_allFixed(self):
+    def test_loader(self):
         """
-        All the fixed attributes should be taken into consideration.
+        Keys loaded in the same reactor iteration are fetched with one
+        query.  Duplicate keys are only asked for once, but each caller
+        gets its own record.
         """
         engine = yield self.engine()
-        crud = Crud(Readset(pets), Sanitizer(pets))
-        yield crud.create(engine, {'name': 'Jones', 'family_id': 1})
-        yield crud.create(engine, {'name': 'James', 'family_id': 20})
-        yield crud.create(engine, {'name': 'Jones', 'family_id': 20})
-        yield crud.create(engine, {'name': 'James', 'family_id': 1})
-
-        crud2 = crud.fix({'name': 'James', 'family_id': 20})
-        yield crud2.update(engine, {'owner_id': -1})
+        crud = Crud(Readset(families), Sanitizer(families))
+        jones = yield crud.create(engine, {'surname': 'Jones'})
+        smith = yield crud.create(engine, {'surname': 'Smith'})
+
+        clock = Clock()
+        loader = crud.loader(engine, clock)
+        executed = countQueries(engine)
+        d1 = loader.load(jones['id'])
+        d2 = loader.load(smith['id'])
+        d3 = loader.load((jones['id'],))
+        d4 = loader.load(1000)
+        self.assertEqual(executed, [])
+        self.assertNoResult(d1)
+
+        clock.advance(0)
+        results = yield defer.gatherResults([d1, d2, d3, d4])
+        self.assertEqual(results, [jones, smith, jones, None])
+        self.assertEqual(len(executed), 1)
+        self.assertNotIdentical(results[0], results[2])
+
+        d5 = loader.load(smith['id'])
+        clock.advance(0)
+        result = yield d5
+        self.assertEqual(result, smith)
+        self.assertEqual(len(executed), 2, "Results aren't cached")
 
-        fams = yield crud.fetch(engine)
-        actual = set()
-        for fam in fams:
-            actual.add((fam['owner_id'], fam['name'], fam['family_id']))
+
+    @defer.inlineCallbacks
+    def test_loader_batches(self):
+        """
+        At most C{max_batch_size} keys are fetched by each query.  Fixed
+        attributes are respected.
+        """
+        engine = yield self.engine()
+        crud = Crud(Readset(families), Sanitizer(families))
+        fams = yield crud.createMany(engine, [{'surname': str(i % 2)}
+                                              for i in xrange(5)])
+        clock = Clock()
+        loader = crud.fix({'surname': '0'}).loader(engine, clock)
+        loader.max_batch_size = 2
+        executed = countQueries(engine)
+        ds = [loader.load(x['id']) for x in fams]
+        clock.advance(0)
+        results = yield defer.gatherResults(ds)
+        self.assertEqual(len(executed), 3)
+        self.assertEqual(results, [fams[0], None, fams[2], None, fams[4]])
+
+
+    @defer.inlineCallbacks
+    def test_loader_error(self):
+        """
+        If a batch fails, every caller waiting on it gets the failure.
+        """
+        engine = yield self.engine()
+        crud = Crud(Readset(families), Sanitizer(families))
+        clock = Clock()
+        loader = crud.loader(engine, clock)
+        engine.execute = lambda *args: defer.fail(ValueError('foo'))
+        d1 = loader.load(1)
+        d2 = loader.load(1)
+        clock.advance(0)
+        self.failureResultOf(d1, ValueError)
+        self.failureResultOf(d2, ValueError)
+
+
+    @defer.inlineCallbacks
+    def test_loader_instrument(self):
+        """
+        Each batch is reported as a C{load} operation of the L{Crud}.
+        """
+        engine = yield self.engine()
+        events = []
+        crud = Crud(Readset(families), Sanitizer(families))
+        yield crud.create(engine, {'surname': 'Jones'})
+        crud.instrument = events.append
+        clock = Clock()
+        loader = crud.loader(engine, clock)
+        d = loader.load(1)
+        loader.load(2)
+        clock.advance(0)
+        yield d
+        self.assertEqual([(x.source, x.operation, x.rows, x.statements)
+                          for x in events], [(crud, 'load', 1, 1)])
+
+
+    @defer.inlineCallbacks
+    def test_singleFlight(self):
+        """
+        Identical reads made while one is running share its query, and get
+        their own copies of the result.  Nothing is kept afterwards.
+        """
+        engine = yield self.engine()
+        crud = Crud(Readset(families), Sanitizer(families),
+                    single_flight=True)
+        yield crud.create(engine, {'surname': 'Jones'})
+
+        executed = countQueries(engine)
+        fixed = crud.fix({'surname': 'Jones'})
+        d1 = fixed.fetch(engine)
+        d2 = crud.fix({'surname': 'Jones'}).fetch(engine)
+        d3 = crud.fetch(engine)
+        d4 = crud.count(engine)
+        d5 = crud.count(engine)
+        results = yield defer.gatherResults([d1, d2, d3, d4, d5])
+        self.assertEqual(len(executed), 3)
+        self.assertEqual(results[0], results[1])
+        self.assertNotIdentical(results[0][0], results[1][0])
+        self.assertEqual(results[3:], [1, 1])
+        self.assertEqual(crud._in_flight, {})
+
+        yield crud.fetch(engine)
+        self.assertEqual(len(executed), 4)
+
+
+    @defer.inlineCallbacks
+    def test_singleFlight_error(self):
+        """
+        Everyone sharing a failed read gets the failure.
+        """
+        engine = yield self.engine()
+        crud = Crud(Readset(families), Sanitizer(families),
+                    single_flight=True)
+        d = defer.Deferred()
+        calls = []
+        def execute(*args):
+            calls.append(args)
+            return d
+        engine.execute = execute
+        d1 = crud.fetch(engine)
+        d2 = crud.fetch(engine)
+        d.errback(ValueError('foo'))
+        self.failureResultOf(d1, ValueError)
+        self.failureResultOf(d2, ValueError)
+        self.assertEqual(len(calls), 1)
+
+
+    @defer.inlineCallbacks
+    def test_singleFlight_cache(self):
+        """
+        Single flight works along with a cache.
+        """
+        engine = yield self.engine()
+        crud = Crud(Readset(families), Sanitizer(families),
+                    cache=QueryCache(), single_flight=True)
+        yield crud.create(engine, {'surname': 'Jones'})
+        executed = countQueries(engine)
+        results = yield defer.gatherResults([crud.fetch(engine),
+                                             crud.fetch(engine)])
+        self.assertEqual(results[0], results[1])
+        yield crud.fetch(engine)
+        self.assertEqual(len(executed), 1)
+        self.assertEqual(crud.cache.hits, 1)
+
+
+    @defer.inlineCallbacks
+    def test_singleFlight_uncompiled(self):
+        """
+        Reads the statement cache can't compile (such as ones with
+        subqueries or text) still share their query.
+        """
+        engine = yield self.engine()
+        crud = Crud(Readset(families), Sanitizer(families),
+                    single_flight=True)
+        yield crud.create(engine, {'surname': 'Jones'})
+        executed = countQueries(engine)
+        for where in [families.c.id.in_(select([families.c.id])),
+                      text("surname = 'Jones'")]:
+            results = yield defer.gatherResults([crud.fetch(engine, where),
+                                                 crud.fetch(engine, where)])
+            self.assertEqual(results[0], results[1])
+            self.assertEqual(len(results[0]), 1)
+        self.assertEqual(len(executed), 2)
+
+
+    @defer.inlineCallbacks
+    def test_getOne(self):
+        """
+        You can get just one item.
+        """
+        engine = yield self.engine()
+        crud = Crud(Readset(families), Sanitizer(families))
+        fam = yield crud.create(engine, {'surname': 'hey'})
+        one = yield crud.getOne(engine)
+        self.assertEqual(one, fam)
+
+
+    @defer.inlineCallbacks
+    def test_getOne_where(self):
+        """
+        You can get one by a where clause
+        """
+        engine = yield self.engine()
+        crud = Crud(Readset(families), Sanitizer(families))
+        fam1 = yield crud.create(engine, {'surname': 'bob'})
+        yield crud.create(engine, {'surname': 'Jones'})
+        one = yield crud.getOne(engine, families.c.surname == 'bob')
+        self.assertEqual(one, fam1)
+
+
+    @defer.inlineCallbacks
+    def test_getOne_moreThanOne(self):
+        """
+        If getOne returns more than one, it's an exception.
+        """
+        engine = yield self.engine()
+        crud = Crud(Readset(families))
+        yield crud.create(engine, {'surname': 'bob'})
+        yield crud.create(engine, {'surname': 'Jones'})
+        self.assertFailure(crud.getOne(engine), TooMany)
+
+
+    @defer.inlineCallbacks
+    def test_getOne_None(self):
+        """
+        If there is no result, return None.
+        """
+        engine = yield self.engine()
+        crud = Crud(Readset(families))
+        one = yield crud.getOne(engine)
+        self.assertEqual(one, None)
+
+
+    @defer.inlineCallbacks
+    def test_count(self):
+        """
+        You can count the records.
+        """
+        engine = yield self.engine()
+        crud = Crud(Readset(families))
+        for i in xrange(14):
+            yield crud.create(engine, {'surname': str(i)})
+
+        count = yield crud.count(engine)
+        self.assertEqual(count, 14)
+
+
+    @defer.inlineCallbacks
+    def test_count_where(self):
+        """
+        You can count filtered records.
+        """
+        engine = yield self.engine()
+        crud = Crud(Readset(families), Sanitizer(families))
+        for i in xrange(14):
+            yield crud.create(engine, {'surname': str(i)})
+
+        count = yield crud.count(engine, families.c.surname == '12')
+        self.assertEqual(count, 1)
+
+
+    @defer.inlineCallbacks
+    def test_count_references(self):
+        """
+        References to one thing aren't joined when counting unless the where
+        clause needs them.  Other references are.
+        """
+        engine = yield self.engine()
+        fam_crud = Crud(Readset(families), Sanitizer(families))
+        johnson = yield fam_crud.create(engine, {'surname': 'Johnson'})
+        yield fam_crud.create(engine, {'surname': 'Johnson'})
+        people_crud = Crud(Readset(people), Sanitizer(people))
+        yield people_crud.create(engine, {'family_id': johnson['id']})
+        yield people_crud.create(engine, {'family_id': johnson['id']})
+        yield people_crud.create(engine, {})
+
+        crud = Crud(Readset(people, references={
+            'family': Ref(Readset(families),
+                          people.c.family_id == families.c.id),
+        }), Sanitizer(people))
+        self.assertNotIn('JOIN', str(crud._countQuery()))
+        count = yield crud.count(engine)
+        self.assertEqual(count, 3)
+
+        where = families.c.surname == 'Johnson'
+        self.assertIn('JOIN', str(crud._countQuery(where)))
+        count = yield crud.count(engine, where)
+        self.assertEqual(count, 2)
+
+        # a (badly declared) reference that can match several rows
+        crud = Crud(Readset(families, references={
+            'member': Ref(Readset(people),
+                          people.c.family_id == families.c.id),
+        }), Sanitizer(families))
+        self.assertIn('JOIN', str(crud._countQuery()))
+        count = yield crud.count(engine)
+        fams = yield crud.fetch(engine)
+        self.assertEqual(count, len(fams))
+
+
+    def test_ref_toOne(self):
+        """
+        Whether a reference is to one thing is guessed from the join,
+        unless declared.
+        """
+        ref = Ref(Readset(families), people.c.family_id == families.c.id)
+        self.assertTrue(ref.to_one)
+        ref = Ref(Readset(families), families.c.id == people.c.family_id)
+        self.assertTrue(ref.to_one)
+        ref = Ref(Readset(people), people.c.family_id == families.c.id)
+        self.assertFalse(ref.to_one)
+        ref = Ref(Readset(people), people.c.family_id == families.c.id,
+                  to_one=True)
+        self.assertTrue(ref.to_one)
+        ref = Ref(Readset(families), people.c.family_id == families.c.id,
+                  to_one=False)
+        self.assertFalse(ref.to_one)
+        ref = Ref(Readset(pets), pets.c.family_id == families.c.id,
+                  multiple=True)
+        self.assertFalse(ref.to_one)
+
+
+    @defer.inlineCallbacks
+    def test_count_fixed(self):
+        """
+        The count is restricted by fixed attributes.
+        """
+        engine = yield self.engine()
+        crud = Crud(Readset(families), Sanitizer(families))
+        yield crud.create(engine, {'surname': 'Jones'})
+        yield crud.create(engine, {'surname': 'Arnold'})
+
+        crud2 = crud.fix({'surname': 'Arnold'})
+        count = yield crud2.count(engine)
+        self.assertEqual(count, 1)
+
+
+    @defer.inlineCallbacks
+    def test_update(self):
+        """
+        You can update sets.
+        """
+        engine = yield self.engine()
+        crud = Crud(Readset(families), Sanitizer(families))
+        yield crud.create(engine, {'surname': 'Jones'})
+        fams = yield crud.update(engine, {'surname': 'Jamison'})
+        self.assertEqual(len(fams), 1)
+        self.assertEqual(fams[0]['surname'], 'Jamison')
+
+
+    @defer.inlineCallbacks
+    def test_update_noLongerMatching(self):
+        """
+        The updated records are returned even if they no longer match the
+        where clause, as they are with RETURNING.
+        """
+        engine = yield self.engine()
+        crud = Crud(Readset(families), Sanitizer(families))
+        jones = yield crud.create(engine, {'surname': 'Jones'})
+        yield crud.create(engine, {'surname': 'Smith'})
+        yield crud.create(engine, {'surname': 'Jones'})
+
+        fams = yield crud.update(engine, {'surname': 'Brown'},
+                                 families.c.surname == 'Jones')
+        self.assertEqual([(x['id'], x['surname']) for x in fams],
+                         [(jones['id'], 'Brown'), (jones['id'] + 2, 'Brown')])
+        count = yield crud.count(engine, families.c.surname == 'Brown')
+        self.assertEqual(count, 2)
+
+
+    @defer.inlineCallbacks
+    def test_update_fixed(self):
+        """
+        Fixed attributes are part of the update.
+        """
+        engine = yield self.engine()
+        crud = Crud(Readset(families), Sanitizer(families))
+        yield crud.create(engine, {'surname': 'Jones', 'location': 'anvilania'})
+        yield crud.create(engine, {'surname': 'James', 'location': 'gotham'})
+
+        crud2 = crud.fix({'surname': 'James'})
+        yield crud2.update(engine, {'location': 'middle earth'})
+
+        fams = yield crud.fetch(engine, families.c.surname == u'Jones')
+        self.assertEqual(fams[0]['location'], 'anvilania')
+
+        fams = yield crud.fetch(engine, families.c.surname == u'James')
+        self.assertEqual(fams[0]['location'], 'middle earth')
+
+
+    @defer.inlineCallbacks
+    def test_update_fixedNoChange(self):
+        """
+        You aren't allowed to update the fixed attributes.
+        """
+        engine = yield self.engine()
+        crud = Crud(Readset(families), Sanitizer(families))
+        yield crud.create(engine, {'surname': 'Jones', 'location': 'bar'})
+
+        crud2 = crud.fix({'surname': 'Jones'})
+        fams = yield crud2.update(engine, {'surname': 'Allison',
+                                           'location': 'hawaii'})
+        fam = fams[0]
+        self.assertEqual(fam['surname'], 'Jones', "Should keep fixed value")
+
+
+    @defer.inlineCallbacks
+    def test_update_nothing(self):
+        """
+        It's a no-op to update nothing.
+        """
+        engine = yield self.engine()
+        crud = Crud(Readset(families), Sanitizer(families))
+        yield crud.create(engine, {'surname': 'Jones'})
+        fams = yield crud.update(engine, {})
+        fam = fams[0]
+        self.assertEqual(fam['surname'], 'Jones')
+
+
+    @defer.inlineCallbacks
+    def test_update_allFixed(self):
+        """
+        All the fixed attributes should be taken into consideration.
+        """
+        engine = yield self.engine()
+        crud = Crud(Readset(pets), Sanitizer(pets))
+        yield crud.create(engine, {'name': 'Jones', 'family_id': 1})
+        yield crud.create(engine, {'name': 'James', 'family_id': 20})
+        yield crud.create(engine, {'name': 'Jones', 'family_id': 20})
+        yield crud.create(engine, {'name': 'James', 'family_id': 1})
+
+        crud2 = crud.fix({'name': 'James', 'family_id': 20})
+        yield crud2.update(engine, {'owner_id': -1})
+
+        fams = yield crud.fetch(engine)
+        actual = set()
+        for fam in fams:
+            actual.add((fam['owner_id'], fam['name'], fam['family_id']))
 
         expected = set([
             (None, 'Jones', 1),
@@ -438,7 +1384,161 @@ class CrudTest(TestCase):
             (None, 'Jones', 20),
             (None, 'James', 1),
         ])
-        self.assertEqual(actual, expected, "Should only change the one thing")
+        self.assertEqual(actual, expected, "Should only change the one thing")
+
+
+    @defer.inlineCallbacks
+    def test_update_noReturn(self):
+        """
+        You can update without reading the records back.
+        """
+        engine = yield self.engine()
+        crud = Crud(Readset(families), Sanitizer(families))
+        yield crud.create(engine, {'surname': 'Jones'})
+
+        executed = countQueries(engine)
+        result = yield crud.update(engine, {'surname': 'Jamison'},
+                                   return_rows=False)
+        self.assertEqual(result, None)
+        self.assertEqual(len(executed), 1, "Should only update")
+
+        fams = yield crud.fetch(engine)
+        self.assertEqual(fams[0]['surname'], 'Jamison')
+
+
+    @defer.inlineCallbacks
+    def test_updateMany(self):
+        """
+        You can update several records by primary key, each with different
+        values.
+        """
+        engine = yield self.engine()
+        crud = Crud(Readset(families), Sanitizer(families))
+        fams = yield crud.createMany(engine, [
+            {'surname': str(i)} for i in xrange(5)])
+
+        executed = countQueries(engine)
+        updated = yield crud.updateMany(engine, [
+            {'id': fams[3]['id'], 'surname': 'Three'},
+            {'id': fams[0]['id'], 'surname': 'Zero'},
+            {'id': fams[1]['id'], 'location': 'Nowhere'},
+            {'id': fams[2]['id'], 'surname': 'Two'},
+        ])
+        self.assertEqual(len(executed), 3, "Should run one executemany for "
+                         "each set of changed fields and one read back")
+        self.assertEqual([x['id'] for x in updated],
+                         [fams[i]['id'] for i in [3, 0, 1, 2]])
+        self.assertEqual([x['surname'] for x in updated],
+                         ['Three', 'Zero', '1', 'Two'])
+        self.assertEqual(updated[2]['location'], 'Nowhere')
+
+        fams = yield crud.fetch(engine, order=families.c.id)
+        self.assertEqual([x['surname'] for x in fams],
+                         ['Zero', '1', 'Two', 'Three', '4'])
+
+
+    @defer.inlineCallbacks
+    def test_updateMany_fixed(self):
+        """
+        Fixed attributes can't be changed and records outside of them
+        aren't updated.
+        """
+        engine = yield self.engine()
+        crud = Crud(Readset(families), Sanitizer(families))
+        jones = yield crud.create(engine, {'surname': 'Jones',
+                                           'location': 'Here'})
+        smith = yield crud.create(engine, {'surname': 'Smith',
+                                           'location': 'There'})
+
+        here = crud.fix({'location': 'Here'})
+        updated = yield here.updateMany(engine, [
+            {'id': jones['id'], 'surname': 'Jamison', 'location': 'There'},
+            {'id': smith['id'], 'surname': 'Smithers'},
+        ])
+        self.assertEqual(updated, [{'id': jones['id'], 'surname': 'Jamison',
+                                    'location': 'Here'}])
+
+        smith = yield crud.getOne(engine, families.c.id == smith['id'])
+        self.assertEqual(smith['surname'], 'Smith')
+
+
+    @defer.inlineCallbacks
+    def test_updateMany_sanitize(self):
+        """
+        Each item is sanitized as an update scoped to its record.
+        """
+        engine = yield self.engine()
+        called = []
+        class Foo(object):
+            sanitizer = Sanitizer(families)
+            @sanitizer.sanitizeData
+            def sani(self, context, data):
+                called.append(context)
+                data['surname'] = data['surname'].upper()
+                return data
+
+        crud = Crud(Readset(families), Foo().sanitizer)
+        fams = yield crud.createMany(engine, [
+            {'surname': 'a'}, {'surname': 'b'}])
+        del called[:]
+
+        updated = yield crud.updateMany(engine, [
+            {'id': fams[0]['id'], 'surname': 'c'},
+            {'id': fams[1]['id'], 'surname': 'd'},
+        ])
+        self.assertEqual([x['surname'] for x in updated], ['C', 'D'])
+        self.assertEqual([x.action for x in called], ['update', 'update'])
+
+        result = yield engine.execute(called[1].query)
+        rows = yield result.fetchall()
+        self.assertEqual([x[0] for x in rows], [fams[1]['id']],
+                         "The query should match the record being updated")
+
+
+    @defer.inlineCallbacks
+    def test_updateMany_invalid(self):
+        """
+        Every item is sanitized before any is updated, so an invalid one
+        leaves every record as it was.
+        """
+        engine = yield self.engine()
+        class Foo(object):
+            sanitizer = Sanitizer(families)
+            @sanitizer.sanitizeField('surname')
+            def surname(self, context, data, field):
+                if not data[field]:
+                    raise ValueError('empty surname')
+                return data[field]
+
+        crud = Crud(Readset(families), Foo().sanitizer)
+        fams = yield crud.createMany(engine, [
+            {'surname': 'a'}, {'surname': 'b'}, {'surname': 'c'}])
+        executed = countQueries(engine)
+        yield self.assertFailure(crud.updateMany(engine, [
+            {'id': fams[0]['id'], 'surname': 'x'},
+            {'id': fams[1]['id'], 'surname': 'y'},
+            {'id': fams[2]['id'], 'surname': ''},
+        ], batch_size=2), ValueError)
+        self.assertEqual(executed, [])
+        yield self.assertFailure(crud.updateMany(engine, [
+            {'id': fams[0]['id'], 'surname': 'x'},
+            {'id': fams[1]['id'], 'surname': 'y'},
+            {'surname': 'z'},
+        ], batch_size=2), MissingRequiredFields)
+        self.assertEqual(executed, [])
+        after = yield crud.fetch(engine)
+        self.assertEqual(after, fams)
+
+
+    @defer.inlineCallbacks
+    def test_updateMany_missingPrimaryKey(self):
+        """
+        Every item must have a primary key.
+        """
+        engine = yield self.engine()
+        crud = Crud(Readset(families), Sanitizer(families))
+        yield self.assertFailure(crud.updateMany(engine, [
+            {'surname': 'Jones'}]), MissingRequiredFields)
 
 
     @defer.inlineCallbacks
@@ -560,6 +1660,109 @@ class CrudTest(TestCase):
         self.assertEqual(len(fams), 1, "Should have deleted Arnold")
 
 
+    @defer.inlineCallbacks
+    def test_cache(self):
+        """
+        With a cache, repeated fetches and counts don't hit the database
+        until something is written.
+        """
+        engine = yield self.engine()
+        cache = QueryCache()
+        crud = Crud(Readset(families), Sanitizer(families), cache=cache)
+        jones = yield crud.create(engine, {'surname': 'Jones'})
+
+        executed = countQueries(engine)
+        fams = yield crud.fetch(engine)
+        self.assertEqual(fams, [jones])
+        fams[0]['surname'] = 'changed'
+        fams = yield crud.fetch(engine)
+        self.assertEqual(fams, [jones], "Should return a copy")
+        count = yield crud.count(engine)
+        count = yield crud.count(engine)
+        self.assertEqual(count, 1)
+        one = yield crud.getOne(engine, families.c.id == jones['id'])
+        one = yield crud.getOne(engine, families.c.id == jones['id'])
+        self.assertEqual(one, jones)
+        self.assertEqual(len(executed), 3)
+        self.assertEqual((cache.hits, cache.misses), (3, 3))
+
+        smith = yield crud.create(engine, {'surname': 'Smith'})
+        fams = yield crud.fetch(engine)
+        self.assertEqual(fams, [jones, smith])
+
+
+    @defer.inlineCallbacks
+    def test_cache_uncompiled(self):
+        """
+        Reads the statement cache can't compile (such as ones with
+        subqueries or text) are cached too.
+        """
+        engine = yield self.engine()
+        cache = QueryCache()
+        crud = Crud(Readset(families), Sanitizer(families), cache=cache)
+        jones = yield crud.create(engine, {'surname': 'Jones'})
+        executed = countQueries(engine)
+        for where in [families.c.id.in_(select([families.c.id])),
+                      text("surname = 'Jones'")]:
+            fams = yield crud.fetch(engine, where)
+            fams = yield crud.fetch(engine, where)
+            self.assertEqual(fams, [jones])
+            count = yield crud.count(engine, where)
+            self.assertEqual(count, 1)
+        self.assertEqual(len(executed), 4)
+        self.assertEqual(cache.hits, 2)
+
+
+    @defer.inlineCallbacks
+    def test_cache_fixed(self):
+        """
+        Fixed attributes are part of the cache key and fixed Cruds share the
+        cache.
+        """
+        engine = yield self.engine()
+        crud = Crud(Readset(families), Sanitizer(families), cache=QueryCache())
+        jones = crud.fix({'surname': 'Jones'})
+        smith = crud.fix({'surname': 'Smith'})
+        self.assertIdentical(jones.cache, crud.cache)
+        yield jones.create(engine, {})
+
+        fams = yield jones.fetch(engine)
+        self.assertEqual(len(fams), 1)
+        fams = yield smith.fetch(engine)
+        self.assertEqual(len(fams), 0)
+
+
+    @defer.inlineCallbacks
+    def test_cache_invalidatedByOtherCruds(self):
+        """
+        Writes through any Crud invalidate cached reads of the tables they
+        write to, including referenced tables.
+        """
+        engine = yield self.engine()
+        fam_crud = Crud(Readset(families), Sanitizer(families))
+        pet_crud = Crud(Readset(pets), Sanitizer(pets))
+        crud = Crud(Readset(families, references={
+            'pets': Ref(Readset(pets), pets.c.family_id == families.c.id,
+                multiple=True),
+        }), Sanitizer(families), cache=QueryCache())
+        jones = yield fam_crud.create(engine, {'surname': 'Jones'})
+
+        fams = yield crud.fetch(engine)
+        self.assertEqual(fams[0]['pets'], [])
+
+        yield pet_crud.create(engine, {'family_id': jones['id']})
+        fams = yield crud.fetch(engine)
+        self.assertEqual(len(fams[0]['pets']), 1)
+
+        yield fam_crud.update(engine, {'surname': 'Jamison'})
+        fams = yield crud.fetch(engine)
+        self.assertEqual(fams[0]['surname'], 'Jamison')
+
+        yield fam_crud.delete(engine)
+        fams = yield crud.fetch(engine)
+        self.assertEqual(fams, [])
+
+
     @defer.inlineCallbacks
     def test_references_null(self):
         """
@@ -572,105 +1775,409 @@ class CrudTest(TestCase):
                           people.c.family_id == families.c.id),
         }), Sanitizer(people))
 
-        yield crud.create(engine, {'name': 'Sam'})
-        peeps = yield crud.fetch(engine, )
-        self.assertEqual(len(peeps), 1)
-        sam = peeps[0]
-        self.assertEqual(sam['family'], None, str(sam))
-        self.assertEqual(sam['name'], 'Sam')
+        yield crud.create(engine, {'name': 'Sam'})
+        peeps = yield crud.fetch(engine, )
+        self.assertEqual(len(peeps), 1)
+        sam = peeps[0]
+        self.assertEqual(sam['family'], None, str(sam))
+        self.assertEqual(sam['name'], 'Sam')
+
+
+    @defer.inlineCallbacks
+    def test_references_notNull(self):
+        """
+        You can nest objects by reference.
+        """
+        engine = yield self.engine()
+        fam_crud = Crud(Readset(families), Sanitizer(families))
+        family = yield fam_crud.create(engine, {'surname': 'Jones'})
+
+        crud = Crud(Readset(people, references={
+            'family': Ref(Readset(families), people.c.family_id == families.c.id),
+        }), Sanitizer(people))
+        sam = yield crud.create(engine, {'name': 'Sam', 'family_id': family['id']})
+        self.assertEqual(sam['family'], family)
+
+
+    @defer.inlineCallbacks
+    def test_references_multiple(self):
+        """
+        You can have multiple references.
+        """
+        engine = yield self.engine()
+        fam_crud = Crud(Readset(families), Sanitizer(families))
+        johnson = yield fam_crud.create(engine, {'surname': 'Johnson'})
+
+        person_crud = Crud(Readset(people), Sanitizer(people))
+        john = yield person_crud.create(engine, {
+            'family_id': johnson['id'],
+            'name': 'John',
+        })
+
+        pets_crud = Crud(Readset(pets, references={
+            'family': Ref(Readset(families), pets.c.family_id == families.c.id),
+            'owner': Ref(Readset(people), pets.c.owner_id == people.c.id),
+        }), Sanitizer(pets))
+
+        cat = yield pets_crud.create(engine, {
+            'family_id': johnson['id'],
+            'name': 'cat',
+            'owner_id': john['id'],
+        })
+        self.assertEqual(cat['name'], 'cat')
+        self.assertEqual(cat['family'], johnson)
+        self.assertEqual(cat['owner'], john)
+
+        dog = yield pets_crud.create(engine, {
+            'name': 'dog',
+            'owner_id': john['id']
+        })
+        self.assertEqual(dog['name'], 'dog')
+        self.assertEqual(dog['owner'], john)
+        self.assertEqual(dog['family'], None)
+
+        fish = yield pets_crud.create(engine, {
+            'name': 'bob',
+            'family_id': johnson['id'],
+        })
+        self.assertEqual(fish['name'], 'bob')
+        self.assertEqual(fish['owner'], None)
+        self.assertEqual(fish['family'], johnson)
+
+
+    @defer.inlineCallbacks
+    def test_references_list(self):
+        """
+        You can reference a list of things.
+        """
+        engine = yield self.engine()
+        pet_crud = Crud(Readset(pets), Sanitizer(pets))
+        fam_crud = Crud(Readset(families, references={
+            'pets': Ref(Readset(pets), pets.c.family_id == families.c.id,
+                multiple=True),
+        }), Sanitizer(families))
+
+        johnson = yield fam_crud.create(engine, {'surname': 'Johnson'})
+        self.assertEqual(johnson['pets'], [])
+
+        cat = yield pet_crud.create(engine, {
+            'family_id': johnson['id'],
+            'name': 'cat'})
+
+        johnson_crud = fam_crud.fix({'id': johnson['id']})
+        johnson = yield johnson_crud.getOne(engine)
+        self.assertEqual(johnson['pets'], [cat])
+
+        dog = yield pet_crud.create(engine, {
+            'family_id': johnson['id'],
+            'name': 'dog'})
+        johnson = yield johnson_crud.getOne(engine)
+        self.assertIn(dog, johnson['pets'])
+        self.assertIn(cat, johnson['pets'])
+
+
+    @defer.inlineCallbacks
+    def test_references_list_batched(self):
+        """
+        The lists of referenced things are loaded for all the fetched records
+        with a single query rather than one query per record.
+        """
+        engine = yield self.engine()
+        pet_crud = Crud(Readset(pets), Sanitizer(pets))
+        fam_crud = Crud(Readset(families, references={
+            'pets': Ref(Readset(pets), pets.c.family_id == families.c.id,
+                multiple=True),
+        }), Sanitizer(families))
+
+        expected = {}
+        for i in xrange(5):
+            fam = yield fam_crud.create(engine, {'surname': str(i)})
+            expected[fam['id']] = []
+            for j in xrange(i):
+                pet = yield pet_crud.create(engine, {
+                    'family_id': fam['id'],
+                    'name': '%d-%d' % (i, j)})
+                expected[fam['id']].append(pet)
+
+        executed = countQueries(engine)
+        fams = yield fam_crud.fetch(engine)
+        self.assertEqual(len(executed), 2, "Should run one query for the "
+                         "families and one for all their pets")
+        self.assertEqual(len(fams), 5)
+        for fam in fams:
+            self.assertEqual(sorted(fam['pets']), sorted(expected[fam['id']]))
+
+
+    @defer.inlineCallbacks
+    def test_references_list_chunked(self):
+        """
+        The lists of referenced things are loaded in chunks of
+        multi_ref_chunk_size parent records.
+        """
+        engine = yield self.engine()
+        pet_crud = Crud(Readset(pets), Sanitizer(pets))
+        fam_crud = Crud(Readset(families, references={
+            'pets': Ref(Readset(pets), pets.c.family_id == families.c.id,
+                multiple=True),
+        }), Sanitizer(families))
+        fam_crud.multi_ref_chunk_size = 2
+
+        for i in xrange(5):
+            fam = yield fam_crud.create(engine, {'surname': str(i)})
+            yield pet_crud.create(engine, {'family_id': fam['id'],
+                                           'name': str(i)})
+
+        executed = countQueries(engine)
+        fams = yield fam_crud.fetch(engine)
+        self.assertEqual(len(executed), 4, "Should run one query for the "
+                         "families and three for their pets")
+        for fam in fams:
+            self.assertEqual([x['name'] for x in fam['pets']],
+                             [fam['surname']])
+
+
+    @defer.inlineCallbacks
+    def test_references_lazy(self):
+        """
+        Lazy lists of referenced things aren't fetched until loaded, and
+        then they are fetched for every record at once.
+        """
+        engine = yield self.engine()
+        pet_crud = Crud(Readset(pets), Sanitizer(pets))
+        fam_crud = Crud(Readset(families, references={
+            'pets': Ref(Readset(pets), pets.c.family_id == families.c.id,
+                multiple=True, lazy=True),
+        }), Sanitizer(families))
+
+        cats = []
+        for i in xrange(3):
+            fam = yield fam_crud.create(engine, {'surname': str(i)})
+            cat = yield pet_crud.create(engine, {'family_id': fam['id'],
+                                                 'name': 'cat'})
+            cats.append(cat)
+
+        executed = countQueries(engine)
+        fams = yield fam_crud.fetch(engine, order=families.c.id)
+        self.assertEqual(len(executed), 1, "Should not fetch the pets yet")
+        self.assertTrue(isinstance(fams[0]['pets'], LazyList))
+        self.assertFalse(fams[0]['pets'].loaded)
+        self.assertRaises(NotLoaded, len, fams[0]['pets'])
+
+        d1 = fams[1]['pets'].load()
+        d2 = fams[2]['pets'].load()
+        pets1 = yield d1
+        pets2 = yield d2
+        self.assertEqual(len(executed), 2, "Should fetch all the pets at once")
+        self.assertEqual(pets1, [cats[1]])
+        self.assertEqual(pets2, [cats[2]])
+
+        self.assertTrue(fams[0]['pets'].loaded)
+        self.assertEqual(fams[0]['pets'], [cats[0]])
+        self.assertEqual(list(fams[0]['pets']), [cats[0]])
+        self.assertIn(cats[0], fams[0]['pets'])
+        pets0 = yield fams[0]['pets'].load()
+        self.assertEqual(pets0, [cats[0]])
+        self.assertEqual(len(executed), 2)
+
+
+    @defer.inlineCallbacks
+    def test_references_lazyError(self):
+        """
+        If loading fails, every waiting load fails and you can try again.
+        """
+        engine = yield self.engine()
+        fam_crud = Crud(Readset(families, references={
+            'pets': Ref(Readset(pets), pets.c.family_id == families.c.id,
+                multiple=True, lazy=True),
+        }), Sanitizer(families))
+        yield fam_crud.create(engine, {'surname': 'Jones'})
+        yield fam_crud.create(engine, {'surname': 'Smith'})
+        fams = yield fam_crud.fetch(engine)
+
+        real_execute = engine.execute
+        engine.execute = lambda *args: defer.fail(ValueError('foo'))
+        d1 = fams[0]['pets'].load()
+        d2 = fams[1]['pets'].load()
+        yield self.assertFailure(d1, ValueError)
+        yield self.assertFailure(d2, ValueError)
+
+        engine.execute = real_execute
+        loaded = yield fams[0]['pets'].load()
+        self.assertEqual(loaded, [])
+
+
+    @defer.inlineCallbacks
+    def test_records(self):
+        """
+        With C{records=True}, you get L{Record}s instead of dictionaries.
+        Their fields can be read as attributes or items.
+        """
+        engine = yield self.engine()
+        crud = Crud(Readset(families), Sanitizer(families), records=True)
+        fam = yield crud.create(engine, {'surname': 'Jones'})
+        self.assertTrue(isinstance(fam, Record))
+        self.assertEqual(fam.surname, 'Jones')
+        self.assertEqual(fam['surname'], 'Jones')
+        self.assertEqual(fam.location, None)
+        self.assertEqual(sorted(fam.keys()), ['id', 'location', 'surname'])
+        self.assertEqual(len(fam), 3)
+        self.assertIn('surname', fam)
+        self.assertEqual(fam.get('foo', 'bar'), 'bar')
+        self.assertEqual(fam, {'id': fam.id, 'location': None,
+                               'surname': 'Jones'})
+        self.assertEqual(fam.to_dict(), {'id': fam.id, 'location': None,
+                                         'surname': 'Jones'})
+
+        fam['surname'] = 'Smith'
+        self.assertEqual(fam.surname, 'Smith')
+        self.assertRaises(AttributeError, setattr, fam, 'foo', 'bar')
+
+        fams = yield crud.fetch(engine)
+        self.assertEqual(fams, [{'id': fam.id, 'location': None,
+                                 'surname': 'Jones'}])
 
 
     @defer.inlineCallbacks
-    def test_references_notNull(self):
+    def test_records_references(self):
         """
-        You can nest objects by reference.
+        Referenced rows are records, too, and L{Record.to_dict} turns them
+        all back into dictionaries.
         """
         engine = yield self.engine()
         fam_crud = Crud(Readset(families), Sanitizer(families))
         family = yield fam_crud.create(engine, {'surname': 'Jones'})
-
         crud = Crud(Readset(people, references={
-            'family': Ref(Readset(families), people.c.family_id == families.c.id),
-        }), Sanitizer(people))
-        sam = yield crud.create(engine, {'name': 'Sam', 'family_id': family['id']})
-        self.assertEqual(sam['family'], family)
+            'family': Ref(Readset(families),
+                          people.c.family_id == families.c.id),
+        }), Sanitizer(people), table_attr='_object', records=True)
+        sam = yield crud.create(engine, {'name': 'Sam',
+                                         'family_id': family['id']})
+        john = yield crud.create(engine, {'name': 'John'})
+
+        self.assertEqual(sam._object, 'people')
+        self.assertTrue(isinstance(sam.family, Record))
+        self.assertEqual(sam.family.surname, 'Jones')
+        self.assertEqual(sam.family._object, 'family')
+        self.assertEqual(john.family, None)
+        family['_object'] = 'family'
+        self.assertEqual(sam.to_dict()['family'], family)
+        self.assertEqual(type(sam.to_dict()['family']), dict)
 
 
     @defer.inlineCallbacks
-    def test_references_multiple(self):
+    def test_records_multiple(self):
         """
-        You can have multiple references.
+        Multiple references are lists of records.
         """
         engine = yield self.engine()
-        fam_crud = Crud(Readset(families), Sanitizer(families))
-        johnson = yield fam_crud.create(engine, {'surname': 'Johnson'})
-
-        person_crud = Crud(Readset(people), Sanitizer(people))
-        john = yield person_crud.create(engine, {
-            'family_id': johnson['id'],
-            'name': 'John',
-        })
+        pet_crud = Crud(Readset(pets), Sanitizer(pets))
+        fam_crud = Crud(Readset(families, references={
+            'pets': Ref(Readset(pets), pets.c.family_id == families.c.id,
+                multiple=True),
+        }), Sanitizer(families), records=True)
+        fam = yield fam_crud.create(engine, {'surname': 'Jones'})
+        cat = yield pet_crud.create(engine, {'family_id': fam.id,
+                                             'name': 'cat'})
+        fam = yield fam_crud.getOne(engine)
+        self.assertEqual(fam.pets[0].name, 'cat')
+        self.assertEqual(fam.pets, [cat])
+        self.assertEqual(fam.to_dict()['pets'], [cat])
 
-        pets_crud = Crud(Readset(pets, references={
-            'family': Ref(Readset(families), pets.c.family_id == families.c.id),
-            'owner': Ref(Readset(people), pets.c.owner_id == people.c.id),
-        }), Sanitizer(pets))
 
-        cat = yield pets_crud.create(engine, {
-            'family_id': johnson['id'],
-            'name': 'cat',
-            'owner_id': john['id'],
-        })
-        self.assertEqual(cat['name'], 'cat')
-        self.assertEqual(cat['family'], johnson)
-        self.assertEqual(cat['owner'], john)
+    @defer.inlineCallbacks
+    def test_records_cache(self):
+        """
+        Cached records are copied like dictionaries are.
+        """
+        engine = yield self.engine()
+        crud = Crud(Readset(families), Sanitizer(families),
+                    cache=QueryCache(), records=True)
+        yield crud.create(engine, {'surname': 'Jones'})
+        fams = yield crud.fetch(engine)
+        fams[0]['surname'] = 'changed'
+        fams = yield crud.fetch(engine)
+        self.assertEqual(crud.cache.hits, 1)
+        self.assertEqual(fams[0].surname, 'Jones')
 
-        dog = yield pets_crud.create(engine, {
-            'name': 'dog',
-            'owner_id': john['id']
-        })
-        self.assertEqual(dog['name'], 'dog')
-        self.assertEqual(dog['owner'], john)
-        self.assertEqual(dog['family'], None)
 
-        fish = yield pets_crud.create(engine, {
-            'name': 'bob',
-            'family_id': johnson['id'],
-        })
-        self.assertEqual(fish['name'], 'bob')
-        self.assertEqual(fish['owner'], None)
-        self.assertEqual(fish['family'], johnson)
+    @defer.inlineCallbacks
+    def test_records_fix(self):
+        """
+        Fixed and projected L{Crud}s make records too.
+        """
+        engine = yield self.engine()
+        crud = Crud(Readset(families), Sanitizer(families), records=True)
+        crud = crud.fix({'surname': 'Jones'})
+        yield crud.create(engine, {})
+        fams = yield crud.fetch(engine, fields=['surname'])
+        self.assertEqual(fams[0].surname, 'Jones')
+        self.assertEqual(fams[0].keys(), ['surname'])
 
 
     @defer.inlineCallbacks
-    def test_references_list(self):
+    def test_instrument(self):
         """
-        You can reference a list of things.
+        Each operation reports an event with its time, the number of
+        statements it took, the number of records and the time spent
+        sanitizing.
         """
+        now = [0.0]
+        self.patch(instrument, '_now', lambda: now[0])
+
+        class SlowSanitizer(object):
+            table = families
+            def sanitize(self, context, data):
+                now[0] += 0.5
+                return data
+
         engine = yield self.engine()
-        pet_crud = Crud(Readset(pets), Sanitizer(pets))
-        fam_crud = Crud(Readset(families, references={
+        events = []
+        crud = Crud(Readset(families, references={
             'pets': Ref(Readset(pets), pets.c.family_id == families.c.id,
                 multiple=True),
-        }), Sanitizer(families))
-
-        johnson = yield fam_crud.create(engine, {'surname': 'Johnson'})
-        self.assertEqual(johnson['pets'], [])
-
-        cat = yield pet_crud.create(engine, {
-            'family_id': johnson['id'],
-            'name': 'cat'})
+        }), SlowSanitizer(), instrument=events.append)
+
+        fam = yield crud.create(engine, {'surname': 'Jones'})
+        yield crud.fetch(engine)
+        yield crud.getOne(engine, fields=['surname'])
+        yield crud.count(engine)
+        yield crud.fix({'surname': 'Jones'}).update(engine,
+                                                    {'location': 'here'})
+        yield crud.delete(engine, families.c.id == fam['id'])
+        engine.execute = lambda *args: defer.fail(ValueError('foo'))
+        yield self.assertFailure(crud.fetch(engine), ValueError)
+
+        self.assertEqual([(x.source, x.operation, x.statements, x.rows)
+                          for x in events], [
+            (crud, 'create', 3, 1),
+            (crud, 'fetch', 2, 1),
+            (crud, 'getOne', 1, 1),
+            (crud, 'count', 1, None),
+            (crud, 'update', 4, 1),
+            (crud, 'delete', 1, None),
+            (crud, 'fetch', 1, None),
+        ])
+        self.assertTrue(events[-1].failure.check(ValueError))
+        self.assertEqual(events[0].sanitize_seconds, 0.5)
+        self.assertEqual(events[0].seconds, 0.5)
+        self.assertEqual(events[1].sanitize_seconds, 0.0)
 
-        johnson_crud = fam_crud.fix({'id': johnson['id']})
-        johnson = yield johnson_crud.getOne(engine)
-        self.assertEqual(johnson['pets'], [cat])
 
-        dog = yield pet_crud.create(engine, {
-            'family_id': johnson['id'],
-            'name': 'dog'})
-        johnson = yield johnson_crud.getOne(engine)
-        self.assertIn(dog, johnson['pets'])
-        self.assertIn(cat, johnson['pets'])
+    @defer.inlineCallbacks
+    def test_instrument_histograms(self):
+        """
+        L{Histograms} keep latency histograms per L{Crud} and operation.
+        """
+        engine = yield self.engine()
+        stats = Histograms()
+        crud = Crud(Readset(families), Sanitizer(families), instrument=stats)
+        for i in xrange(3):
+            yield crud.create(engine, {'surname': str(i)})
+        yield crud.fetch(engine)
+        self.assertEqual(stats.get(crud, 'create').count, 3)
+        self.assertEqual(stats.get(crud, 'create').statements, 6)
+        self.assertEqual(stats.get(crud, 'fetch').rows, 3)
+        self.assertEqual(stats.get(crud, 'fetch').count, 1)
 
 
     @defer.inlineCallbacks
@@ -779,6 +2286,22 @@ class ReadsetTest(TestCase):
 
 
 
+    def test_project(self):
+        """
+        You can make a Readset with only some of the fields and references.
+        """
+        ref = Ref(Readset(families), people.c.family_id == families.c.id)
+        r = Readset(people, references={'family': ref})
+        p = r.project(['name', 'id', 'family.surname'])
+        self.assertEqual(p.table, people)
+        self.assertEqual(p.readable_columns, [people.c.id, people.c.name])
+        self.assertEqual(p.references.keys(), ['family'])
+        self.assertEqual(p.references['family'].readset.readable,
+                         set(['surname']))
+        self.assertIdentical(p.references['family'].join, ref.join)
+        self.assertRaises(NotReadable, r.project, ['foo'])
+
+
 class WritesetTest(TestCase):
 
 
@@ -884,6 +2407,21 @@ class PaginatorTest(TestCase):
         self.assertEqual(page2, monkeys[10:20])
 
 
+    @defer.inlineCallbacks
+    def test_page_fields(self):
+        """
+        You can choose which fields are in a page.
+        """
+        engine = yield self.engine()
+        crud = Crud(Readset(pets))
+        pager = Paginator(crud, page_size=2, order=pets.c.id)
+        for i in xrange(3):
+            yield crud.create(engine, {'name': str(i)})
+
+        page = yield pager.page(engine, 1, fields=['name'])
+        self.assertEqual(page, [{'name': '2'}])
+
+
     @defer.inlineCallbacks
     def test_page_where(self):
         """
@@ -911,6 +2449,117 @@ class PaginatorTest(TestCase):
         self.assertEqual(count, 1)
 
 
+    @defer.inlineCallbacks
+    def test_pageAfter(self):
+        """
+        You can page with a cursor rather than page numbers.
+        """
+        engine = yield self.engine()
+        crud = Crud(Readset(pets))
+        pager = Paginator(crud, page_size=10, order=pets.c.id)
+
+        monkeys = []
+        for i in xrange(25):
+            monkey = yield crud.create(engine, {'name': 'seamonkey %d' % (i,)})
+            monkeys.append(monkey)
+
+        page1, cursor = yield pager.pageAfter(engine)
+        self.assertEqual(page1, monkeys[:10])
+        self.assertNotEqual(cursor, None)
+
+        page2, cursor = yield pager.pageAfter(engine, cursor)
+        self.assertEqual(page2, monkeys[10:20])
+
+        page3, cursor = yield pager.pageAfter(engine, cursor)
+        self.assertEqual(page3, monkeys[20:])
+        self.assertEqual(cursor, None, "There are no more pages")
+
+
+    @defer.inlineCallbacks
+    def test_pageAfter_ties(self):
+        """
+        Records with the same value in the order columns are ordered by
+        primary key so that none are skipped or repeated.
+        """
+        engine = yield self.engine()
+        crud = Crud(Readset(pets))
+        pager = Paginator(crud, page_size=3, order=pets.c.name.desc())
+
+        for i in xrange(8):
+            yield crud.create(engine, {'name': 'pet %d' % (i % 3,)})
+
+        seen = []
+        page, cursor = yield pager.pageAfter(engine)
+        seen.extend(page)
+        while cursor is not None:
+            page, cursor = yield pager.pageAfter(engine, cursor)
+            seen.extend(page)
+
+        self.assertEqual(len(seen), 8)
+        self.assertEqual([x['name'] for x in seen],
+                         ['pet 2'] * 2 + ['pet 1'] * 3 + ['pet 0'] * 3)
+        self.assertEqual(len(set([x['id'] for x in seen])), 8)
+        for name in ['pet 0', 'pet 1', 'pet 2']:
+            ids = [x['id'] for x in seen if x['name'] == name]
+            self.assertEqual(ids, sorted(ids))
+
+
+    def test_pageAfter_seeks(self):
+        """
+        The page after a cursor is found by seeking an index on the first
+        order column rather than scanning it.
+        """
+        meta = MetaData()
+        things = Table('thing', meta,
+            Column('id', Integer, primary_key=True),
+            Column('name', String, index=True),
+        )
+        engine = create_engine('sqlite://')
+        meta.create_all(engine)
+        crud = Crud(Readset(things))
+        crud.createMany(engine, [{'name': str(i % 7)} for i in xrange(30)])
+        pager = Paginator(crud, page_size=4, order=things.c.name)
+
+        statements = []
+        event.listen(engine, 'before_cursor_execute',
+                     lambda conn, cursor, sql, params, context, many:
+                        statements.append((sql, params)))
+        seen = []
+        page, cursor = pager.pageAfter(engine)
+        seen.extend(page)
+        while cursor is not None:
+            page, cursor = pager.pageAfter(engine, cursor)
+            seen.extend(page)
+        self.assertEqual(len(set([x['id'] for x in seen])), 30)
+        self.assertEqual([x['name'] for x in seen],
+                         sorted([x['name'] for x in seen]))
+
+        sql, params = statements[-1]
+        plan = engine.execute('EXPLAIN QUERY PLAN ' + sql, params).fetchall()
+        self.assertIn('(name>?)', ' '.join([x['detail'] for x in plan]))
+
+
+    @defer.inlineCallbacks
+    def test_pageAfter_where(self):
+        """
+        You can filter cursor pages, too.
+        """
+        engine = yield self.engine()
+        crud = Crud(Readset(pets))
+        pager = Paginator(crud, page_size=2, order=[pets.c.name])
+
+        for name in ['thing 3', 'dog', 'thing 1', 'thing 2']:
+            yield crud.create(engine, {'name': name})
+
+        page1, cursor = yield pager.pageAfter(engine,
+            where=pets.c.name.startswith('thing'))
+        self.assertEqual([x['name'] for x in page1], ['thing 1', 'thing 2'])
+        page2, cursor = yield pager.pageAfter(engine, cursor,
+            where=pets.c.name.startswith('thing'))
+        self.assertEqual([x['name'] for x in page2], ['thing 3'])
+        self.assertEqual(cursor, None)
+
+
     @defer.inlineCallbacks
     def test_pageCount(self):
         """
@@ -929,6 +2578,101 @@ class PaginatorTest(TestCase):
         self.assertEqual(pages, 5)
 
 
+    @defer.inlineCallbacks
+    def test_instrument(self):
+        """
+        Paginators report their operations to their L{Crud}'s instrument
+        (or their own), and not the L{Crud} operations they use.
+        """
+        engine = yield self.engine()
+        events = []
+        crud = Crud(Readset(families), Sanitizer(families))
+        for i in xrange(3):
+            yield crud.create(engine, {'surname': str(i)})
+        crud.instrument = events.append
+        pager = Paginator(crud, page_size=2, order=families.c.id)
+        yield pager.page(engine, 0)
+        yield pager.pageCount(engine)
+        yield pager.pageAfter(engine)
+        yield pager.pageWithCount(engine, 1)
+
+        self.assertEqual([(x.source, x.operation, x.rows) for x in events], [
+            (pager, 'page', 2),
+            (pager, 'pageCount', None),
+            (pager, 'pageAfter', 2),
+            (pager, 'pageWithCount', 1),
+        ])
+
+        other = []
+        pager = Paginator(crud, page_size=2, instrument=other.append)
+        yield pager.page(engine, 0)
+        self.assertEqual(len(other), 1)
+
+
+    @defer.inlineCallbacks
+    def test_pageWithCount(self):
+        """
+        You can get a page and the page count with a single query.
+        """
+        engine = yield self.engine()
+        crud = Crud(Readset(pets))
+        pager = Paginator(crud, page_size=10, order=pets.c.id)
+
+        monkeys = []
+        for i in xrange(43):
+            monkey = yield crud.create(engine, {'name': 'seamonkey %d' % (i,)})
+            monkeys.append(monkey)
+
+        executed = countQueries(engine)
+        page, count = yield pager.pageWithCount(engine, 1)
+        self.assertEqual(page, monkeys[10:20])
+        self.assertEqual(count, 5)
+        self.assertEqual(len(executed), 1)
+
+        page, count = yield pager.pageWithCount(engine, 0,
+            pets.c.name.like('% 1%'))
+        self.assertEqual(page, [monkeys[1]] + monkeys[10:19])
+        self.assertEqual(count, 2)
+
+
+    @defer.inlineCallbacks
+    def test_pageWithCount_empty(self):
+        """
+        The count is right for empty sets and pages past the end.
+        """
+        engine = yield self.engine()
+        crud = Crud(Readset(pets))
+        pager = Paginator(crud, page_size=3, order=pets.c.id)
+
+        page, count = yield pager.pageWithCount(engine, 0)
+        self.assertEqual((page, count), ([], 0))
+
+        for i in xrange(4):
+            yield crud.create(engine, {})
+        page, count = yield pager.pageWithCount(engine, 5)
+        self.assertEqual((page, count), ([], 2))
+
+
+    @defer.inlineCallbacks
+    def test_pageWithCount_noWindowFunctions(self):
+        """
+        If the database doesn't do window functions, the page and count are
+        fetched separately.
+        """
+        engine = yield self.engine()
+        crud = Crud(Readset(pets))
+        pager = Paginator(crud, page_size=3, order=pets.c.id)
+        for i in xrange(4):
+            yield crud.create(engine, {})
+
+        self.patch(engine.dialect.dbapi, 'sqlite_version_info', (3, 24, 0))
+        executed = countQueries(engine)
+        page, count = yield pager.pageWithCount(engine, 1)
+        self.assertEqual(len(page), 1)
+        self.assertEqual(count, 2)
+        self.assertEqual(len(executed), 2)
+
+
     @defer.inlineCallbacks
     def test_pageCountForills(self):
         """
@@ -1144,6 +2888,73 @@ class SanitizerTest(TestCase):
                          "name wasn't present")
 
 
+    def test_synchronous(self):
+        """
+        If none of the sanitization functions return Deferreds, the data is
+        sanitized without waiting on any.
+        """
+        class Foo(object):
+            sanitizer = Sanitizer(pets)
+
+            @sanitizer.sanitizeData
+            def data(self, context, data):
+                data['family_id'] = 12
+                return data
+
+            @sanitizer.sanitizeField('name')
+            def name(self, context, data, field):
+                return data[field].upper()
+
+        sanitizer = Foo().sanitizer
+        output = sanitizer._sanitize(self.create_context, {'name': 'sam'})
+        self.assertEqual(output, {'name': 'SAM', 'family_id': 12})
+
+        output = self.successResultOf(sanitizer.sanitize(self.create_context,
+                                                         {'name': 'sam'}))
+        self.assertEqual(output, {'name': 'SAM', 'family_id': 12})
+
+
+    def test_synchronous_error(self):
+        """
+        Errors raised by synchronous sanitization functions are returned as
+        failed Deferreds from sanitize.
+        """
+        class Foo(object):
+            sanitizer = Sanitizer(pets)
+
+            @sanitizer.sanitizeField('name')
+            def name(self, context, data, field):
+                raise ValueError(data[field])
+
+        sanitizer = Foo().sanitizer
+        self.failureResultOf(sanitizer.sanitize(self.create_context,
+                                                {'name': 'sam'}), ValueError)
+
+
+    def test_deferred_midway(self):
+        """
+        If a sanitization function returns a Deferred, the following ones
+        wait for it.
+        """
+        d = defer.Deferred()
+        class Foo(object):
+            sanitizer = Sanitizer(pets)
+
+            @sanitizer.sanitizeData
+            def data(self, context, data):
+                return d
+
+            @sanitizer.sanitizeField('name')
+            def name(self, context, data, field):
+                return data[field].upper()
+
+        sanitizer = Foo().sanitizer
+        result = sanitizer.sanitize(self.create_context, {})
+        self.assertNoResult(result)
+        d.callback({'name': 'sam'})
+        self.assertEqual(self.successResultOf(result), {'name': 'SAM'})
+
+
     def test_getSanitizedFields(self):
         """
         You can list the fields that are being sanitized.
@@ -1186,6 +2997,24 @@ class SaniChainTest(TestCase):
         self.assertEqual(output, {'hey': 'ho'})
 
 
+    def test_synchronous(self):
+        """
+        A chain of synchronous sanitizers sanitizes without waiting on
+        Deferreds.
+        """
+        class Foo(object):
+            sanitizer = Sanitizer(pets)
+
+            @sanitizer.sanitizeField('name')
+            def name(self, context, data, field):
+                return data[field].upper()
+
+        chain = SaniChain([Foo().sanitizer, Writeset(pets, ['name'])])
+        context = SanitizationContext(None, 'create', None)
+        output = chain._sanitize(context, {'name': 'sam', 'foo': 'bar'})
+        self.assertEqual(output, {'name': 'SAM'})
+
+
     def test_differentTable(self):
         """
         Sanitizers must have the same table.
@@ -1255,6 +3084,17 @@ class crudFromSpecTest(TestCase):
         self.assertEqual(crud.table_map, {'foo':'bar'})
 
 
+    def test_cache(self):
+        """
+        You can set the cache.
+        """
+        class Base:
+            table = families
+        cache = QueryCache()
+        crud = crudFromSpec(Base, cache=cache)
+        self.assertIdentical(crud.cache, cache)
+
+
     def test_defaults(self):
         """
         By default, all columns are readable and all are writeable
@@ -0,0 +1,678 @@
+from twisted.trial.unittest import TestCase, SkipTest
+from twisted.internet import defer, reactor
+
+from alchimia import TWISTED_STRATEGY
+
+from sqlalchemy import MetaData, Table, Column, Integer, String, ForeignKey
+from sqlalchemy import create_engine, event
+from sqlalchemy.pool import StaticPool
+
+from crudset.crud import Crud, Paginator, Ref, Sanitizer, Readset, SaniChain
+from crudset.crud import SanitizationContext, LazyList, crudFromSpec
+from crudset.engine import asyncio, driverFor, twisted_driver, sync_driver
+from crudset.engine import AsyncioEngine, AsyncioDriver
+from crudset.engine import transaction, Transaction
+from crudset.cache import QueryCache
+from crudset.error import TooMany, WouldBlock
+
+
+metadata = MetaData()
+families = Table('family', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('surname', String),
+)
+
+people = Table('people', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('family_id', Integer, ForeignKey('family.id')),
+    Column('name', String),
+)
+
+
+
+class PersonSpec(object):
+    table = people
+    writeable = ['family_id', 'name']
+    references = {
+        'family': Ref(Readset(families), people.c.family_id == families.c.id),
+    }
+
+
+
+def sqliteEngine(**kwargs):
+    return create_engine('sqlite://',
+                         connect_args={'check_same_thread': False},
+                         poolclass=StaticPool, **kwargs)
+
+
+
+class driverForTest(TestCase):
+
+
+    def test_default(self):
+        """
+        Engines without a driver of their own get the Twisted one.
+        """
+        self.assertIdentical(driverFor(None), twisted_driver)
+        self.assertIdentical(driverFor(object()), twisted_driver)
+
+
+    def test_twisted_call(self):
+        """
+        The Twisted driver always returns a Deferred from call.
+        """
+        self.assertEqual(self.successResultOf(
+            twisted_driver.call(lambda x: x + 1, 1)), 2)
+        d = defer.succeed(3)
+        self.assertIdentical(twisted_driver.call(lambda: d), d)
+        self.failureResultOf(twisted_driver.call(lambda: 1 / 0),
+                             ZeroDivisionError)
+
+
+    def test_sync(self):
+        """
+        Plain SQLAlchemy engines and connections get the synchronous driver.
+        """
+        engine = sqliteEngine()
+        self.assertIdentical(driverFor(engine), sync_driver)
+        self.assertIdentical(driverFor(engine.connect()), sync_driver)
+        twisted_engine = sqliteEngine(reactor=reactor,
+                                      strategy=TWISTED_STRATEGY)
+        self.assertIdentical(driverFor(twisted_engine), twisted_driver)
+
+
+
+class SyncDriverTest(TestCase):
+
+
+    def test_run(self):
+        """
+        Generators may yield plain values and fired Deferreds, and
+        exceptions are raised back into them.
+        """
+        def gen():
+            a = yield 'plain'
+            b = yield defer.succeed('deferred')
+            try:
+                yield defer.fail(ValueError('foo'))
+            except ValueError as err:
+                c = str(err)
+            defer.returnValue([a, b, c])
+        self.assertEqual(sync_driver.run(gen()), ['plain', 'deferred', 'foo'])
+
+        def failing():
+            yield None
+            raise TooMany('bar')
+        self.assertRaises(TooMany, sync_driver.run, failing())
+
+
+    def test_wouldBlock(self):
+        """
+        Deferreds which haven't fired can't be waited for.
+        """
+        def gen():
+            yield defer.Deferred()
+        self.assertRaises(WouldBlock, sync_driver.run, gen())
+        self.assertRaises(WouldBlock, sync_driver.call, defer.Deferred)
+
+
+    def test_call(self):
+        """
+        Results are returned and failures raised.
+        """
+        self.assertEqual(sync_driver.call(lambda x: x + 1, 1), 2)
+        self.assertEqual(sync_driver.call(defer.succeed, 3), 3)
+        self.assertRaises(ValueError, sync_driver.call, defer.fail,
+                          ValueError('foo'))
+
+
+
+class SyncTest(TestCase):
+
+
+    def setUp(self):
+        self.engine = sqliteEngine()
+        metadata.create_all(self.engine)
+
+
+    def test_crud(self):
+        """
+        With a plain engine, L{Crud} methods return plain values.
+        """
+        crud = Crud(Readset(families), Sanitizer(families))
+        fam = crud.create(self.engine, {'surname': 'Jones'})
+        self.assertEqual(fam, {'id': 1, 'surname': 'Jones'})
+        crud.createMany(self.engine, [{'surname': 'Smith'},
+                                      {'surname': 'Brown'}])
+
+        self.assertEqual(crud.count(self.engine), 3)
+        fams = crud.fetch(self.engine, order=families.c.id)
+        self.assertEqual([x['surname'] for x in fams],
+                         ['Jones', 'Smith', 'Brown'])
+        self.assertEqual(crud.getOne(self.engine,
+                                     families.c.surname == 'Smith')['id'], 2)
+        self.assertRaises(TooMany, crud.getOne, self.engine)
+
+        fams = crud.update(self.engine, {'surname': 'Jones'},
+                           families.c.id == 2)
+        self.assertEqual(fams, [{'id': 2, 'surname': 'Jones'}])
+        crud.delete(self.engine, families.c.surname == 'Jones')
+        self.assertEqual(crud.count(self.engine), 1)
+
+
+    def test_connection(self):
+        """
+        A connection works like an engine.
+        """
+        crud = crudFromSpec(PersonSpec)
+        conn = self.engine.connect()
+        self.addCleanup(conn.close)
+        sam = crud.create(conn, {'name': 'Sam'})
+        self.assertEqual(crud.fetch(conn), [sam])
+
+
+    def test_references(self):
+        """
+        Single, multiple and lazy references work.
+        """
+        fam_crud = Crud(Readset(families), Sanitizer(families))
+        fam = fam_crud.create(self.engine, {'surname': 'Jones'})
+        crud = crudFromSpec(PersonSpec)
+        sam = crud.create(self.engine, {'name': 'Sam', 'family_id': fam['id']})
+        self.assertEqual(sam['family'], fam)
+
+        fam_crud = Crud(Readset(families, references={
+            'people': Ref(Readset(people), people.c.family_id == families.c.id,
+                          multiple=True),
+            'lazy': Ref(Readset(people), people.c.family_id == families.c.id,
+                        multiple=True, lazy=True),
+        }))
+        jones = fam_crud.getOne(self.engine)
+        self.assertEqual(jones['people'], [
+            {'id': sam['id'], 'name': 'Sam', 'family_id': fam['id']}])
+        self.assertEqual(jones['lazy'].load(), jones['people'])
+
+
+    def test_sanitizers(self):
+        """
+        Sanitizers return plain values, even if they're written to return
+        (already fired) Deferreds.
+        """
+        class Thing(object):
+            sanitizer = Sanitizer(families)
+
+            @sanitizer.sanitizeField('surname')
+            def surname(self, context, data, field):
+                return data[field].upper()
+
+            @sanitizer.sanitizeData
+            def deferred(self, context, data):
+                data['surname'] += '!'
+                return defer.succeed(data)
+
+        chain = SaniChain([Thing().sanitizer])
+        context = SanitizationContext(self.engine, 'create', None)
+        self.assertEqual(chain.sanitize(context, {'surname': 'a'}),
+                         {'surname': 'A!'})
+
+        crud = Crud(Readset(families), chain)
+        self.assertEqual(crud.create(self.engine, {'surname': 'jo'})['surname'],
+                         'JO!')
+
+
+    def test_fetchChunks(self):
+        """
+        Chunks are handed to the callback as they're read.
+        """
+        crud = Crud(Readset(families), Sanitizer(families))
+        crud.createMany(self.engine, [{'surname': str(i)} for i in xrange(5)])
+        chunks = []
+        total = crud.fetchChunks(self.engine, lambda x: chunks.append(len(x)),
+                                 chunk_size=2)
+        self.assertEqual(total, 5)
+        self.assertEqual(chunks, [2, 2, 1])
+
+
+    def test_paginator(self):
+        """
+        L{Paginator} works, too.
+        """
+        crud = Crud(Readset(families), Sanitizer(families))
+        crud.createMany(self.engine, [{'surname': str(i)} for i in xrange(5)])
+        pager = Paginator(crud, page_size=2, order=families.c.id)
+        self.assertEqual([x['id'] for x in pager.page(self.engine, 1)], [3, 4])
+        self.assertEqual(pager.pageCount(self.engine), 3)
+        page, cursor = pager.pageAfter(self.engine)
+        page, cursor = pager.pageAfter(self.engine, cursor)
+        self.assertEqual([x['id'] for x in page], [3, 4])
+        page, count = pager.pageWithCount(self.engine, 2)
+        self.assertEqual(([x['id'] for x in page], count), ([5], 3))
+
+
+    def test_loader(self):
+        """
+        Loaders need a Twisted engine.
+        """
+        crud = Crud(Readset(families), Sanitizer(families))
+        self.assertRaises(TypeError, crud.loader, self.engine)
+        if asyncio is not None:
+            loop = asyncio.new_event_loop()
+            self.addCleanup(loop.close)
+            engine = AsyncioEngine(self.engine, loop)
+            self.addCleanup(engine.executor.shutdown)
+            self.assertRaises(TypeError, crud.loader, engine)
+
+
+
+class AsyncioTest(TestCase):
+
+
+    def setUp(self):
+        if asyncio is None:
+            raise SkipTest('asyncio (or trollius) is not installed')
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+        self.engine = AsyncioEngine(sqliteEngine(), self.loop)
+        self.addCleanup(self.engine.executor.shutdown)
+        metadata.create_all(self.engine.engine)
+
+
+    def resolve(self, future):
+        """
+        Run the event loop until C{future} is done.
+        """
+        self.assertTrue(isinstance(future, asyncio.Future), future)
+        return self.loop.run_until_complete(future)
+
+
+    def test_driver(self):
+        """
+        An L{AsyncioEngine} runs operations with an L{AsyncioDriver}.
+        """
+        driver = driverFor(self.engine)
+        self.assertTrue(isinstance(driver, AsyncioDriver))
+        self.assertIdentical(driver.loop, self.loop)
+
+
+    def test_driver_run(self):
+        """
+        Generators may yield Futures, coroutines, Deferreds and plain values,
+        and exceptions are raised back into them.
+        """
+        driver = driverFor(self.engine)
+
+        @asyncio.coroutine
+        def coro():
+            yield asyncio.From(asyncio.sleep(0, loop=self.loop))
+            raise asyncio.Return('coro')
+
+        def gen():
+            a = yield 'plain'
+            b = yield defer.succeed('deferred')
+            c = yield coro()
+            d = defer.Deferred()
+            self.loop.call_soon(d.callback, 'later')
+            e = yield d
+            try:
+                yield defer.fail(ValueError('foo'))
+            except ValueError as err:
+                f = str(err)
+            defer.returnValue([a, b, c, e, f])
+
+        self.assertEqual(self.resolve(driver.run(gen())),
+                         ['plain', 'deferred', 'coro', 'later', 'foo'])
+
+        def failing():
+            yield None
+            raise TooMany('bar')
+        self.assertRaises(TooMany, self.resolve, driver.run(failing()))
+
+
+    def test_crud(self):
+        """
+        With an L{AsyncioEngine}, L{Crud} methods return Futures.
+        """
+        crud = Crud(Readset(families), Sanitizer(families))
+        fam = self.resolve(crud.create(self.engine, {'surname': 'Jones'}))
+        self.assertEqual(fam, {'id': 1, 'surname': 'Jones'})
+        self.resolve(crud.createMany(self.engine, [{'surname': 'Smith'},
+                                                   {'surname': 'Brown'}]))
+
+        self.assertEqual(self.resolve(crud.count(self.engine)), 3)
+        fams = self.resolve(crud.fetch(self.engine, order=families.c.id))
+        self.assertEqual([x['surname'] for x in fams],
+                         ['Jones', 'Smith', 'Brown'])
+        self.assertEqual(self.resolve(crud.getOne(self.engine,
+            families.c.surname == 'Smith'))['id'], 2)
+        self.assertRaises(TooMany, self.resolve, crud.getOne(self.engine))
+
+        fams = self.resolve(crud.update(self.engine, {'surname': 'Jones'},
+                                        families.c.id == 2))
+        self.assertEqual(fams, [{'id': 2, 'surname': 'Jones'}])
+        self.resolve(crud.delete(self.engine, families.c.surname == 'Jones'))
+        self.assertEqual(self.resolve(crud.count(self.engine)), 1)
+
+
+    def test_references(self):
+        """
+        Single, multiple and lazy references work.
+        """
+        fam_crud = Crud(Readset(families), Sanitizer(families))
+        fam = self.resolve(fam_crud.create(self.engine, {'surname': 'Jones'}))
+        crud = crudFromSpec(PersonSpec)
+        sam = self.resolve(crud.create(self.engine, {'name': 'Sam',
+                                                     'family_id': fam['id']}))
+        self.assertEqual(sam['family'], fam)
+
+        fam_crud = Crud(Readset(families, references={
+            'people': Ref(Readset(people), people.c.family_id == families.c.id,
+                          multiple=True),
+            'lazy': Ref(Readset(people), people.c.family_id == families.c.id,
+                        multiple=True, lazy=True),
+        }))
+        jones = self.resolve(fam_crud.getOne(self.engine))
+        self.assertEqual(jones['people'], [
+            {'id': sam['id'], 'name': 'Sam', 'family_id': fam['id']}])
+        self.assertTrue(isinstance(jones['lazy'], LazyList))
+        self.assertEqual(self.resolve(jones['lazy'].load()), jones['people'])
+
+
+    def test_sameSpec(self):
+        """
+        The same spec works with Twisted and asyncio engines.
+        """
+        crud = crudFromSpec(PersonSpec)
+        sam = self.resolve(crud.create(self.engine, {'name': 'Sam'}))
+        self.assertEqual(sam['name'], 'Sam')
+
+        twisted_engine = sqliteEngine(reactor=reactor,
+                                      strategy=TWISTED_STRATEGY)
+        metadata.create_all(twisted_engine._engine)
+        d = crud.create(twisted_engine, {'name': 'Tim'})
+        self.assertTrue(isinstance(d, defer.Deferred))
+        d.addCallback(lambda _: crud.fetch(twisted_engine))
+        d.addCallback(lambda people: self.assertEqual(
+            [x['name'] for x in people], ['Tim']))
+        return d
+
+
+    def test_asyncSanitizers(self):
+        """
+        Sanitizers may be coroutines (or return Deferreds).
+        """
+        class Thing(object):
+            sanitizer = Sanitizer(families)
+
+            @sanitizer.sanitizeField('surname')
+            @asyncio.coroutine
+            def surname(self, context, data, field):
+                yield asyncio.From(asyncio.sleep(0, loop=context.engine.loop))
+                raise asyncio.Return(data[field].upper())
+
+            @sanitizer.sanitizeData
+            def deferred(self, context, data):
+                data['surname'] += '!'
+                return defer.succeed(data)
+
+        class Custom(object):
+            table = families
+
+            @asyncio.coroutine
+            def sanitize(self, context, data):
+                raise asyncio.Return(dict(data, surname=data['surname'] * 2))
+
+        chain = SaniChain([Thing().sanitizer, Custom()])
+        context = SanitizationContext(self.engine, 'create', None)
+        self.assertEqual(self.resolve(chain.sanitize(context,
+                                                     {'surname': 'a'})),
+                         {'surname': 'A!A!'})
+
+        crud = Crud(Readset(families), chain)
+        fam = self.resolve(crud.create(self.engine, {'surname': 'jones'}))
+        self.assertEqual(fam['surname'], 'JONES!JONES!')
+
+
+    @defer.inlineCallbacks
+    def test_asyncSanitizers_twisted(self):
+        """
+        With a Twisted engine, there's no event loop to run coroutine
+        sanitizers on, so they fail rather than never finishing.
+        """
+        class Thing(object):
+            sanitizer = Sanitizer(families)
+
+            @sanitizer.sanitizeField('surname')
+            @asyncio.coroutine
+            def surname(self, context, data, field):
+                raise asyncio.Return(data[field].upper())
+
+        class Custom(object):
+            table = families
+
+            @asyncio.coroutine
+            def sanitize(self, context, data):
+                raise asyncio.Return(data)
+
+        engine = sqliteEngine(reactor=reactor, strategy=TWISTED_STRATEGY)
+        metadata.create_all(engine._engine)
+        for sanitizer in [Thing().sanitizer, Custom()]:
+            crud = Crud(Readset(families), sanitizer)
+            yield self.assertFailure(crud.create(engine, {'surname': 'a'}),
+                                     TypeError)
+        count = yield crud.count(engine)
+        self.assertEqual(count, 0)
+
+
+    def test_fetchChunks(self):
+        """
+        Chunk callbacks may be coroutines.
+        """
+        crud = Crud(Readset(families), Sanitizer(families))
+        self.resolve(crud.createMany(self.engine, [{'surname': str(i)}
+                                                   for i in xrange(5)]))
+        chunks = []
+
+        @asyncio.coroutine
+        def callback(chunk):
+            yield asyncio.From(asyncio.sleep(0, loop=self.loop))
+            chunks.append(len(chunk))
+
+        total = self.resolve(crud.fetchChunks(self.engine, callback,
+                                              chunk_size=2))
+        self.assertEqual(total, 5)
+        self.assertEqual(chunks, [2, 2, 1])
+
+
+    def test_paginator(self):
+        """
+        L{Paginator} works, too.
+        """
+        crud = Crud(Readset(families), Sanitizer(families))
+        self.resolve(crud.createMany(self.engine, [{'surname': str(i)}
+                                                   for i in xrange(5)]))
+        pager = Paginator(crud, page_size=2, order=families.c.id)
+        page = self.resolve(pager.page(self.engine, 1))
+        self.assertEqual([x['id'] for x in page], [3, 4])
+        self.assertEqual(self.resolve(pager.pageCount(self.engine)), 3)
+        page, cursor = self.resolve(pager.pageAfter(self.engine))
+        page, cursor = self.resolve(pager.pageAfter(self.engine, cursor))
+        self.assertEqual([x['id'] for x in page], [3, 4])
+        page, count = self.resolve(pager.pageWithCount(self.engine, 2))
+        self.assertEqual(([x['id'] for x in page], count), ([5], 3))
+
+
+
+def addFamily(txn, surname, names):
+    """
+    Create a family and its people, as an operation which yields what
+    the L{Crud}s return (to be run by whichever driver).
+    """
+    family_crud = Crud(Readset(families), Sanitizer(families))
+    family = yield family_crud.create(txn, {'surname': surname})
+    people_crud = crudFromSpec(PersonSpec)
+    for name in names:
+        if name is None:
+            raise ValueError('no name')
+        yield people_crud.create(txn, {'name': name,
+                                       'family_id': family['id']})
+    defer.returnValue(family)
+
+
+
+class TwistedTransactionTest(TestCase):
+
+
+    def setUp(self):
+        self.engine = sqliteEngine(reactor=reactor, strategy=TWISTED_STRATEGY)
+        metadata.create_all(self.engine._engine)
+        self.crud = crudFromSpec(PersonSpec)
+
+
+    @defer.inlineCallbacks
+    def test_commit(self):
+        """
+        Operations in a transaction share a connection and are committed
+        together.
+        """
+        checkouts = []
+        event.listen(self.engine._engine.pool, 'checkout',
+                     lambda *args: checkouts.append(1))
+        family = yield transaction(self.engine,
+            defer.inlineCallbacks(addFamily), 'Jones', ['Sam', 'Sue'])
+        self.assertEqual(family['surname'], 'Jones')
+        self.assertEqual(len(checkouts), 1)
+
+        people = yield self.crud.fetch(self.engine)
+        self.assertEqual([x['name'] for x in people], ['Sam', 'Sue'])
+        self.assertEqual(people[0]['family'], family)
+
+
+    @defer.inlineCallbacks
+    def test_rollback(self):
+        """
+        If the function fails, everything is rolled back.
+        """
+        yield self.assertFailure(transaction(self.engine,
+            defer.inlineCallbacks(addFamily), 'Jones', ['Sam', None]),
+            ValueError)
+        count = yield self.crud.count(self.engine)
+        self.assertEqual(count, 0)
+
+
+    @defer.inlineCallbacks
+    def test_nested(self):
+        """
+        A transaction within a transaction joins it.
+        """
+        def outer(txn):
+            self.assertTrue(isinstance(txn, Transaction))
+            return transaction(txn, inner)
+        def inner(txn):
+            self.assertTrue(isinstance(txn, Transaction))
+            self.inner = txn
+            return self.crud.create(txn, {'name': 'Sam'})
+        sam = yield transaction(self.engine, outer)
+        self.assertEqual(sam['name'], 'Sam')
+        self.assertIdentical(self.inner.engine, self.engine)
+
+
+    @defer.inlineCallbacks
+    def test_notCached(self):
+        """
+        Reads in a transaction aren't cached, since they can see
+        uncommitted writes.
+        """
+        cache = QueryCache()
+        crud = crudFromSpec(PersonSpec, cache=cache)
+        yield transaction(self.engine, crud.create, {'name': 'Sam'})
+        self.assertEqual(len(cache), 0)
+
+
+
+class SyncTransactionTest(TestCase):
+
+
+    def setUp(self):
+        self.engine = sqliteEngine()
+        metadata.create_all(self.engine)
+        self.crud = crudFromSpec(PersonSpec)
+
+
+    def test_commit(self):
+        """
+        Operations in a transaction share a connection and are committed
+        once.
+        """
+        checkouts = []
+        commits = []
+        event.listen(self.engine.pool, 'checkout',
+                     lambda *args: checkouts.append(1))
+        event.listen(self.engine, 'commit', lambda *args: commits.append(1))
+        run = lambda txn, *args: sync_driver.run(addFamily(txn, *args))
+        family = transaction(self.engine, run, 'Jones', ['Sam', 'Sue', 'Al'])
+        self.assertEqual(family['surname'], 'Jones')
+        self.assertEqual((len(checkouts), len(commits)), (1, 1))
+        self.assertEqual(self.crud.count(self.engine), 3)
+
+
+    def test_rollback(self):
+        """
+        If the function fails, everything is rolled back.
+        """
+        run = lambda txn, *args: sync_driver.run(addFamily(txn, *args))
+        self.assertRaises(ValueError, transaction, self.engine, run,
+                          'Jones', ['Sam', None])
+        self.assertEqual(self.crud.count(self.engine), 0)
+
+
+    def test_invalidatedOnCommit(self):
+        """
+        Reads cached on other connections before the commit are invalidated
+        by it.
+        """
+        engine = create_engine('sqlite:///' + self.mktemp())
+        metadata.create_all(engine)
+        crud = crudFromSpec(PersonSpec, cache=QueryCache())
+        def run(txn):
+            crud.create(txn, {'name': 'Sam'})
+            self.assertEqual(crud.count(engine), 0)
+            self.assertEqual(txn.written, set([people]))
+        transaction(engine, run)
+        self.assertEqual(crud.count(engine), 1)
+
+
+
+class AsyncioTransactionTest(TestCase):
+
+
+    def setUp(self):
+        if asyncio is None:
+            raise SkipTest('asyncio (or trollius) is not installed')
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+        self.engine = AsyncioEngine(sqliteEngine(), self.loop)
+        self.addCleanup(self.engine.executor.shutdown)
+        metadata.create_all(self.engine.engine)
+        self.crud = crudFromSpec(PersonSpec)
+        self.addFamily = lambda txn, *args: driverFor(txn).run(addFamily(txn, *args))
+
+
+    def test_commit(self):
+        """
+        Operations in a transaction are committed together.
+        """
+        family = self.loop.run_until_complete(transaction(self.engine,
+            self.addFamily, 'Jones', ['Sam', 'Sue']))
+        self.assertEqual(family['surname'], 'Jones')
+        self.assertEqual(self.loop.run_until_complete(
+            self.crud.count(self.engine)), 2)
+
+
+    def test_rollback(self):
+        """
+        If the function fails, everything is rolled back.
+        """
+        self.assertRaises(ValueError, self.loop.run_until_complete,
+            transaction(self.engine, self.addFamily, 'Jones', ['Sam', None]))
+        self.assertEqual(self.loop.run_until_complete(
+            self.crud.count(self.engine)), 0)
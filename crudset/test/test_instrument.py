@@ -0,0 +1,216 @@
+from twisted.trial.unittest import TestCase
+from twisted.internet import defer
+
+from mock import MagicMock
+
+from crudset import instrument
+from crudset.instrument import OperationEvent, InstrumentedEngine, unwrap
+from crudset.instrument import instrumented, timeSanitizer, recordCount
+from crudset.instrument import Histogram, Histograms
+
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 0.0
+
+
+    def __call__(self):
+        return self.now
+
+
+
+class Thing(object):
+
+    def __init__(self, clock, instrument=None):
+        self.clock = clock
+        self.instrument = instrument
+
+
+    @instrumented('work', rows=recordCount)
+    def work(self, engine, result, seconds=1.0):
+        self.clock.now += seconds
+        engine.execute('one')
+        return result
+
+
+    @instrumented('outer')
+    def outer(self, engine):
+        engine.execute('outer')
+        return self.work(engine, [1, 2])
+
+
+    @instrumented('fail')
+    def fail(self, engine):
+        engine.execute('fail')
+        raise ValueError('foo')
+
+
+
+class instrumentedTest(TestCase):
+
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.patch(instrument, '_now', self.clock)
+        self.events = []
+        self.thing = Thing(self.clock, self.events.append)
+        self.engine = MagicMock()
+
+
+    def test_event(self):
+        """
+        An event is reported with the time taken, the number of statements
+        and the number of records.
+        """
+        result = self.successResultOf(
+            self.thing.work(self.engine, [1, 2, 3], 2.5))
+        self.assertEqual(result, [1, 2, 3])
+        self.engine.execute.assert_called_once_with('one')
+        self.assertEqual(len(self.events), 1)
+        event = self.events[0]
+        self.assertEqual(event.source, self.thing)
+        self.assertEqual(event.operation, 'work')
+        self.assertEqual(event.seconds, 2.5)
+        self.assertEqual(event.statements, 1)
+        self.assertEqual(event.rows, 3)
+        self.assertEqual(event.failure, None)
+
+
+    def test_nested(self):
+        """
+        Operations within an operation are part of the outer operation.
+        """
+        self.successResultOf(self.thing.outer(self.engine))
+        self.assertEqual(len(self.events), 1)
+        event = self.events[0]
+        self.assertEqual(event.operation, 'outer')
+        self.assertEqual(event.statements, 2)
+        self.assertEqual(event.seconds, 1.0)
+        self.assertEqual(event.rows, None)
+
+
+    def test_failure(self):
+        """
+        Failed operations are reported, too.
+        """
+        self.failureResultOf(self.thing.fail(self.engine), ValueError)
+        event = self.events[0]
+        self.assertEqual(event.statements, 1)
+        self.assertTrue(event.failure.check(ValueError))
+
+
+    def test_noInstrument(self):
+        """
+        Without an instrument, the engine isn't wrapped.
+        """
+        self.thing.instrument = None
+        self.assertEqual(self.thing.work(self.engine, [1]), [1])
+
+
+    def test_timeSanitizer(self):
+        """
+        Time spent sanitizing is added to the operation.
+        """
+        event = OperationEvent(None, 'create')
+        context = MagicMock()
+        context.engine = InstrumentedEngine(self.engine, event)
+        d = defer.Deferred()
+        result = timeSanitizer(lambda context, data: d, context, {'a': 1})
+        self.clock.now += 2.0
+        d.callback({'a': 2})
+        self.assertEqual(self.successResultOf(result), {'a': 2})
+        self.assertEqual(event.sanitize_seconds, 2.0)
+
+
+    def test_timeSanitizer_notInstrumented(self):
+        """
+        Outside of an operation, the sanitizer is just called.
+        """
+        context = MagicMock()
+        context.engine = self.engine
+        result = timeSanitizer(lambda context, data: 'foo', context, {})
+        self.assertEqual(result, 'foo')
+
+
+
+class InstrumentedEngineTest(TestCase):
+
+
+    def test_passthrough(self):
+        """
+        Everything but execute goes straight to the wrapped engine.
+        """
+        engine = MagicMock()
+        event = OperationEvent(None, 'fetch')
+        wrapped = InstrumentedEngine(engine, event)
+        self.assertEqual(wrapped.dialect, engine.dialect)
+        wrapped.execute('foo', bar='baz')
+        engine.execute.assert_called_once_with('foo', bar='baz')
+        self.assertEqual(event.statements, 1)
+        self.assertEqual(unwrap(wrapped), engine)
+        self.assertEqual(unwrap(engine), engine)
+
+
+
+class HistogramsTest(TestCase):
+
+
+    def event(self, source, operation, seconds, **kwargs):
+        event = OperationEvent(source, operation)
+        event.seconds = seconds
+        for k, v in kwargs.items():
+            setattr(event, k, v)
+        return event
+
+
+    def test_perSourceAndOperation(self):
+        """
+        There's a histogram for each source and operation.
+        """
+        stats = Histograms(bounds=[1, 2, 3])
+        stats(self.event('a', 'fetch', 0.5, rows=2, statements=3))
+        stats(self.event('a', 'fetch', 2.5, rows=1, statements=1,
+                         sanitize_seconds=0.25))
+        stats(self.event('a', 'count', 1.5))
+        stats(self.event('b', 'fetch', 4.0, failure='x'))
+
+        h = stats.get('a', 'fetch')
+        self.assertEqual(h.count, 2)
+        self.assertEqual(h.buckets, [1, 0, 1, 0])
+        self.assertEqual(h.rows, 3)
+        self.assertEqual(h.statements, 4)
+        self.assertEqual(h.seconds, 3.0)
+        self.assertEqual(h.sanitize_seconds, 0.25)
+        self.assertEqual(h.failures, 0)
+        self.assertEqual(h.mean(), 1.5)
+
+        self.assertEqual(stats.get('a', 'count').buckets, [0, 1, 0, 0])
+        self.assertEqual(stats.get('b', 'fetch').buckets, [0, 0, 0, 1])
+        self.assertEqual(stats.get('b', 'fetch').failures, 1)
+        self.assertEqual(stats.get('b', 'count'), None)
+
+        stats.clear()
+        self.assertEqual(stats.get('a', 'fetch'), None)
+
+
+    def test_percentile(self):
+        """
+        Percentiles are the upper bound of the bucket they fall in (or the
+        slowest time, if that's less).
+        """
+        h = Histogram((1, 2, 3))
+        self.assertEqual(h.percentile(50), None)
+        self.assertEqual(h.mean(), None)
+        for seconds in [0.5] * 8 + [1.5, 10]:
+            h.add(self.event('a', 'fetch', seconds))
+        self.assertEqual(h.percentile(50), 1)
+        self.assertEqual(h.percentile(80), 1)
+        self.assertEqual(h.percentile(90), 2)
+        self.assertEqual(h.percentile(100), 10)
+        self.assertEqual(h.max_seconds, 10)
+
+        h = Histogram((1, 2, 3))
+        h.add(self.event('a', 'fetch', 0.25))
+        self.assertEqual(h.percentile(99), 0.25)
@@ -0,0 +1,189 @@
+from twisted.trial.unittest import TestCase
+from twisted.internet import defer
+
+from mock import MagicMock
+
+from sqlalchemy import MetaData, Table, Column, Integer, String
+from sqlalchemy import create_engine
+
+from crudset.crud import Crud, Paginator, Readset, Sanitizer
+from crudset.engine import transaction, sync_driver
+from crudset.instrument import Histograms
+from crudset.router import Router, primaryOf
+
+
+metadata = MetaData()
+families = Table('family', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('surname', String),
+)
+
+
+
+class RouterTest(TestCase):
+
+
+    def setUp(self):
+        """
+        A primary and two replicas, as separate SQLite files which start
+        out with different families.  Nothing is actually replicated, so
+        the families show where a read went.
+        """
+        self.primary = self.sqlite(['Primary'])
+        self.replicas = [self.sqlite(['One']), self.sqlite(['Two'])]
+        self.router = Router(self.primary, self.replicas)
+        self.crud = Crud(Readset(families), Sanitizer(families))
+
+
+    def sqlite(self, surnames):
+        engine = create_engine('sqlite:///' + self.mktemp())
+        metadata.create_all(engine)
+        for surname in surnames:
+            engine.execute(families.insert().values(surname=surname))
+        return engine
+
+
+    def surnames(self, records):
+        return [x['surname'] for x in records]
+
+
+    def test_reads(self):
+        """
+        Reads go to each replica in turn.
+        """
+        self.assertEqual(self.surnames(self.crud.fetch(self.router)), ['One'])
+        self.assertEqual(self.crud.getOne(self.router)['surname'], 'Two')
+        self.assertEqual(self.crud.count(self.router), 1)
+        pager = Paginator(self.crud, page_size=1, order=families.c.id)
+        self.assertEqual(self.surnames(pager.page(self.router, 0)), ['Two'])
+        self.assertEqual(self.router.outstanding, [0, 0])
+
+
+    def test_writes(self):
+        """
+        Writes, and reading back what was written, go to the primary.
+        """
+        jones = self.crud.create(self.router, {'surname': 'Jones'})
+        self.assertEqual(jones, {'id': 2, 'surname': 'Jones'})
+        smiths = self.crud.createMany(self.router, [{'surname': 'Smith'}])
+        self.assertEqual(self.surnames(smiths), ['Smith'])
+        updated = self.crud.update(self.router, {'surname': 'Brown'},
+                                   families.c.id == 2)
+        self.assertEqual(updated, [{'id': 2, 'surname': 'Brown'}])
+        updated = self.crud.updateMany(self.router,
+                                       [{'id': 3, 'surname': 'Green'}])
+        self.assertEqual(self.surnames(updated), ['Green'])
+        self.crud.delete(self.router, families.c.id == 1)
+
+        self.assertEqual(self.surnames(self.crud.fetch(self.primary)),
+                         ['Brown', 'Green'])
+        for replica, surname in zip(self.replicas, ['One', 'Two']):
+            self.assertEqual(self.surnames(self.crud.fetch(replica)),
+                             [surname])
+
+
+    def test_fixed(self):
+        """
+        Cruds made by fix() route the same way.
+        """
+        crud = self.crud.fix({'surname': 'Jones'})
+        self.assertEqual(crud.create(self.router, {})['surname'], 'Jones')
+        self.assertEqual(crud.count(self.router), 0)
+
+
+    def test_transaction(self):
+        """
+        Transactions run on the primary.
+        """
+        def run(txn):
+            self.crud.create(txn, {'surname': 'Jones'})
+            return self.crud.count(txn)
+        self.assertEqual(transaction(self.router, run), 2)
+
+
+    def test_instrumented(self):
+        """
+        Writes on the primary are still instrumented.
+        """
+        stats = Histograms()
+        crud = Crud(Readset(families), Sanitizer(families), instrument=stats)
+        crud.create(self.router, {'surname': 'Jones'})
+        self.assertEqual(stats.get(crud, 'create').statements, 2)
+        self.assertEqual(self.crud.count(self.primary), 2)
+
+
+    def test_noReplicas(self):
+        """
+        Without replicas, everything goes to the primary.
+        """
+        router = Router(self.primary, [])
+        self.assertEqual(self.surnames(self.crud.fetch(router)), ['Primary'])
+
+
+    def test_unknownPolicy(self):
+        """
+        Only known policies are allowed.
+        """
+        self.assertRaises(ValueError, Router, self.primary, [], 'random')
+
+
+    def test_primaryOf(self):
+        """
+        Things which aren't L{Router}s are their own primary.
+        """
+        self.assertIdentical(primaryOf(self.router), self.primary)
+        self.assertIdentical(primaryOf(self.primary), self.primary)
+
+
+    def test_driver(self):
+        """
+        Operations are run by the primary's driver.
+        """
+        self.assertIdentical(self.router.crudsetDriver(), sync_driver)
+
+
+
+class leastOutstandingTest(TestCase):
+
+
+    def engine(self):
+        """
+        Make an engine whose statements don't finish until their Deferreds
+        (in C{self.pending}) are fired.
+        """
+        engine = MagicMock()
+        def execute(*args):
+            d = defer.Deferred()
+            self.pending.append((engine, d))
+            return d
+        engine.execute.side_effect = execute
+        return engine
+
+
+    def test_leastOutstanding(self):
+        """
+        Reads go to the replica with the fewest statements still executing.
+        """
+        self.pending = []
+        primary = self.engine()
+        replicas = [self.engine(), self.engine()]
+        router = Router(primary, replicas, policy='least-outstanding')
+        query = families.select()
+
+        router.execute(query)
+        router.execute(query)
+        router.execute(query)
+        self.assertEqual(router.outstanding, [2, 1])
+        self.assertEqual([x[0] for x in self.pending],
+                         [replicas[0], replicas[1], replicas[0]])
+
+        self.pending[0][1].callback('result')
+        self.pending[2][1].errback(ValueError('foo'))
+        self.failureResultOf(self.pending[2][1], ValueError)
+        self.assertEqual(router.outstanding, [0, 1])
+        router.execute(query)
+        self.assertIdentical(self.pending[-1][0], replicas[0])
+
+        router.execute(families.insert())
+        self.assertIdentical(self.pending[-1][0], primary)
+        self.assertEqual(router.outstanding, [1, 1])